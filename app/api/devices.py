@@ -1,26 +1,66 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from typing import Any, Dict, List, Tuple
 from supabase import Client
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from app.core.deps import get_supabase, get_current_user, get_device_manager
-from app.core.device_manager import DeviceManager
+from app.core.deps import get_supabase, get_current_user, get_device_manager, get_device_state_cache
+from app.core.device_manager import DeviceManager, CommandQueueFull
+from app.core.device_state import DeviceStateCache
 from app.core.ws_manager import manager as ws_manager
 from app.models.device import DeviceCreate, DeviceUpdate, DeviceResponse
-from app.models.device_command import DeviceCommand
+from app.core.config import settings
+from app.models.device_command import DeviceCommand, DeviceCommandResult, DeviceGroupCommand, DeviceGroupCommandResponse
 
 router = APIRouter()
 
 
+def driver_spec(record: dict) -> Tuple[str, Dict[str, Any]]:
+    """(device_type, config) con cui caricare il driver del dispositivo"""
+    # In un caso reale, la config verrebbe dal DB o da un secret manager
+    return record.get("device_type") or "virtual_light", record.get("state") or {}
+
+
+def recent_devices(supabase: Client, device_cache: DeviceStateCache) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Dispositivi visti nelle ultime DEVICE_PRELOAD_WINDOW_HOURS (al più DEVICE_PRELOAD_MAX, dai più
+    recenti) da connettere all'avvio; i loro record vengono messi anche nella cache.
+    """
+    if settings.DEVICE_PRELOAD_MAX <= 0:
+        return []
+    since = datetime.utcnow() - timedelta(hours=settings.DEVICE_PRELOAD_WINDOW_HOURS)
+    result = supabase.table("devices").select("*").gte("last_seen", since.isoformat()) \
+        .order("last_seen", desc=True).limit(settings.DEVICE_PRELOAD_MAX).execute()
+    devices = []
+    for record in result.data:
+        device_cache.put(record)
+        devices.append((str(record["id"]), *driver_spec(record)))
+    return devices
+
+
+async def on_polled_state(device_cache: DeviceStateCache, device_id: str, state: Dict[str, Any]):
+    """Stato cambiato fuori dall'app (letto dal poller): aggiorna la cache e notifica i client"""
+    if not await device_cache.run(device_cache.refresh_state, device_id, state):
+        return  # Già noto, es. appena notificato da un comando
+    try:
+        await ws_manager.broadcast({
+            "event": "device_update",
+            "device_id": device_id,
+            "state": state
+        })
+    except Exception:
+        pass
+
+
 @router.get("/", response_model=List[DeviceResponse])
 async def list_devices(
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache)
 ):
-    """Lista tutti i device dell'utente corrente"""
+    """Lista tutti i device dell'utente corrente (con gli stati non ancora salvati su Supabase)"""
     try:
         result = supabase.table("devices").select("*").eq("user_id", current_user.id).execute()
-        return result.data
+        return await device_cache.run(device_cache.overlay, result.data)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -32,7 +72,8 @@ async def list_devices(
 async def create_device(
     device: DeviceCreate,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache)
 ):
     """Crea un nuovo device"""
     try:
@@ -41,6 +82,8 @@ async def create_device(
         device_data["created_at"] = datetime.utcnow().isoformat()
         
         result = supabase.table("devices").insert(device_data).execute()
+        if result.data:
+            await device_cache.run(device_cache.put, result.data[0])
         return result.data[0] if result.data else None
     except Exception as e:
         raise HTTPException(
@@ -49,32 +92,77 @@ async def create_device(
         )
 
 
+@router.post("/commands", response_model=DeviceGroupCommandResponse)
+async def send_group_command(
+    group: DeviceGroupCommand,
+    current_user: dict = Depends(get_current_user),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache),
+    device_manager: DeviceManager = Depends(get_device_manager)
+):
+    """
+    Invia un comando a più dispositivi in parallelo (gruppo, o scena con params per dispositivo).
+    Risponde con l'esito di ciascuno e invia un unico evento devices_update via WebSocket.
+    """
+    try:
+        targets = {target.device_id: target.params if target.params is not None else group.params for target in group.devices}
+        records = await device_cache.run(device_cache.get_many, list(targets), current_user.id)
+        specs = {device_id: driver_spec(record) for device_id, record in records.items()}
+        outcomes = await device_manager.send_commands(
+            {device_id: params for device_id, params in targets.items() if device_id in records},
+            specs=specs,
+            concurrency=settings.DEVICE_COMMAND_CONCURRENCY,
+            timeout=group.timeout or settings.DEVICE_COMMAND_TIMEOUT
+        )
+        
+        results = []
+        updates = []
+        for device_id in targets:
+            outcome = outcomes.get(device_id)
+            if outcome is None:
+                results.append(DeviceCommandResult(device_id=device_id, status="not_found", error="Device not found"))
+                continue
+            if outcome["status"] == "ok":
+                await device_cache.run(device_cache.update_state, device_id, outcome["state"])
+                updates.append({"device_id": device_id, "state": outcome["state"]})
+            results.append(DeviceCommandResult(device_id=device_id, **outcome))
+        
+        # Un solo evento per tutto il gruppo invece di uno per dispositivo
+        if updates:
+            try:
+                await ws_manager.broadcast({"event": "devices_update", "devices": updates})
+            except Exception:
+                pass
+        
+        succeeded = len(updates)
+        return DeviceGroupCommandResponse(results=results, succeeded=succeeded, failed=len(results) - succeeded)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error sending group command: {str(e)}"
+        )
+
+
 @router.get("/{device_id}", response_model=DeviceResponse)
 async def get_device(
     device_id: str,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache),
     device_manager: DeviceManager = Depends(get_device_manager)
 ):
     """Ottieni un device specifico, con stato aggiornato dal driver se disponibile"""
     try:
-        result = supabase.table("devices").select("*").eq("id", device_id).eq("user_id", current_user.id).execute()
+        device_data = await device_cache.run(device_cache.get, device_id, current_user.id)
         
-        if not result.data:
+        if device_data is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Device {device_id} not found"
             )
         
-        device_data = result.data[0]
-        
         # Prova a ottenere lo stato real-time dal driver
         real_time_state = await device_manager.get_device_state(device_id)
         if real_time_state:
             device_data["state"] = real_time_state
-            
-            # Opzionale: aggiorna il DB con l'ultimo stato noto
-            # supabase.table("devices").update({"state": real_time_state}).eq("id", device_id).execute()
         
         return device_data
     except HTTPException:
@@ -91,39 +179,39 @@ async def send_command(
     device_id: str,
     command: DeviceCommand,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache),
     device_manager: DeviceManager = Depends(get_device_manager)
 ):
-    """Invia un comando a un dispositivo"""
+    """
+    Invia un comando a un dispositivo.
+    Proprietario e stato vengono dalla cache: il nuovo stato è salvato su Supabase al prossimo flush.
+    I comandi ravvicinati (es. uno slider) vengono fusi: solo l'ultimo aggiorna la cache e notifica.
+    Risponde 429 se il dispositivo ha troppi comandi in attesa.
+    """
     try:
         # Verifica ownership
-        result = supabase.table("devices").select("*").eq("id", device_id).eq("user_id", current_user.id).execute()
-        if not result.data:
+        device_record = await device_cache.run(device_cache.get, device_id, current_user.id)
+        if device_record is None:
              raise HTTPException(status_code=404, detail="Device not found")
         
-        device_record = result.data[0]
-        
-        # Se il driver non è caricato, prova a caricarlo
-        if device_id not in device_manager.drivers:
-             # In un caso reale, la config verrebbe dal DB o da un secret manager
-             config = device_record.get("state", {})
-             device_type = device_record.get("device_type", "virtual_light") # Default fallback
-             await device_manager.load_device(device_id, device_type, config)
+        # Se il driver non è caricato (o è stato disconnesso perché inattivo), lo carica
+        await device_manager.ensure_device(device_id, *driver_spec(device_record))
 
         # Invia comando
-        success = await device_manager.send_command(device_id, command.params)
+        try:
+            success, last = await device_manager.submit_command(device_id, command.params)
+        except CommandQueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
         
         if not success:
              raise HTTPException(status_code=500, detail="Failed to execute command on device")
              
         # Ottieni stato aggiornato
         new_state = await device_manager.get_device_state(device_id)
-        
-        # Aggiorna DB
-        update_response = supabase.table("devices").update({
-            "state": new_state,
-            "last_seen": datetime.utcnow().isoformat()
-        }).eq("id", device_id).execute()
+        if not last:
+            # Fuso con un comando successivo: salvataggio e notifica li fa quello
+            return {**device_record, "state": new_state}
+        device_record = await device_cache.run(device_cache.update_state, device_id, new_state)
         
         # Invia notifica real-time via WebSocket
         try:
@@ -136,7 +224,7 @@ async def send_command(
             # Non bloccare la chiamata API se il WS fallisce
             pass
         
-        return update_response.data[0]
+        return device_record
 
     except HTTPException:
         raise
@@ -152,7 +240,8 @@ async def update_device(
     device_id: str,
     device_update: DeviceUpdate,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache)
 ):
     """Aggiorna un device esistente"""
     try:
@@ -167,7 +256,8 @@ async def update_device(
                 detail=f"Device {device_id} not found"
             )
         
-        return result.data[0]
+        await device_cache.run(device_cache.put, result.data[0], keep_state="state" not in update_data)
+        return (await device_cache.run(device_cache.overlay, result.data))[0]
     except HTTPException:
         raise
     except Exception as e:
@@ -181,7 +271,9 @@ async def update_device(
 async def delete_device(
     device_id: str,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    device_cache: DeviceStateCache = Depends(get_device_state_cache),
+    device_manager: DeviceManager = Depends(get_device_manager)
 ):
     """Elimina un device"""
     try:
@@ -193,6 +285,8 @@ async def delete_device(
                 detail=f"Device {device_id} not found"
             )
         
+        await device_cache.run(device_cache.invalidate, device_id)
+        await device_manager.unload_device(device_id)
         return None
     except HTTPException:
         raise
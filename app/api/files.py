@@ -1,26 +1,386 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Header, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import Iterator, List, Optional
 from supabase import Client
-from datetime import datetime
-import hashlib
+from datetime import datetime, timedelta, timezone
+import itertools
 import os
+import posixpath
+import shutil
 
 from app.core.config import settings
-from app.core.deps import get_supabase, get_current_user
-from app.models.file import FileCreate, FileResponse, FileUploadResponse
+from app.core.storage import write_stream_to_temp, iter_upload_file, discard_temp
+from app.core.io_pool import run_io
+from app.core.media_pipeline import media_pipeline, is_supported_media
+from app.core.thumbnails import THUMBNAIL_MEDIA_TYPE
+from app.core.ws_manager import manager as ws_manager
+from app.core.blob_store import BlobStore
+from app.core.change_journal import ChangeJournal, CursorExpired
+from app.core.folder_index import FolderIndex, ROOT, normalize_virtual_path, ancestor_folders, parent_folder
+from app.core.search_index import SearchIndex
+from app.core.quota import StorageQuota, QuotaExceeded
+from app.core.cache import TTLCache
+from app.core.archive import ArchiveEntry, iter_zip
+from app.core.downloads import file_download_response
+from app.core.volumes import PRIMARY, storage_volumes
+from app.core.http_ranges import content_disposition
+from app.core.signed_urls import sign_token, verify_token, InvalidSignature
+from app.core.pagination import encode_cursor, decode_cursor, escape_like, postgrest_quote
+from app.core.upload_sessions import upload_sessions, UploadSession, ChunkError
+from app.core.chunk_store import ChunkStore, ChunkError as ChunkStoreError
+from app.core.deps import (
+    get_supabase,
+    get_current_user,
+    get_blob_store,
+    get_folder_index,
+    get_change_journal,
+    get_search_index,
+    get_storage_quota,
+    get_chunk_store,
+    get_optional_chunk_store,
+)
+from app.models.file import (
+    ArchiveRequest,
+    ChunkedCommitRequest,
+    ChunkParams,
+    ChunkRef,
+    FileChangesResponse,
+    FileCreate,
+    FileResponse,
+    FileUploadResponse,
+    FileUpdate,
+    FileVersionDetail,
+    FileVersionResponse,
+    FolderStats,
+    FolderResponse,
+    HashCheckRequest,
+    HashCheckResponse,
+    SearchResult,
+    SignedUrlResponse,
+    StorageUsageResponse,
+    UploadByHashRequest,
+    UploadSessionCreate,
+    UploadSessionResponse,
+)
 
 router = APIRouter()
 
+FILE_LIST_COLUMNS = "id,user_id,name,path,size,mime_type,storage_path,checksum,metadata,created_at,updated_at"
+SEARCH_INDEX_COLUMNS = "id,name,path,size,mime_type,tags,metadata,created_at,updated_at"
+
+# Record dei file letti di recente, per evitare un round trip a Supabase a ogni download.
+# La cache è per worker e si invalida solo nel worker che modifica il file: gli altri possono
+# servire un record superato per FILE_RECORD_CACHE_TTL secondi. Le modifiche leggono sempre
+# da Supabase e il download rilegge il record se il contenuto in cache non c'è più.
+file_record_cache = TTLCache(maxsize=settings.FILE_RECORD_CACHE_SIZE, ttl=settings.FILE_RECORD_CACHE_TTL)
+
+
+def _get_file_record(supabase: Client, file_id: str, user_id: str, cached: bool = True) -> dict:
+    """
+    Record del file dell'utente, dalla cache o da Supabase (404 se non esiste).
+    Con cached=False lo rilegge comunque da Supabase (e aggiorna la cache).
+    """
+    cache_key = (user_id, file_id)
+    file_record = file_record_cache.get(cache_key) if cached else None
+    if file_record is not None:
+        return file_record
+    
+    result = supabase.table("files").select("*").eq("id", file_id).eq("user_id", user_id).execute()
+    if not result.data:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File {file_id} not found"
+        )
+    
+    file_record = result.data[0]
+    file_record_cache.set(cache_key, file_record)
+    return file_record
+
+
+def _record_last_modified(file_record: dict) -> Optional[datetime]:
+    """Data di ultima modifica del record (timezone-aware), se disponibile"""
+    value = file_record.get("updated_at") or file_record.get("created_at")
+    if not value:
+        return None
+    try:
+        parsed = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _virtual_path(path: str) -> str:
+    """Normalizza un path virtuale fornito dal client (400 se non valido)"""
+    try:
+        return normalize_virtual_path(path)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid path: {str(e)}")
+
+
+def _quota_error(e: QuotaExceeded) -> HTTPException:
+    """413 con lo spazio usato e la quota, per mostrarli al client"""
+    return HTTPException(
+        status_code=413,
+        detail={
+            "message": "Storage quota exceeded",
+            "used_bytes": e.used_bytes,
+            "quota_bytes": e.quota_bytes,
+            "requested_bytes": e.requested_bytes,
+        }
+    )
+
+
+def _iter_user_files(supabase: Client, user_id: str, columns: str, prefix: Optional[str] = None) -> Iterator[dict]:
+    """Scorre tutti i file dell'utente (opzionalmente sotto `prefix`) a pagine keyset su path"""
+    last_path = None
+    while True:
+        query = supabase.table("files").select(columns).eq("user_id", user_id)
+        if prefix:
+            query = query.like("path", escape_like(prefix) + "%")
+        if last_path is not None:
+            query = query.gt("path", last_path)
+        rows = query.order("path").limit(settings.FILE_LIST_MAX_LIMIT).execute().data
+        yield from rows
+        if len(rows) < settings.FILE_LIST_MAX_LIMIT:
+            break
+        last_path = rows[-1]["path"]
+
+
+def _ensure_folder_index(supabase: Client, folder_index: FolderIndex, user_id: str):
+    """Costruisce l'indice delle cartelle dell'utente dal catalogo, se non esiste ancora"""
+    if folder_index.is_indexed(user_id):
+        return
+    
+    files = [(row["path"], row["size"]) for row in _iter_user_files(supabase, user_id, "path,size")]
+    folder_index.rebuild(user_id, files)
+
+
+def _ensure_search_index(supabase: Client, search_index: SearchIndex, user_id: str):
+    """Aggiorna l'indice di ricerca dell'utente dal journal, o lo ricostruisce dal catalogo"""
+    if search_index.catch_up(user_id):
+        return
+    
+    # La testa del journal va letta prima di scorrere il catalogo (vedi SearchIndex.rebuild)
+    seq = search_index.change_journal.head(user_id)
+    search_index.rebuild(user_id, seq, _iter_user_files(supabase, user_id, SEARCH_INDEX_COLUMNS))
+
+
+def _release_content(blob_store: BlobStore, file_record: dict):
+    """
+    Rilascia il contenuto di un file (bloccante, da eseguire nel pool di I/O).
+    Il blob viene eliminato solo se nessun altro file lo usa; i file salvati
+    prima del blob store vengono eliminati direttamente.
+    """
+    released = None
+    if file_record.get("checksum"):
+        released = blob_store.release(file_record["checksum"])
+    
+    storage_path = file_record.get("storage_path")
+    if released is None and storage_path and not blob_store.is_blob_path(storage_path) and os.path.exists(storage_path):
+        os.remove(storage_path)
+    
+    # Contenuto eliminato (o mai deduplicato): anche le sue miniature non servono più
+    if released is not False and file_record.get("checksum"):
+        shutil.rmtree(media_pipeline.cache_dir(file_record["checksum"]), ignore_errors=True)
+
+
+async def _content_path(blob_store: BlobStore, file_record: dict) -> str:
+    """Path fisico attuale del contenuto: un blob può essere stato spostato su un altro volume"""
+    return await run_io(blob_store.resolve, file_record.get("storage_path"), file_record.get("checksum"))
+
+
+def _store_media_metadata(supabase: Client, file_id: str, user_id: str, media: dict) -> Optional[dict]:
+    """
+    Salva nel campo `metadata` del file i dati prodotti dalla pipeline delle miniature.
+    Restituisce i metadata aggiornati, None se il file non esiste più.
+    """
+    result = supabase.table("files").select("metadata").eq("id", file_id).eq("user_id", user_id).execute()
+    if not result.data:
+        return None
+    metadata = dict(result.data[0].get("metadata") or {})
+    metadata["media"] = media
+    supabase.table("files").update({"metadata": metadata}).eq("id", file_id).eq("user_id", user_id).execute()
+    file_record_cache.invalidate((user_id, file_id))
+    return metadata
+
+
+async def on_media_processed(supabase: Client, search_index: Optional[SearchIndex], file_id: str, user_id: str,
+                             media: dict):
+    """Salva i metadata della pipeline e avvisa i client dell'utente che le miniature sono pronte"""
+    metadata = await run_in_threadpool(_store_media_metadata, supabase, file_id, user_id, media)
+    if metadata is None:
+        return  # File eliminato nel frattempo
+    if search_index is not None:
+        # I metadata (EXIF) non passano dal journal: l'indice di ricerca li riceve qui
+        await run_in_threadpool(search_index.set_metadata, user_id, file_id, metadata)
+    await _notify_user(user_id, {
+        "event": "thumbnail_ready",
+        "file_id": file_id,
+        "thumbnails": media.get("thumbnails", []),
+        "width": media.get("width"),
+        "height": media.get("height"),
+    })
+
+
+async def _notify_user(user_id: str, message: dict):
+    """Evento real-time alle connessioni WebSocket dell'utente (best effort)"""
+    try:
+        await ws_manager.send_to_user(user_id, message)
+    except Exception as e:
+        print(f"⚠️ Could not push {message.get('event')} to {user_id}: {e}")
+
+
+async def _record_change(change_journal: ChangeJournal, user_id: str, op: str, file_record: dict,
+                         old_path: Optional[str] = None):
+    """
+    Registra la modifica nel journal per la sincronizzazione dei client e la
+    notifica via WebSocket alle sessioni dell'utente. La modifica al catalogo
+    è già avvenuta: un errore qui viene solo loggato.
+    """
+    try:
+        change = change_journal.record(
+            user_id, op,
+            file_id=file_record["id"],
+            path=file_record["path"],
+            old_path=old_path,
+            size=file_record.get("size"),
+            checksum=file_record.get("checksum"),
+            mime_type=file_record.get("mime_type")
+        )
+    except Exception as e:
+        print(f"⚠️ Could not record {op} of {file_record['id']} in change journal: {e}")
+        return
+    
+    await _notify_user(user_id, {
+        "event": f"file_{op}",
+        "file_id": change["file_id"],
+        "name": os.path.basename(change["path"]),
+        "path": change["path"],
+        "old_path": change["old_path"],
+        "size": change["size"],
+        "mime_type": change["mime_type"],
+        "seq": change["seq"],
+        "cursor": encode_cursor({"seq": change["seq"]}),
+    })
+
+
+async def _register_file(
+    supabase: Client,
+    blob_store: BlobStore,
+    folder_index: FolderIndex,
+    change_journal: ChangeJournal,
+    storage_quota: StorageQuota,
+    user_id: str,
+    name: str,
+    path: str,
+    mime_type: Optional[str],
+    storage_path: str,
+    size: int,
+    checksum: str
+) -> FileUploadResponse:
+    """
+    Registra nel catalogo un file il cui blob è già stato referenziato.
+    Se l'inserimento fallisce il riferimento al blob viene rilasciato.
+    """
+    # Registra il file in Supabase
+    file_data = {
+        "user_id": user_id,
+        "name": name,
+        "path": path,
+        "size": size,
+        "mime_type": mime_type,
+        "storage_path": storage_path,
+        "checksum": checksum,
+        "created_at": datetime.utcnow().isoformat()
+    }
+    
+    print(f"📝 Registering in DB: {name}")
+    try:
+        result = supabase.table("files").insert(file_data).execute()
+    except Exception:
+        await run_io(blob_store.release, checksum)
+        raise
+    
+    if not result.data:
+        print("❌ DB Insert returned no data")
+        await run_io(blob_store.release, checksum)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to create file record in database"
+        )
+    
+    file_record = result.data[0]
+    await run_io(folder_index.add_file, user_id, path, size)
+    await run_io(storage_quota.apply, user_id, size, 1)
+    await _record_change(change_journal, user_id, "created", file_record)
+    media_pipeline.submit(str(file_record["id"]), user_id, checksum, storage_path, mime_type)
+    print(f"✅ Upload successful: {file_record['id']}")
+    return FileUploadResponse(
+        file_id=str(file_record["id"]),
+        name=name,
+        size=size,
+        url=f"/api/files/{file_record['id']}/download"
+    )
+
 
 @router.get("/", response_model=List[FileResponse])
 async def list_files(
+    limit: int = Query(settings.FILE_LIST_DEFAULT_LIMIT, ge=1, le=settings.FILE_LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    prefix: Optional[str] = None,
+    sort: str = Query("path", pattern="^(path|name|size|created_at)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
     current_user: dict = Depends(get_current_user),
     supabase: Client = Depends(get_supabase)
 ):
-    """Lista tutti i file dell'utente corrente"""
+    """
+    Lista i file dell'utente corrente, paginata con cursore (keyset su user_id, path).
+    `prefix` filtra per cartella virtuale (es: /Documents/).
+    Il cursore della pagina successiva è restituito nell'header X-Next-Cursor.
+    """
+    sort_key = f"{sort}:{order}"
+    position = None
+    if cursor:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        if position.get("s") != sort_key or "p" not in position or "k" not in position:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor does not match sort order")
+    
     try:
-        result = supabase.table("files").select("*").eq("user_id", current_user.id).execute()
-        return result.data
+        desc = order == "desc"
+        query = supabase.table("files").select(FILE_LIST_COLUMNS).eq("user_id", current_user.id)
+        
+        if prefix:
+            query = query.like("path", escape_like(prefix) + "%")
+        
+        # Riprende dopo l'ultimo elemento della pagina precedente; path fa da tie-breaker
+        if position:
+            op = "lt" if desc else "gt"
+            if sort == "path":
+                query = getattr(query, op)("path", position["p"])
+            else:
+                key, path = postgrest_quote(position["k"]), postgrest_quote(position["p"])
+                query = query.or_(f"{sort}.{op}.{key},and({sort}.eq.{key},path.{op}.{path})")
+        
+        query = query.order(sort, desc=desc)
+        if sort != "path":
+            query = query.order("path", desc=desc)
+        
+        rows = query.limit(limit + 1).execute().data
+        
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            headers["X-Next-Cursor"] = encode_cursor({"s": sort_key, "k": last[sort], "p": last["path"]})
+        
+        # I record arrivano già nella forma di FileResponse: evita la validazione riga per riga
+        return JSONResponse(content=rows, headers=headers)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -28,70 +388,878 @@ async def list_files(
         )
 
 
-@router.post("/upload", response_model=FileUploadResponse)
-async def upload_file(
-    file: UploadFile = File(...),
+@router.get("/changes", response_model=FileChangesResponse)
+async def list_changes(
+    since: Optional[str] = None,
+    limit: int = Query(settings.FILE_LIST_DEFAULT_LIMIT, ge=1, le=settings.FILE_LIST_MAX_LIMIT),
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    change_journal: ChangeJournal = Depends(get_change_journal)
 ):
-    """Upload di un file nel personal cloud"""
+    """
+    Modifiche ai file dopo il cursore `since`, in ordine di sequenza.
+    Senza `since` restituisce solo il cursore corrente: il client lo salva, scarica
+    la lista completa e da lì in poi chiede solo le modifiche. Con 410 il cursore
+    è scaduto e il client deve ripartire da una lista completa.
+    """
     try:
-        user_id = current_user.id
-        print(f"🚀 Receiving file upload: {file.filename} ({file.content_type}) from user {user_id}")
+        if since is None:
+            head = change_journal.head(current_user.id)
+            return FileChangesResponse(changes=[], cursor=encode_cursor({"seq": head}), has_more=False)
         
-        # Leggi il contenuto del file
-        contents = await file.read()
-        file_size = len(contents)
-        print(f"📊 File size: {file_size} bytes")
+        try:
+            since_seq = int(decode_cursor(since)["seq"])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
         
-        # Calcola checksum
-        checksum = hashlib.sha256(contents).hexdigest()
-        
-        # Salva il file localmente (simula cloud storage)
-        storage_dir = f"{settings.STORAGE_PATH}/{user_id}"
-        os.makedirs(storage_dir, exist_ok=True)
-        storage_path = f"{storage_dir}/{checksum}_{file.filename}"
+        try:
+            changes = change_journal.changes_since(current_user.id, since_seq, limit + 1)
+        except CursorExpired:
+            raise HTTPException(
+                status_code=status.HTTP_410_GONE,
+                detail="Cursor expired, full resync required"
+            )
         
-        print(f"💾 Saving to: {storage_path}")
-        with open(storage_path, "wb") as f:
-            f.write(contents)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        last_seq = changes[-1]["seq"] if changes else since_seq
+        return FileChangesResponse(
+            changes=changes,
+            cursor=encode_cursor({"seq": last_seq}),
+            has_more=has_more
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error fetching changes: {str(e)}"
+        )
+
+
+@router.get("/search", response_model=List[SearchResult])
+async def search_files(
+    q: str = Query(..., min_length=1, max_length=256),
+    limit: int = Query(settings.SEARCH_DEFAULT_LIMIT, ge=1, le=settings.FILE_LIST_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    prefix: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    search_index: SearchIndex = Depends(get_search_index)
+):
+    """
+    Cerca i file dell'utente per nome (anche con errori di battitura o parole parziali),
+    cartelle, tag e metadata, in ordine di rilevanza. `prefix` limita la ricerca a una
+    cartella virtuale. Il cursore della pagina successiva è nell'header X-Next-Cursor.
+    """
+    position = None
+    if cursor:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+        if position.get("q") != q or not {"score", "path", "file_id"} <= position.keys():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor does not match query")
+    
+    try:
+        await run_in_threadpool(_ensure_search_index, supabase, search_index, current_user.id)
+        rows = await run_in_threadpool(search_index.search, current_user.id, q, limit + 1, position, prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error searching files: {str(e)}"
+        )
+    
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor({"q": q, "score": last["score"], "path": last["path"], "file_id": last["file_id"]})
+    
+    results = [SearchResult(id=row["file_id"], **{k: v for k, v in row.items() if k != "file_id"}) for row in rows]
+    return JSONResponse(content=[result.model_dump(mode="json") for result in results], headers=headers)
+
+
+# Il corpo multipart viene letto dall'handler, dopo il controllo della quota:
+# lo schema del form va dichiarato a mano per la documentazione OpenAPI
+UPLOAD_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "path": {"type": "string"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+
+def _content_length(request: Request) -> Optional[int]:
+    try:
+        return int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+
+
+@router.post("/upload", response_model=FileUploadResponse, openapi_extra=UPLOAD_FORM_SCHEMA)
+async def upload_file(
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota)
+):
+    """
+    Upload di un file nel personal cloud (multipart: `file` e `path` opzionale, path virtuale di destinazione).
+    Se il Content-Length supera lo spazio rimasto risponde 413 prima di leggere il corpo.
+    """
+    user_id = current_user.id
+    try:
+        usage = await run_io(storage_quota.usage, user_id)
+        with storage_quota.reserve(user_id, _content_length(request), usage) as reservation:
+            async with request.form() as form:
+                file = form.get("file")
+                if file is None or isinstance(file, str):
+                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Missing file field")
+                path = form.get("path")
+                virtual_path = _virtual_path(path or os.path.basename(file.filename or "upload"))
+                print(f"🚀 Receiving file upload: {file.filename} ({file.content_type}) from user {user_id}")
+                
+                # Scrivi il file su disco a blocchi, calcolando size e checksum in un solo passaggio
+                filename = os.path.basename(virtual_path)
+                stored = await write_stream_to_temp(iter_upload_file(file))
+            file_size = stored.size
+            checksum = stored.checksum
+            print(f"📊 File size: {file_size} bytes")
+            
+            # Senza Content-Length la quota si può verificare solo a file ricevuto
+            try:
+                await run_io(reservation.extend_to, file_size)
+            except QuotaExceeded:
+                await run_io(discard_temp, stored.temp_path)
+                raise
+            
+            # Salva il contenuto nel blob store (deduplicato per checksum)
+            storage_path = await run_io(
+                blob_store.add_from_temp, stored.temp_path, checksum, file_size, file.content_type, filename
+            )
+            print(f"💾 Stored as blob: {storage_path}")
+            
+            return await _register_file(
+                supabase, blob_store, folder_index, change_journal, storage_quota, user_id,
+                name=filename,
+                path=virtual_path,
+                mime_type=file.content_type,
+                storage_path=storage_path,
+                size=file_size,
+                checksum=checksum
+            )
+
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Upload error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error uploading file: {str(e)}"
+        )
+
+
+@router.post("/upload/check", response_model=HashCheckResponse)
+async def check_hashes(
+    check: HashCheckRequest,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase)
+):
+    """
+    Pre-flight di sincronizzazione: indica quali checksum l'utente ha già nel cloud.
+    Per questi il client può usare /upload/by-hash invece di inviare i byte.
+    """
+    checksums = list({c.lower() for c in check.checksums})
+    try:
+        known = set()
+        batch_size = settings.FILE_LIST_MAX_LIMIT
+        for i in range(0, len(checksums), batch_size):
+            batch = checksums[i:i + batch_size]
+            result = supabase.table("files").select("checksum").eq("user_id", current_user.id).in_("checksum", batch).execute()
+            known.update(row["checksum"] for row in result.data)
+        return HashCheckResponse(
+            present=sorted(known),
+            missing=sorted(set(checksums) - known)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error checking hashes: {str(e)}"
+        )
+
+
+@router.post("/upload/by-hash", response_model=FileUploadResponse, status_code=status.HTTP_201_CREATED)
+async def upload_by_hash(
+    upload: UploadByHashRequest,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota)
+):
+    """
+    Crea il file nel catalogo a partire da checksum e size, senza trasferire il contenuto.
+    Risponde 404 se il server non ha quel contenuto: il client deve fare l'upload completo.
+    """
+    path = _virtual_path(upload.path or os.path.basename(upload.name))
+    checksum = upload.checksum.lower()
+    
+    try:
+        # Di default si deduplica solo su contenuti che l'utente possiede già:
+        # conoscere un hash non deve bastare per ottenere il file di un altro utente
+        if not settings.UPLOAD_BY_HASH_CROSS_USER:
+            owned = supabase.table("files").select("id").eq("user_id", current_user.id).eq("checksum", checksum).limit(1).execute()
+            if not owned.data:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Content not available, upload required"
+                )
         
-        # Registra il file in Supabase
-        file_data = {
-            "user_id": user_id,
-            "name": file.filename,
-            "path": f"/{file.filename}",
-            "size": file_size,
-            "mime_type": file.content_type,
+        # Il contenuto è deduplicato ma conta comunque nella quota, come ogni file del catalogo
+        usage = await run_io(storage_quota.usage, current_user.id)
+        with storage_quota.reserve(current_user.id, upload.size, usage):
+            storage_path = await run_io(blob_store.acquire, checksum, upload.size)
+            if storage_path is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Content not available, upload required"
+                )
+            print(f"⚡ Deduplicated upload by hash: {path} -> {checksum}")
+            
+            return await _register_file(
+                supabase, blob_store, folder_index, change_journal, storage_quota, current_user.id,
+                name=os.path.basename(path),
+                path=path,
+                mime_type=upload.mime_type,
+                storage_path=storage_path,
+                size=upload.size,
+                checksum=checksum
+            )
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error creating file by hash: {str(e)}"
+        )
+
+
+async def _replace_file_content(
+    supabase: Client,
+    blob_store: BlobStore,
+    folder_index: FolderIndex,
+    change_journal: ChangeJournal,
+    storage_quota: StorageQuota,
+    user_id: str,
+    file_record: dict,
+    storage_path: str,
+    size: int,
+    checksum: str,
+    mime_type: Optional[str] = None
+) -> FileUploadResponse:
+    """
+    Sostituisce il contenuto di un file esistente con un blob già referenziato.
+    Il blob precedente viene rilasciato; se l'aggiornamento fallisce si rilascia quello nuovo.
+    """
+    file_record = dict(file_record)  # Copia: serve il contenuto precedente anche dopo l'update
+    file_id = str(file_record["id"])
+    old_checksum = file_record.get("checksum")
+    old_size = file_record.get("size") or 0
+    
+    if old_checksum == checksum:
+        await run_io(blob_store.release, checksum)
+    else:
+        update = {
+            "size": size,
             "storage_path": storage_path,
             "checksum": checksum,
-            "created_at": datetime.utcnow().isoformat()
+            "updated_at": datetime.utcnow().isoformat()
         }
+        if mime_type:
+            update["mime_type"] = mime_type
+        if file_record.get("metadata"):
+            # I dati della pipeline si riferiscono al contenuto precedente
+            update["metadata"] = {k: v for k, v in file_record["metadata"].items() if k != "media"}
+        try:
+            result = supabase.table("files").update(update).eq("id", file_id).eq("user_id", user_id).execute()
+        except Exception:
+            await run_io(blob_store.release, checksum)
+            raise
+        if not result.data:
+            await run_io(blob_store.release, checksum)
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"File {file_id} not found"
+            )
         
-        print(f"📝 Registering in DB: {file.filename}")
-        result = supabase.table("files").insert(file_data).execute()
+        file_record_cache.invalidate((user_id, file_id))
+        await run_io(folder_index.remove_file, user_id, file_record["path"], old_size)
+        await run_io(folder_index.add_file, user_id, file_record["path"], size)
+        await run_io(storage_quota.apply, user_id, size - old_size, 0)
+        await _record_change(change_journal, user_id, "updated", result.data[0])
         
-        if result.data:
-            file_record = result.data[0]
-            print(f"✅ Upload successful: {file_record['id']}")
-            return FileUploadResponse(
-                file_id=str(file_record["id"]),
-                name=file.filename,
-                size=file_size,
-                url=f"/api/files/{file_record['id']}/download"
-            )
-        else:
-            print("❌ DB Insert returned no data")
+        await run_io(_release_content, blob_store, file_record)
+        media_pipeline.submit(file_id, user_id, checksum, storage_path, mime_type or file_record.get("mime_type"))
+        print(f"🔁 Content replaced: {file_id} ({old_size} -> {size} bytes)")
+    
+    return FileUploadResponse(
+        file_id=file_id,
+        name=file_record["name"],
+        size=size,
+        url=f"/api/files/{file_id}/download"
+    )
+
+
+def _get_upload_session(session_id: str, user_id: str) -> UploadSession:
+    """Carica una sessione di upload verificando che appartenga all'utente"""
+    session = upload_sessions.get(session_id)
+    if session is None or session.user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Upload session {session_id} not found"
+        )
+    return session
+
+
+def _session_response(session: UploadSession) -> UploadSessionResponse:
+    """Costruisce la risposta con lo stato dei chunk della sessione"""
+    received = upload_sessions.received_chunks(session)
+    received_set = set(received)
+    return UploadSessionResponse(
+        session_id=session.id,
+        name=session.name,
+        size=session.size,
+        chunk_size=session.chunk_size,
+        total_chunks=session.total_chunks,
+        received_chunks=received,
+        missing_chunks=[i for i in range(session.total_chunks) if i not in received_set]
+    )
+
+
+@router.post("/uploads", response_model=UploadSessionResponse, status_code=status.HTTP_201_CREATED)
+async def create_upload_session(
+    upload: UploadSessionCreate,
+    current_user: dict = Depends(get_current_user),
+    storage_quota: StorageQuota = Depends(get_storage_quota)
+):
+    """
+    Apre una sessione di upload a chunk.
+    I chunk si inviano con PUT /uploads/{session_id}/chunks/{index}, in qualsiasi ordine e in parallelo.
+    Risponde 413 se il file non ci sta nella quota, prima che il client invii i chunk.
+    """
+    path = _virtual_path(upload.path or os.path.basename(upload.name))
+    name = os.path.basename(path)
+    chunk_size = upload.chunk_size or settings.UPLOAD_SESSION_CHUNK_SIZE
+    if chunk_size > settings.UPLOAD_SESSION_MAX_CHUNK_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"chunk_size cannot exceed {settings.UPLOAD_SESSION_MAX_CHUNK_SIZE} bytes"
+        )
+    
+    try:
+        await run_io(storage_quota.check, current_user.id, upload.size)
+        session = await run_io(
+            upload_sessions.create,
+            user_id=current_user.id,
+            name=name,
+            path=path,
+            size=upload.size,
+            chunk_size=chunk_size,
+            mime_type=upload.mime_type,
+            checksum=upload.checksum
+        )
+        return _session_response(session)
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error creating upload session: {str(e)}"
+        )
+
+
+@router.get("/uploads/{session_id}", response_model=UploadSessionResponse)
+async def get_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stato della sessione: chunk ricevuti e mancanti (per riprendere un upload interrotto)"""
+    session = _get_upload_session(session_id, current_user.id)
+    return _session_response(session)
+
+
+@router.put("/uploads/{session_id}/chunks/{index}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Carica un singolo chunk (body raw). L'header opzionale X-Chunk-Sha256 ne verifica l'integrità."""
+    session = _get_upload_session(session_id, current_user.id)
+    try:
+        await upload_sessions.write_chunk(session, index, request.stream(), expected_sha256=x_chunk_sha256)
+        return None
+    except ChunkError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error writing chunk: {str(e)}"
+        )
+
+
+@router.post("/uploads/{session_id}/commit", response_model=FileUploadResponse)
+async def commit_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota)
+):
+    """
+    Completa la sessione: verifica il checksum finale e registra il file.
+    Se nel frattempo la quota si è esaurita risponde 413 e la sessione resta aperta.
+    Un commit concorrente sulla stessa sessione riceve 409.
+    """
+    session = _get_upload_session(session_id, current_user.id)
+    
+    missing = upload_sessions.missing_chunks(session)
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"message": "Upload incomplete", "missing_chunks": missing}
+        )
+    
+    if not await run_io(upload_sessions.begin_commit, session.id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is already being committed"
+        )
+    try:
+        # Un commit appena concluso può aver già eliminato la sessione
+        if await run_io(upload_sessions.get, session.id) is None:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to create file record in database"
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Upload session {session_id} not found"
             )
+        
+        usage = await run_io(storage_quota.usage, current_user.id)
+        with storage_quota.reserve(current_user.id, session.size, usage):
+            data_path, checksum = await upload_sessions.finalize(session)
+            if session.checksum and session.checksum != checksum:
+                await run_io(upload_sessions.discard, session.id)
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"Checksum mismatch: expected {session.checksum}, got {checksum}"
+                )
             
+            storage_path = await run_io(
+                blob_store.add_from_temp, data_path, checksum, session.size, session.mime_type, session.name
+            )
+            try:
+                response = await _register_file(
+                    supabase, blob_store, folder_index, change_journal, storage_quota, current_user.id,
+                    name=session.name,
+                    path=session.path,
+                    mime_type=session.mime_type,
+                    storage_path=storage_path,
+                    size=session.size,
+                    checksum=checksum
+                )
+            except BaseException:
+                # `data` è già diventato il blob (che _register_file rilascia se l'insert
+                # fallisce): la sessione non si può più completare
+                await run_io(upload_sessions.discard, session.id)
+                raise
+        await run_io(upload_sessions.discard, session.id)
+        return response
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Upload error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error uploading file: {str(e)}"
+            detail=f"Error committing upload: {str(e)}"
+        )
+    finally:
+        await run_io(upload_sessions.end_commit, session.id)
+
+
+@router.delete("/uploads/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload_session(
+    session_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Annulla una sessione di upload ed elimina i dati parziali"""
+    session = _get_upload_session(session_id, current_user.id)
+    if not await run_io(upload_sessions.discard_if_open, session.id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is being committed"
+        )
+    return None
+
+
+def _chunk_owner(user_id: str) -> Optional[str]:
+    """Utente a cui limitare la visibilità dei chunk (None se la deduplica è tra utenti)"""
+    return None if settings.UPLOAD_BY_HASH_CROSS_USER else user_id
+
+
+@router.get("/chunked/params", response_model=ChunkParams)
+async def get_chunk_params(
+    current_user: dict = Depends(get_current_user),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """Parametri CDC del server: i client devono tagliare i file con gli stessi valori"""
+    return ChunkParams(
+        algorithm="fastcdc-gear-sha256",
+        min_size=chunk_store.min_size,
+        avg_size=chunk_store.avg_size,
+        max_size=chunk_store.max_size
+    )
+
+
+@router.post("/chunked/check", response_model=HashCheckResponse)
+async def check_chunks(
+    check: HashCheckRequest,
+    current_user: dict = Depends(get_current_user),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """Indica quali chunk il server ha già: il client carica solo quelli mancanti"""
+    checksums = sorted({c.lower() for c in check.checksums})
+    try:
+        missing = chunk_store.missing(checksums, _chunk_owner(current_user.id))
+        return HashCheckResponse(
+            present=sorted(set(checksums) - set(missing)),
+            missing=missing
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error checking chunks: {str(e)}"
+        )
+
+
+@router.put("/chunked/chunks/{checksum}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk_by_checksum(
+    checksum: str,
+    request: Request,
+    current_user: dict = Depends(get_current_user),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """Carica un singolo chunk (corpo raw); il server verifica che lo SHA256 corrisponda"""
+    checksum = checksum.lower()
+    if len(checksum) != 64 or any(c not in "0123456789abcdef" for c in checksum):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid chunk checksum")
+    
+    try:
+        stored = await write_stream_to_temp(request.stream())
+        await run_io(chunk_store.put_chunk, current_user.id, stored, checksum)
+        return None
+    except ChunkStoreError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error storing chunk: {str(e)}"
+        )
+
+
+@router.post("/chunked/commit", response_model=FileUploadResponse)
+async def commit_chunked_file(
+    commit: ChunkedCommitRequest,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """
+    Crea o aggiorna il file al path indicato ricomponendolo dal manifest di chunk.
+    Se il file esiste già diventa una nuova versione (il contenuto precedente è tra le
+    versioni solo se il file era già versionato, vedi GET /{file_id}/versions). Risponde 409 con i chunk mancanti,
+    413 se la nuova dimensione non ci sta nella quota.
+    """
+    path = _virtual_path(commit.path)
+    manifest = [(chunk.checksum.lower(), chunk.size) for chunk in commit.chunks]
+    
+    missing = chunk_store.missing(sorted({c for c, _ in manifest}), _chunk_owner(current_user.id))
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"message": "Missing chunks", "missing_chunks": missing}
+        )
+    
+    try:
+        existing = supabase.table("files").select("*").eq("user_id", current_user.id).eq("path", path).execute()
+        file_record = existing.data[0] if existing.data else None
+        # La dimensione è nota dal manifest: la quota si verifica prima di ricomporre il file
+        old_size = (file_record.get("size") or 0) if file_record else 0
+        usage = await run_io(storage_quota.usage, current_user.id)
+        with storage_quota.reserve(current_user.id, sum(size for _, size in manifest) - old_size, usage):
+            stored = await run_io(chunk_store.assemble_to_temp, manifest)
+            storage_path = await run_io(
+                blob_store.add_from_temp, stored.temp_path, stored.checksum, stored.size,
+                commit.mime_type, posixpath.basename(path)
+            )
+            
+            if file_record:
+                # Prima di rilasciare il contenuto precedente (vedi ChunkStore.add_version)
+                await run_io(
+                    chunk_store.add_version, str(file_record["id"]), current_user.id, manifest, stored.size, stored.checksum
+                )
+                response = await _replace_file_content(
+                    supabase, blob_store, folder_index, change_journal, storage_quota, current_user.id, file_record,
+                    storage_path=storage_path,
+                    size=stored.size,
+                    checksum=stored.checksum,
+                    mime_type=commit.mime_type
+                )
+            else:
+                response = await _register_file(
+                    supabase, blob_store, folder_index, change_journal, storage_quota, current_user.id,
+                    name=os.path.basename(path),
+                    path=path,
+                    mime_type=commit.mime_type,
+                    storage_path=storage_path,
+                    size=stored.size,
+                    checksum=stored.checksum
+                )
+                await run_io(chunk_store.add_version, response.file_id, current_user.id, manifest, stored.size, stored.checksum)
+        
+        return response
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except HTTPException:
+        raise
+    except ChunkStoreError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error committing chunked file: {str(e)}"
+        )
+
+
+def _folder_stats(path: str, stats: Optional[dict]) -> FolderStats:
+    """Converte una riga dell'indice in FolderStats"""
+    return FolderStats(
+        path=path,
+        name=os.path.basename(path) or ROOT,
+        total_size=stats["total_size"] if stats else 0,
+        file_count=stats["file_count"] if stats else 0
+    )
+
+
+@router.get("/folders", response_model=FolderResponse)
+async def get_folder(
+    path: str = ROOT,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    folder_index: FolderIndex = Depends(get_folder_index)
+):
+    """Dimensioni aggregate di una cartella virtuale, sottocartelle dirette e breadcrumb"""
+    folder_path = ROOT if path.strip("/") == "" else _virtual_path(path)
+    try:
+        await run_in_threadpool(_ensure_folder_index, supabase, folder_index, current_user.id)
+        
+        # Antenati + cartella richiesta in un'unica query: O(profondità)
+        chain = ancestor_folders(folder_path) + [folder_path] if folder_path != ROOT else [ROOT]
+        stats = await run_in_threadpool(folder_index.get_folders, current_user.id, chain)
+        if folder_path not in stats:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Folder {folder_path} not found"
+            )
+        
+        children = await run_in_threadpool(folder_index.list_children, current_user.id, folder_path)
+        current = _folder_stats(folder_path, stats[folder_path])
+        return FolderResponse(
+            **current.model_dump(),
+            parent=parent_folder(folder_path),
+            breadcrumbs=[_folder_stats(p, stats.get(p)) for p in chain],
+            folders=[_folder_stats(child["path"], child) for child in children]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error fetching folder: {str(e)}"
+        )
+
+
+@router.get("/usage", response_model=StorageUsageResponse)
+async def get_storage_usage(
+    current_user: dict = Depends(get_current_user),
+    storage_quota: StorageQuota = Depends(get_storage_quota)
+):
+    """Spazio occupato e quota dell'utente (letti dai contatori, senza scorrere il catalogo)"""
+    try:
+        usage = await run_io(storage_quota.usage, current_user.id)
+        quota_bytes = usage["quota_bytes"]
+        return StorageUsageResponse(
+            **usage,
+            available_bytes=max(quota_bytes - usage["used_bytes"], 0) if quota_bytes is not None else None
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error fetching storage usage: {str(e)}"
+        )
+
+
+@router.post("/{file_id}/signed-url", response_model=SignedUrlResponse)
+async def create_signed_url(
+    file_id: str,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store)
+):
+    """Genera un link di download temporaneo, utilizzabile senza header di autenticazione"""
+    file_record = _get_file_record(supabase, file_id, current_user.id)
+    location = storage_volumes.relative_path(await _content_path(blob_store, file_record))
+    if location is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="File is not stored in the storage volume"
+        )
+    
+    # Il token contiene tutto il necessario per servire il file: nessuna query alla verifica
+    token = sign_token({
+        "u": current_user.id,
+        "v": location[0],
+        "p": location[1],
+        "n": file_record["name"],
+        "m": file_record.get("mime_type"),
+        "c": file_record.get("checksum")
+    }, ttl=settings.SIGNED_URL_TTL)
+    return SignedUrlResponse(
+        url=f"/api/files/signed/{token}",
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=settings.SIGNED_URL_TTL)
+    )
+
+
+@router.get("/signed/{token}")
+async def download_signed(
+    token: str,
+    request: Request,
+    blob_store: BlobStore = Depends(get_blob_store)
+):
+    """Download tramite link firmato: nessuna verifica su Supabase, solo HMAC e scadenza"""
+    try:
+        claims = verify_token(token)
+    except InvalidSignature as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    
+    volume = storage_volumes.get(claims.get("v", PRIMARY))
+    if volume is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Storage volume not available")
+    storage_path = await run_io(blob_store.resolve, os.path.join(volume.path, claims["p"]), claims.get("c"))
+    if not await run_io(os.path.exists, storage_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Physical file not found on server"
+        )
+    
+    return await run_io(
+        file_download_response,
+        request,
+        path=storage_path,
+        filename=claims["n"],
+        media_type=claims.get("m"),
+        checksum=claims.get("c")
+    )
+
+
+@router.post("/archive")
+async def download_archive(
+    archive_request: ArchiveRequest,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store)
+):
+    """
+    Scarica una cartella (`prefix`) o una selezione di file (`file_ids`) come archivio ZIP.
+    L'archivio viene generato in streaming: nessun file temporaneo, memoria costante.
+    """
+    if not archive_request.prefix and not archive_request.file_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Provide a folder prefix or a list of file_ids"
+        )
+    
+    try:
+        columns = "id,name,path,mime_type,storage_path,checksum,created_at,updated_at"
+        if archive_request.prefix:
+            folder = _virtual_path(archive_request.prefix)
+            # Iteratore pigro: il catalogo viene letto pagina per pagina mentre l'archivio è già in invio
+            records = _iter_user_files(supabase, current_user.id, columns, prefix=folder.rstrip("/") + "/")
+            first = next(records, None)
+            records = itertools.chain([first], records) if first else []
+            base = folder
+            default_name = os.path.basename(folder)
+        else:
+            records = supabase.table("files").select(columns).eq("user_id", current_user.id).in_("id", archive_request.file_ids).execute().data
+            base = ROOT
+            default_name = "files"
+        
+        if not records:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No files to archive")
+        
+        entries = (
+            ArchiveEntry(
+                arcname=posixpath.relpath(record["path"], base),
+                path=blob_store.resolve(record["storage_path"], record.get("checksum")),
+                mime_type=record.get("mime_type"),
+                modified=_record_last_modified(record)
+            )
+            for record in records
+        )
+        
+        archive_name = os.path.basename(archive_request.name or default_name)
+        if not archive_name.endswith(".zip"):
+            archive_name += ".zip"
+        
+        return StreamingResponse(
+            iter_zip(entries),
+            media_type="application/zip",
+            headers={"Content-Disposition": content_disposition(archive_name)}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error creating archive: {str(e)}"
         )
 
 
@@ -121,13 +1289,74 @@ async def get_file(
         )
 
 
+@router.patch("/{file_id}", response_model=FileResponse)
+async def update_file(
+    file_id: str,
+    file_update: FileUpdate,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal)
+):
+    """Rinomina o sposta un file (cambia solo il path virtuale, non il contenuto)"""
+    file_record = _get_file_record(supabase, file_id, current_user.id, cached=False)
+    old_path = file_record["path"]
+    
+    if file_update.path:
+        new_path = _virtual_path(file_update.path)
+    elif file_update.name:
+        new_path = _virtual_path(f"{parent_folder(old_path) or ROOT}/{os.path.basename(file_update.name)}")
+    else:
+        return file_record
+    
+    if new_path == old_path:
+        return file_record
+    
+    try:
+        existing = supabase.table("files").select("id").eq("user_id", current_user.id).eq("path", new_path).execute()
+        if existing.data:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"A file already exists at {new_path}"
+            )
+        
+        result = supabase.table("files").update({
+            "name": os.path.basename(new_path),
+            "path": new_path,
+            "updated_at": datetime.utcnow().isoformat()
+        }).eq("id", file_id).eq("user_id", current_user.id).execute()
+        
+        if not result.data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"File {file_id} not found"
+            )
+        
+        file_record_cache.invalidate((current_user.id, file_id))
+        await run_io(folder_index.move_file, current_user.id, old_path, new_path, file_record.get("size") or 0)
+        await _record_change(change_journal, current_user.id, "moved", result.data[0], old_path=old_path)
+        return result.data[0]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error updating file: {str(e)}"
+        )
+
+
 @router.delete("/{file_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_file(
     file_id: str,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota),
+    chunk_store: Optional[ChunkStore] = Depends(get_optional_chunk_store)
 ):
-    """Elimina un file"""
+    """Elimina un file (e le sue versioni, se il chunk store è attivo)"""
     try:
         # Ottieni informazioni sul file per eliminare il file fisico
         result = supabase.table("files").select("*").eq("id", file_id).eq("user_id", current_user.id).execute()
@@ -140,12 +1369,17 @@ async def delete_file(
         
         file_record = result.data[0]
         
-        # Elimina il file fisico
-        if os.path.exists(file_record["storage_path"]):
-            os.remove(file_record["storage_path"])
-        
         # Elimina il record dal database
         supabase.table("files").delete().eq("id", file_id).execute()
+        file_record_cache.invalidate((current_user.id, file_id))
+        await run_io(folder_index.remove_file, current_user.id, file_record["path"], file_record.get("size") or 0)
+        await run_io(storage_quota.apply, current_user.id, -(file_record.get("size") or 0), -1)
+        await _record_change(change_journal, current_user.id, "deleted", file_record)
+        if chunk_store is not None:
+            await run_io(chunk_store.delete_versions, file_id)
+        
+        # Rilascia il blob: il file fisico viene eliminato solo se nessun altro file lo usa
+        await run_io(_release_content, blob_store, file_record)
         
         return None
     except HTTPException:
@@ -155,36 +1389,44 @@ async def delete_file(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error deleting file: {str(e)}"
         )
+
+
 @router.get("/{file_id}/download")
 async def download_file(
     file_id: str,
+    request: Request,
     current_user: dict = Depends(get_current_user),
-    supabase: Client = Depends(get_supabase)
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store)
 ):
-    """Download di un file"""
+    """
+    Download di un file.
+    Supporta Range (206, anche multi-range), ETag basato sul checksum e GET condizionali (304).
+    Con DOWNLOAD_OFFLOAD attivo i byte vengono serviti dal reverse proxy.
+    """
     try:
-        result = supabase.table("files").select("*").eq("id", file_id).eq("user_id", current_user.id).execute()
-        
-        if not result.data:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"File {file_id} not found"
-            )
+        file_record = _get_file_record(supabase, file_id, current_user.id)
+        storage_path = await _content_path(blob_store, file_record)
         
-        file_record = result.data[0]
-        storage_path = file_record["storage_path"]
-        
-        if not os.path.exists(storage_path):
+        if not await run_io(os.path.exists, storage_path):
+            # Il record in cache può essere superato (file sostituito da un altro worker)
+            file_record = _get_file_record(supabase, file_id, current_user.id, cached=False)
+            storage_path = await _content_path(blob_store, file_record)
+        if not await run_io(os.path.exists, storage_path):
+            file_record_cache.invalidate((current_user.id, file_id))
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Physical file not found on server"
             )
-            
-        from fastapi.responses import FileResponse as FastFileResponse
-        return FastFileResponse(
+        
+        return await run_io(
+            file_download_response,
+            request,
             path=storage_path,
             filename=file_record["name"],
-            media_type=file_record.get("mime_type")
+            media_type=file_record.get("mime_type"),
+            checksum=file_record.get("checksum"),
+            last_modified=_record_last_modified(file_record)
         )
     except HTTPException:
         raise
@@ -193,3 +1435,157 @@ async def download_file(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error downloading file: {str(e)}"
         )
+
+
+@router.get("/{file_id}/thumbnail")
+async def get_thumbnail(
+    file_id: str,
+    request: Request,
+    size: Optional[int] = Query(None, ge=1),
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    search_index: SearchIndex = Depends(get_search_index)
+):
+    """
+    Miniatura JPEG di un'immagine, con lato massimo `size` arrotondato alla taglia
+    disponibile più vicina. Se non è ancora pronta viene generata subito.
+    """
+    file_record = _get_file_record(supabase, file_id, current_user.id)
+    checksum = file_record.get("checksum")
+    if not checksum or not is_supported_media(file_record.get("mime_type")):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No thumbnail available for this file type"
+        )
+    
+    thumbnail_size = media_pipeline.pick_size(size)
+    thumbnail_path = media_pipeline.thumbnail_path(checksum, thumbnail_size)
+    try:
+        if not await run_io(os.path.exists, thumbnail_path):
+            if not media_pipeline.enabled:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Thumbnails are not enabled on this server"
+                )
+            media = await media_pipeline.process(checksum, await _content_path(blob_store, file_record))
+            await on_media_processed(supabase, search_index, file_id, current_user.id, media)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Cannot generate thumbnail: {str(e)}"
+        )
+    
+    return await run_io(
+        file_download_response,
+        request,
+        path=thumbnail_path,
+        filename=f"{os.path.splitext(file_record['name'])[0]}_{thumbnail_size}.jpg",
+        media_type=THUMBNAIL_MEDIA_TYPE,
+        checksum=f"{checksum}-{thumbnail_size}",
+        last_modified=_record_last_modified(file_record)
+    )
+
+
+@router.get("/{file_id}/versions", response_model=List[FileVersionResponse])
+async def list_file_versions(
+    file_id: str,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """
+    Versioni del file, dalla più recente. Se il file non ne ha ancora, la divisione in chunk
+    del contenuto attuale come versione 1 viene avviata in background e la lista è vuota
+    finché non è pronta.
+    """
+    file_record = _get_file_record(supabase, file_id, current_user.id)
+    try:
+        versions = await run_io(chunk_store.list_versions, file_id)
+        if not versions and file_record.get("checksum"):
+            chunk_store.request_versioning(file_id, current_user.id, file_record["checksum"], file_record.get("size") or 0)
+        return versions
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error listing versions: {str(e)}"
+        )
+
+
+@router.get("/{file_id}/versions/{version}", response_model=FileVersionDetail)
+async def get_file_version(
+    file_id: str,
+    version: int,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """
+    Versione con il suo manifest di chunk.
+    Il client confronta il manifest con i chunk locali: per scaricare solo le differenze
+    usa richieste Range su /download (gli offset si ricavano sommando le size).
+    """
+    _get_file_record(supabase, file_id, current_user.id)
+    file_version = chunk_store.get_version(file_id, version)
+    if file_version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Version {version} of file {file_id} not found"
+        )
+    
+    manifest = file_version.pop("manifest")
+    return FileVersionDetail(
+        **file_version,
+        chunks=[ChunkRef(checksum=checksum, size=size) for checksum, size in manifest]
+    )
+
+
+@router.post("/{file_id}/versions/{version}/restore", response_model=FileUploadResponse)
+async def restore_file_version(
+    file_id: str,
+    version: int,
+    current_user: dict = Depends(get_current_user),
+    supabase: Client = Depends(get_supabase),
+    blob_store: BlobStore = Depends(get_blob_store),
+    folder_index: FolderIndex = Depends(get_folder_index),
+    change_journal: ChangeJournal = Depends(get_change_journal),
+    storage_quota: StorageQuota = Depends(get_storage_quota),
+    chunk_store: ChunkStore = Depends(get_chunk_store)
+):
+    """Ripristina una versione precedente: il suo contenuto diventa una nuova versione"""
+    file_record = _get_file_record(supabase, file_id, current_user.id, cached=False)
+    file_version = chunk_store.get_version(file_id, version)
+    if file_version is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Version {version} of file {file_id} not found"
+        )
+    
+    try:
+        manifest = file_version["manifest"]
+        usage = await run_io(storage_quota.usage, current_user.id)
+        with storage_quota.reserve(current_user.id, file_version["size"] - (file_record.get("size") or 0), usage):
+            stored = await run_io(chunk_store.assemble_to_temp, manifest)
+            storage_path = await run_io(
+                blob_store.add_from_temp, stored.temp_path, stored.checksum, stored.size,
+                file_record.get("mime_type"), file_record["name"]
+            )
+            await run_io(chunk_store.add_version, file_id, current_user.id, manifest, stored.size, stored.checksum)
+            response = await _replace_file_content(
+                supabase, blob_store, folder_index, change_journal, storage_quota, current_user.id, file_record,
+                storage_path=storage_path,
+                size=stored.size,
+                checksum=stored.checksum
+            )
+        return response
+    except QuotaExceeded as e:
+        raise _quota_error(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error restoring version: {str(e)}"
+        )
@@ -3,7 +3,9 @@ from sqlalchemy import text
 from supabase import Client
 from redis import Redis
 
-from app.core.deps import get_supabase, get_local_db, get_redis
+from app.core.deps import get_supabase, get_local_db, get_redis, get_storage_scrubber
+from app.core.io_pool import run_io
+from app.core.scrubber import StorageScrubber
 
 router = APIRouter()
 
@@ -103,3 +105,14 @@ async def detailed_healthcheck(
         raise HTTPException(status_code=503, detail=health_status)
     
     return health_status
+
+
+@router.get("/health/storage")
+async def storage_healthcheck(scrubber: StorageScrubber = Depends(get_storage_scrubber)):
+    """Avanzamento dello scrubber dello storage e contenuti corrotti o mancanti"""
+    try:
+        report = await run_io(scrubber.report)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not read scrubber state: {str(e)}")
+    report["status"] = "degraded" if report["issues"] else "healthy"
+    return report
@@ -1,5 +1,7 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, status
+from fastapi.concurrency import run_in_threadpool
 from app.core.ws_manager import manager as ws_manager
+from app.core import deps
 from typing import Optional
 import logging
 
@@ -7,6 +9,16 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+
+def _resolve_user_id(token: str) -> Optional[str]:
+    """Id dell'utente del token Supabase, None se non valido"""
+    try:
+        response = deps.supabase_client.auth.get_user(token)
+        return response.user.id if response else None
+    except Exception as e:
+        logger.warning(f"WebSocket token not valid for file events: {e}")
+        return None
+
 @router.websocket("/devices")
 async def websocket_device_feed(
     websocket: WebSocket,
@@ -14,15 +26,18 @@ async def websocket_device_feed(
 ):
     """
     WebSocket endpoint for real-time device updates.
+    Con un token valido riceve anche gli eventi sui file dell'utente
+    (file_created, file_updated, file_moved, file_deleted, thumbnail_ready).
     """
     if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    # In un caso reale, qui valideresti il token JWT tramite Supabase
-    # Per semplicità lo accettiamo se presente, o simula validazione
+    # Gli eventi sui file sono privati: servono solo se il token identifica un utente.
+    # Con un token non valido la connessione riceve comunque gli eventi dei dispositivi.
+    user_id = await run_in_threadpool(_resolve_user_id, token)
     
-    await ws_manager.connect(websocket)
+    await ws_manager.connect(websocket, user_id=user_id)
     try:
         while True:
             # Heartbeat from client
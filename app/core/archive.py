@@ -0,0 +1,77 @@
+"""Archivi ZIP generati in streaming, senza file temporanei"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+import logging
+import zipfile
+
+from app.core.codecs import open_content
+from app.core.config import settings
+from app.core.media_types import is_compressed_mime
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ArchiveEntry:
+    """File da includere nell'archivio"""
+    arcname: str
+    path: str
+    mime_type: Optional[str] = None
+    modified: Optional[datetime] = None
+
+
+class _ChunkBuffer:
+    """
+    Stream di sola scrittura e non seekable: zipfile usa quindi i data descriptor
+    e non torna mai indietro. I byte scritti vengono raccolti e svuotati dal generatore.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> Iterator[bytes]:
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+
+def _zip_date_time(modified: Optional[datetime]) -> tuple:
+    if modified is None or modified.year < 1980:
+        modified = datetime(1980, 1, 1)
+    return modified.timetuple()[:6]
+
+
+def iter_zip(entries: Iterable[ArchiveEntry]) -> Iterator[bytes]:
+    """
+    Genera un archivio ZIP64 man mano che viene letto: la memoria usata è
+    limitata a un blocco di lettura più la central directory.
+    I contenuti già compressi vengono salvati senza deflate.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", allowZip64=True) as archive:
+        for entry in entries:
+            info = zipfile.ZipInfo(entry.arcname, date_time=_zip_date_time(entry.modified))
+            info.compress_type = zipfile.ZIP_STORED if is_compressed_mime(entry.mime_type) else zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            try:
+                with open_content(entry.path) as src, archive.open(info, "w", force_zip64=True) as dest:
+                    while True:
+                        data = src.read(settings.DOWNLOAD_CHUNK_SIZE)
+                        if not data:
+                            break
+                        dest.write(data)
+                        yield from buffer.drain()
+            except FileNotFoundError:
+                logger.warning(f"Skipping missing file in archive: {entry.path}")
+            yield from buffer.drain()
+    yield from buffer.drain()
@@ -0,0 +1,327 @@
+"""Storage content-addressed con deduplicazione e reference counting"""
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from app.core.codecs import BLOB_SUFFIXES, MIN_SAVING, Codec, codec_for, codec_for_path, split_suffix
+from app.core.config import settings
+from app.core.storage import commit_temp, discard_temp, make_temp
+from app.core.volumes import PRIMARY, StorageVolume, VolumeRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    Ogni contenuto è salvato una sola volta, indicizzato dal suo SHA-256,
+    in directory a fan-out ({volume}/blobs/ab/cd/abcd...).
+    La tabella `blobs` del DB locale tiene il numero di file che puntano
+    a ciascun blob: il file fisico viene eliminato solo a refcount zero.
+    Con più volumi il blob sta sul primo volume con spazio nell'ordine di
+    preferenza del suo checksum (vedi VolumeRegistry).
+    I contenuti comprimibili possono essere salvati compressi (<sha256>.zst, vedi
+    codecs): il checksum resta quello del contenuto originale.
+
+    `on_remove(checksum, path, codec)` viene chiamata, fuori dal lock, prima che il file di
+    un blob eliminato sparisca: `path` è una copia messa da parte nei temporanei del
+    volume, ancora leggibile (il chunk store ne ricava i chunk che vi leggeva).
+    """
+
+    def __init__(self, storage_root: str, engine: Engine, volumes: Optional[VolumeRegistry] = None):
+        self.volumes = volumes or VolumeRegistry([StorageVolume(PRIMARY, storage_root)])
+        self.root = self.volumes.primary.blobs_root
+        self.engine = engine
+        # Serializza incref/decref e operazioni su disco dello stesso processo
+        self._lock = threading.Lock()
+        self.on_remove: Optional[Callable[[str, str, Optional[Codec]], None]] = None
+
+    def blob_path(self, checksum: str, volume: Optional[StorageVolume] = None, codec: Optional[Codec] = None) -> str:
+        """Path fisico del blob sul volume indicato (default il preferito), con fan-out a due livelli"""
+        volume = volume or self.volumes.ranked(checksum)[0]
+        path = os.path.join(volume.blobs_root, checksum[:2], checksum[2:4], checksum)
+        return path + codec.suffix if codec is not None else path
+
+    def _candidates(self, checksum: str) -> List[str]:
+        """Path in cui il blob può trovarsi: volumi in ordine di preferenza, ciascuno con i suffissi dei codec"""
+        return [
+            self.blob_path(checksum, volume) + suffix
+            for volume in self.volumes.ranked(checksum)
+            for suffix in BLOB_SUFFIXES
+        ]
+
+    def locate(self, checksum: str) -> Optional[str]:
+        """
+        Path del blob se presente su disco. I volumi si provano in ordine di preferenza:
+        di norma il primo è quello giusto e bastano una o due stat.
+        """
+        for path in self._candidates(checksum):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def resolve(self, storage_path: str, checksum: Optional[str]) -> str:
+        """Path attuale del contenuto di un file: un blob può essere stato spostato su un altro volume"""
+        if checksum and storage_path and self.is_blob_path(storage_path):
+            return self.locate(checksum) or storage_path
+        return storage_path
+
+    def is_blob_path(self, path: str) -> bool:
+        """True se il path appartiene al blob store (su qualunque volume)"""
+        path = os.path.abspath(path)
+        return any(path.startswith(os.path.abspath(v.blobs_root) + os.sep) for v in self.volumes.volumes)
+
+    def _to_volume(self, temp_path: str, volume: StorageVolume) -> str:
+        """Porta un file temporaneo sul filesystem del volume (copia se è su un altro disco)"""
+        if self.volumes.same_filesystem(temp_path, volume):
+            return temp_path
+        os.makedirs(volume.temp_dir, exist_ok=True)
+        fd, volume_temp = make_temp(volume.temp_dir, "blob_")
+        try:
+            with open(temp_path, "rb") as src, os.fdopen(fd, "wb") as dest:
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+                dest.flush()
+                os.fsync(dest.fileno())
+        except BaseException:
+            discard_temp(volume_temp)
+            raise
+        discard_temp(temp_path)
+        return volume_temp
+
+    def _commit(self, temp_path: str, path: str):
+        try:
+            commit_temp(temp_path, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            volume = self.volumes.volume_of(path)
+            commit_temp(self._to_volume(temp_path, volume), path)
+
+    def _encode(self, temp_path: str, size: int, volume: StorageVolume, codec: Codec) -> Tuple[str, Optional[Codec]]:
+        """
+        Comprime il file temporaneo direttamente nei temporanei del volume di destinazione.
+        Restituisce (file da salvare, codec); se il risparmio è troppo piccolo il
+        compresso viene scartato e si salva l'originale.
+        """
+        os.makedirs(volume.temp_dir, exist_ok=True)
+        fd, encoded_path = make_temp(volume.temp_dir, "blob_")
+        os.close(fd)
+        try:
+            codec.compress_file(temp_path, encoded_path, settings.STORAGE_COMPRESSION_LEVEL)
+        except BaseException:
+            discard_temp(encoded_path)
+            raise
+        encoded_size = os.path.getsize(encoded_path)
+        if encoded_size > size * (1 - MIN_SAVING):
+            discard_temp(encoded_path)
+            return temp_path, None
+        discard_temp(temp_path)
+        logger.debug(f"Blob compressed with {codec.name}: {size} -> {encoded_size} bytes")
+        return encoded_path, codec
+
+    def add_from_temp(self, temp_path: str, checksum: str, size: int,
+                      mime_type: Optional[str] = None, name: Optional[str] = None) -> str:
+        """
+        Aggiunge un riferimento al blob `checksum`.
+        Se il contenuto è nuovo il file temporaneo viene spostato in posizione (compresso
+        se il mime type lo prevede), altrimenti viene scartato. Restituisce il path del blob.
+        """
+        path = None  # Destinazione del temp, una volta compresso e portato sul volume
+        while True:
+            if path is None and self.locate(checksum) is None:
+                # Compressione e copia verso un altro disco avvengono fuori dal lock
+                volume = self.volumes.choose(checksum, size)
+                codec = codec_for(mime_type, size, name)
+                if codec is not None:
+                    temp_path, codec = self._encode(temp_path, size, volume, codec)
+                path = self.blob_path(checksum, volume, codec)
+                temp_path = self._to_volume(temp_path, volume)
+
+            with self._lock:
+                existing = self.locate(checksum)
+                if existing is None and path is None:
+                    # Un release() concorrente ha eliminato il blob dopo il controllo:
+                    # il temp va preparato come per un contenuto nuovo
+                    continue
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        text(
+                            "INSERT INTO blobs (checksum, size, refcount, created_at) "
+                            "VALUES (:checksum, :size, 1, :now) "
+                            "ON CONFLICT (checksum) DO UPDATE SET refcount = blobs.refcount + 1"
+                        ),
+                        {"checksum": checksum, "size": size, "now": datetime.now(timezone.utc)},
+                    )
+                    if existing is not None:
+                        discard_temp(temp_path)
+                        return existing
+                    self._commit(temp_path, path)
+                return path
+
+    def add_references(self, entries: List[Tuple[str, int]]):
+        """
+        Aggiunge in una sola transazione un riferimento per ogni (checksum, size),
+        anche per blob non ancora presenti su disco: il chiamante li mette in
+        posizione subito dopo (import in blocco). Incrementare prima di spostare
+        il file evita che un release() concorrente elimini un blob appena riusato.
+        """
+        if not entries:
+            return
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT INTO blobs (checksum, size, refcount, created_at) "
+                        "VALUES (:checksum, :size, 1, :now) "
+                        "ON CONFLICT (checksum) DO UPDATE SET refcount = blobs.refcount + 1"
+                    ),
+                    [{"checksum": checksum, "size": size, "now": now} for checksum, size in entries],
+                )
+
+    def acquire(self, checksum: str, size: int) -> Optional[str]:
+        """
+        Aggiunge un riferimento a un blob già presente, senza trasferire byte.
+        Restituisce il path del blob, None se il contenuto non è disponibile.
+        """
+        with self._lock:
+            path = self.locate(checksum)
+            if path is None:
+                return None
+            with self.engine.begin() as conn:
+                result = conn.execute(
+                    text(
+                        "UPDATE blobs SET refcount = refcount + 1 "
+                        "WHERE checksum = :checksum AND size = :size AND refcount > 0"
+                    ),
+                    {"checksum": checksum, "size": size},
+                )
+                if result.rowcount == 0:
+                    return None
+        return path
+
+    def release(self, checksum: str) -> Optional[bool]:
+        """
+        Rimuove un riferimento al blob.
+        Restituisce True se il blob è stato eliminato, False se è ancora
+        referenziato, None se il checksum non è gestito dal blob store.
+        """
+        with self._lock:
+            with self.engine.begin() as conn:
+                row = conn.execute(
+                    text("SELECT refcount FROM blobs WHERE checksum = :checksum"),
+                    {"checksum": checksum},
+                ).first()
+                if row is None:
+                    return None
+
+                if row.refcount > 1:
+                    conn.execute(
+                        text("UPDATE blobs SET refcount = refcount - 1 WHERE checksum = :checksum"),
+                        {"checksum": checksum},
+                    )
+                    return False
+
+                conn.execute(text("DELETE FROM blobs WHERE checksum = :checksum"), {"checksum": checksum})
+                kept = self._remove_copies(checksum)
+                logger.info(f"Blob {checksum} removed (no references left)")
+        self._notify_removed(checksum, kept)
+        return True
+
+    def set_refcount(self, checksum: str, expected: int, refcount: int) -> bool:
+        """
+        Corregge il refcount di un blob solo se vale ancora `expected` (usato dallo scrubber
+        per riallinearlo al catalogo). A zero il blob viene eliminato. True se applicato.
+        """
+        with self._lock:
+            with self.engine.begin() as conn:
+                if refcount > 0:
+                    result = conn.execute(
+                        text("UPDATE blobs SET refcount = :refcount WHERE checksum = :checksum AND refcount = :expected"),
+                        {"checksum": checksum, "expected": expected, "refcount": refcount},
+                    )
+                    return result.rowcount > 0
+
+                result = conn.execute(
+                    text("DELETE FROM blobs WHERE checksum = :checksum AND refcount = :expected"),
+                    {"checksum": checksum, "expected": expected},
+                )
+                if result.rowcount == 0:
+                    return False
+                kept = self._remove_copies(checksum)
+                logger.info(f"Blob {checksum} removed (not referenced by the catalog)")
+        self._notify_removed(checksum, kept)
+        return True
+
+    def _remove_copies(self, checksum: str) -> Optional[Tuple[str, Optional[Codec]]]:
+        """
+        Elimina il blob da tutti i volumi. Con on_remove la prima copia viene messa da parte:
+        restituisce (path della copia, codec) per _notify_removed()
+        """
+        kept = None
+        for path in self._candidates(checksum):
+            if not os.path.exists(path):
+                continue
+            if kept is None and self.on_remove is not None:
+                volume = self.volumes.volume_of(path) or self.volumes.primary
+                os.makedirs(volume.temp_dir, exist_ok=True)
+                kept = (os.path.join(volume.temp_dir, "removed_" + os.path.basename(path)), codec_for_path(path))
+                os.replace(path, kept[0])
+            else:
+                os.remove(path)
+        return kept
+
+    def _notify_removed(self, checksum: str, kept: Optional[Tuple[str, Optional[Codec]]]):
+        if kept is None:
+            return
+        path, codec = kept
+        try:
+            self.on_remove(checksum, path, codec)
+        except Exception as e:
+            logger.error(f"❌ Cleanup hook failed for removed blob {checksum}: {e}")
+        finally:
+            discard_temp(path)
+
+    def remove_stray(self, path: str) -> bool:
+        """
+        Elimina un file del fan-out che non serve: blob senza riga in `blobs` (residuo di
+        un crash) o copia su un volume diverso da quello da cui il blob viene letto
+        (spostamento interrotto). True se il file è stato eliminato.
+        """
+        checksum, _ = split_suffix(os.path.basename(path))
+        with self._lock:
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    text("SELECT 1 FROM blobs WHERE checksum = :checksum"), {"checksum": checksum}
+                ).first()
+            if row is not None and self.locate(checksum) == path:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def commit_move(self, checksum: str, temp_path: str, source_path: str, volume: StorageVolume) -> bool:
+        """
+        Completa lo spostamento di un blob già copiato (e verificato) in `temp_path` sul
+        volume di destinazione. Non fa nulla se nel frattempo il blob è stato eliminato.
+        Tra il rename e la rimozione della sorgente il blob esiste su entrambi i volumi:
+        un lettore lo trova comunque, e chi aveva già aperto la sorgente continua a leggerla.
+        """
+        with self._lock:
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    text("SELECT 1 FROM blobs WHERE checksum = :checksum"), {"checksum": checksum}
+                ).first()
+            if row is None or not os.path.exists(source_path):
+                discard_temp(temp_path)
+                return False
+            commit_temp(temp_path, self.blob_path(checksum, volume, codec_for_path(source_path)))
+            os.remove(source_path)
+        return True
@@ -0,0 +1,167 @@
+"""Journal delle modifiche al catalogo dei file, per la sincronizzazione incrementale dei client"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import logging
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("created", "updated", "moved", "deleted")
+
+# Ogni quante modifiche di un utente si eliminano le sue voci oltre la retention
+PRUNE_EVERY = 500
+
+
+class CursorExpired(Exception):
+    """Il cursore è più vecchio della retention del journal (o di un altro database)"""
+
+
+class ChangeJournal:
+    """
+    Ogni modifica riceve una sequenza per utente, assegnata incrementando la riga
+    dell'utente in `file_change_heads` nella stessa transazione dell'inserimento.
+    Il lock su quella riga serializza le modifiche dello stesso utente: una sequenza
+    più alta non diventa mai visibile prima di una più bassa, quindi un client che
+    legge "dopo N" non salta modifiche ancora in corso di commit.
+    """
+
+    def __init__(self, engine: Engine, retention_days: int):
+        self.engine = engine
+        self.retention = timedelta(days=retention_days)
+
+    def record(self, user_id: str, op: str, file_id: str, path: str, old_path: Optional[str] = None,
+               size: Optional[int] = None, checksum: Optional[str] = None,
+               mime_type: Optional[str] = None) -> Dict:
+        """Registra una modifica e la restituisce con la sua sequenza"""
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown change operation: {op}")
+
+        change = {
+            "user_id": user_id,
+            "op": op,
+            "file_id": str(file_id),
+            "path": path,
+            "old_path": old_path,
+            "size": size,
+            "checksum": checksum,
+            "mime_type": mime_type,
+            "created_at": datetime.now(timezone.utc),
+        }
+        with self.engine.begin() as conn:
+            change["seq"] = conn.execute(
+                text(
+                    "INSERT INTO file_change_heads (user_id, seq, pruned_seq) VALUES (:user_id, 1, 0) "
+                    "ON CONFLICT (user_id) DO UPDATE SET seq = file_change_heads.seq + 1 "
+                    "RETURNING seq"
+                ),
+                {"user_id": user_id},
+            ).scalar_one()
+            conn.execute(
+                text(
+                    "INSERT INTO file_changes "
+                    "(user_id, seq, op, file_id, path, old_path, size, checksum, mime_type, created_at) "
+                    "VALUES (:user_id, :seq, :op, :file_id, :path, :old_path, :size, :checksum, :mime_type, :created_at)"
+                ),
+                change,
+            )
+            if change["seq"] % PRUNE_EVERY == 0:
+                self._prune(conn, user_id)
+        return change
+
+    def record_many(self, user_id: str, op: str, changes: List[Dict]) -> int:
+        """
+        Registra molte modifiche con un solo incremento della sequenza (import in blocco).
+        Ogni elemento ha le chiavi file_id, path e opzionalmente size, checksum, mime_type.
+        Restituisce l'ultima sequenza assegnata.
+        """
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown change operation: {op}")
+        if not changes:
+            return self.head(user_id)
+
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as conn:
+            last_seq = conn.execute(
+                text(
+                    "INSERT INTO file_change_heads (user_id, seq, pruned_seq) VALUES (:user_id, :count, 0) "
+                    "ON CONFLICT (user_id) DO UPDATE SET seq = file_change_heads.seq + :count "
+                    "RETURNING seq"
+                ),
+                {"user_id": user_id, "count": len(changes)},
+            ).scalar_one()
+            first_seq = last_seq - len(changes) + 1
+            conn.execute(
+                text(
+                    "INSERT INTO file_changes "
+                    "(user_id, seq, op, file_id, path, old_path, size, checksum, mime_type, created_at) "
+                    "VALUES (:user_id, :seq, :op, :file_id, :path, NULL, :size, :checksum, :mime_type, :created_at)"
+                ),
+                [
+                    {
+                        "user_id": user_id,
+                        "seq": first_seq + i,
+                        "op": op,
+                        "file_id": str(change["file_id"]),
+                        "path": change["path"],
+                        "size": change.get("size"),
+                        "checksum": change.get("checksum"),
+                        "mime_type": change.get("mime_type"),
+                        "created_at": now,
+                    }
+                    for i, change in enumerate(changes)
+                ],
+            )
+            if last_seq // PRUNE_EVERY != (first_seq - 1) // PRUNE_EVERY:
+                self._prune(conn, user_id)
+        return last_seq
+
+    def _prune(self, conn, user_id: str):
+        cutoff = datetime.now(timezone.utc) - self.retention
+        pruned = conn.execute(
+            text("SELECT MAX(seq) FROM file_changes WHERE user_id = :user_id AND created_at < :cutoff"),
+            {"user_id": user_id, "cutoff": cutoff},
+        ).scalar()
+        if not pruned:
+            return
+        conn.execute(
+            text("DELETE FROM file_changes WHERE user_id = :user_id AND seq <= :seq"),
+            {"user_id": user_id, "seq": pruned},
+        )
+        conn.execute(
+            text("UPDATE file_change_heads SET pruned_seq = :seq WHERE user_id = :user_id"),
+            {"user_id": user_id, "seq": pruned},
+        )
+        logger.info(f"Pruned file change journal of {user_id} up to seq {pruned}")
+
+    def head(self, user_id: str) -> int:
+        """Ultima sequenza assegnata all'utente (0 se non ha modifiche)"""
+        with self.engine.connect() as conn:
+            seq = conn.execute(
+                text("SELECT seq FROM file_change_heads WHERE user_id = :user_id"),
+                {"user_id": user_id},
+            ).scalar()
+        return seq or 0
+
+    def changes_since(self, user_id: str, since: int, limit: int) -> List[Dict]:
+        """
+        Modifiche con sequenza maggiore di `since`, in ordine.
+        Solleva CursorExpired se alcune sono già state eliminate dalla retention.
+        """
+        with self.engine.connect() as conn:
+            head = conn.execute(
+                text("SELECT seq, pruned_seq FROM file_change_heads WHERE user_id = :user_id"),
+                {"user_id": user_id},
+            ).first()
+            head_seq, pruned_seq = (head.seq, head.pruned_seq) if head else (0, 0)
+            if since < pruned_seq or since > head_seq:
+                raise CursorExpired(f"Cursor {since} outside journal range ({pruned_seq}-{head_seq})")
+
+            rows = conn.execute(
+                text(
+                    "SELECT seq, op, file_id, path, old_path, size, checksum, mime_type, created_at "
+                    "FROM file_changes WHERE user_id = :user_id AND seq > :since ORDER BY seq LIMIT :limit"
+                ),
+                {"user_id": user_id, "since": since, "limit": limit},
+            ).mappings().all()
+        return [dict(row) for row in rows]
@@ -0,0 +1,615 @@
+"""Chunk store content-defined: versioni dei file e upload delta"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+from sqlalchemy import text, bindparam
+from sqlalchemy.engine import Engine, Connection
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from app.core.blob_store import BlobStore
+from app.core.codecs import Codec, open_content
+from app.core.storage import StoredUpload, get_temp_dir, commit_temp, discard_temp, make_temp
+
+logger = logging.getLogger(__name__)
+
+ManifestEntry = Tuple[str, int]  # (sha256 del chunk, size)
+
+# File in attesa di essere divisi in chunk per la loro prima versione (oltre, la richiesta si ripete)
+VERSIONING_QUEUE_SIZE = 100
+HASH_READ_SIZE = 1024 * 1024
+# Checksum per query IN: un file grande ha decine di migliaia di chunk
+QUERY_BATCH = 1000
+# Attesa massima (secondi) dei chunk di un blob appena eliminato, che _materialize sta trasformando in file
+MATERIALIZE_WAIT = 60.0
+MATERIALIZE_RETRIES = 3
+
+# Tabella gear deterministica (derivata da SHA-256) così i client possono
+# riprodurre esattamente gli stessi tagli: GEAR[i] = primi 4 byte di sha256(b"synthetix-gear" + i)
+GEAR = [int.from_bytes(hashlib.sha256(b"synthetix-gear" + bytes([i])).digest()[:4], "big") for i in range(256)]
+
+
+def _mask(bits: int) -> int:
+    """Maschera sui bit alti dell'hash a 32 bit (quelli che dipendono da più byte)"""
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+def find_cut(data: bytes, min_size: int, avg_size: int, max_size: int) -> int:
+    """
+    Lunghezza del prossimo chunk in `data` secondo il gear hash (FastCDC normalizzato):
+    i primi min_size byte non vengono analizzati, fino a avg_size si usa una maschera
+    più restrittiva e oltre una più permissiva, così le dimensioni si concentrano attorno alla media.
+    """
+    length = len(data)
+    if length <= min_size:
+        return length
+    end = min(length, max_size)
+    normal = min(avg_size, end)
+    bits = max(avg_size.bit_length() - 1, 1)
+    mask_small, mask_large = _mask(bits + 1), _mask(bits - 1)
+
+    gear = GEAR
+    h = 0
+    i = min_size
+    for byte in data[min_size:normal]:
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask_small:
+            return i
+    for byte in data[normal:end]:
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask_large:
+            return i
+    return end
+
+
+def iter_cdc_chunks(stream: BinaryIO, min_size: int, avg_size: int, max_size: int) -> Iterator[bytes]:
+    """Divide uno stream in chunk content-defined leggendo al massimo 2 * max_size byte alla volta"""
+    buffer = b""
+    eof = False
+    while True:
+        if not eof and len(buffer) < max_size:
+            data = stream.read(2 * max_size)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        if not eof and len(buffer) < max_size:
+            continue
+        cut = find_cut(buffer, min_size, avg_size, max_size)
+        yield buffer[:cut]
+        buffer = buffer[cut:]
+
+
+class ChunkError(ValueError):
+    """Chunk mancante o non valido"""
+
+
+class ChunkStore:
+    """
+    I chunk sono salvati una sola volta per SHA-256 in {root}/chunks/ab/cd/<sha256>.
+    Ogni versione di un file è un manifest (lista ordinata di chunk) nella tabella
+    `file_versions`; la tabella `chunks` conta quante versioni usano ciascun chunk.
+    I chunk caricati ma non ancora usati da nessuna versione hanno refcount 0.
+    `chunk_owners` registra quali utenti hanno caricato (o possiedono) ciascun chunk.
+
+    I chunk dell'ultima versione di un file non hanno un file proprio: si leggono dal
+    blob della versione (`chunks.blob_checksum` / `blob_offset`). Quando quel blob viene
+    eliminato (il file ha una nuova versione o è stato cancellato) i chunk ancora usati
+    da altre versioni vengono riscritti come file. Spazio occupato: la versione corrente
+    costa solo il suo blob, ogni versione precedente i chunk che non ha in comune con
+    la corrente (per un file grande modificato poco, qualche chunk).
+
+    La prima versione di un file caricato senza chunk si crea in background dividendo
+    il blob (request_versioning): il gear hash in Python è lento, non va fatto in una richiesta.
+    """
+
+    def __init__(self, storage_root: str, engine: Engine, blob_store: BlobStore,
+                 min_size: int, avg_size: int, max_size: int, keep_versions: int):
+        self.root = os.path.join(storage_root, "chunks")
+        self.engine = engine
+        self.blob_store = blob_store
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.keep_versions = keep_versions
+        self._lock = threading.Lock()
+        # Segnalata da _materialize a fine lavoro: chi ricompone un file attende i chunk del blob eliminato
+        self._materialized = threading.Condition(self._lock)
+        blob_store.on_remove = self._materialize
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queued: Set[str] = set()
+        self._stopping = False
+
+    def chunk_path(self, checksum: str) -> str:
+        return os.path.join(self.root, checksum[:2], checksum[2:4], checksum)
+
+    # --- Prima versione in background ---
+
+    def start(self):
+        self._stopping = False
+        self._queue = asyncio.Queue(maxsize=VERSIONING_QUEUE_SIZE)
+        # Un solo thread dedicato: un file grande lo occupa a lungo, non deve togliere slot al pool di I/O
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chunk-versioning")
+        self._worker = asyncio.create_task(self._run_queue())
+
+    async def stop(self):
+        self._stopping = True
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def request_versioning(self, file_id: str, user_id: str, checksum: str, size: int) -> bool:
+        """
+        Accoda la creazione della prima versione di un file dal suo blob. False se la coda
+        è piena o il servizio non è avviato (la richiesta va ripetuta più tardi).
+        """
+        if self._queue is None or file_id in self._queued:
+            return self._queue is not None
+        try:
+            self._queue.put_nowait((file_id, user_id, checksum, size))
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(file_id)
+        return True
+
+    async def _run_queue(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            file_id, user_id, checksum, size = await self._queue.get()
+            try:
+                version = await loop.run_in_executor(self._executor, self.version_blob, file_id, user_id, checksum, size)
+                if version is not None:
+                    logger.info(f"🧩 File {file_id} chunked into its first version")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Could not chunk file {file_id}: {e}")
+            finally:
+                self._queued.discard(file_id)
+
+    def version_blob(self, file_id: str, user_id: str, checksum: str, size: int) -> Optional[int]:
+        """
+        Divide in chunk il blob `checksum` e lo registra come prima versione del file, senza
+        copiare byte: i chunk si leggono dal blob. Non fa nulla se il file ha già versioni
+        o se il blob non c'è più (operazione bloccante e lenta). Restituisce la versione.
+        """
+        if self.list_versions(file_id):
+            return None
+        path = self.blob_store.locate(checksum)
+        if path is None:
+            return None
+        manifest = []
+        with open_content(path) as f:
+            for data in iter_cdc_chunks(f, self.min_size, self.avg_size, self.max_size):
+                if self._stopping:
+                    return None
+                manifest.append((hashlib.sha256(data).hexdigest(), len(data)))
+        if sum(chunk_size for _, chunk_size in manifest) != size:
+            logger.warning(f"Blob {checksum} does not match the size of file {file_id}, not versioning it")
+            return None
+
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            # Sotto il lock: se il blob viene eliminato dopo, _materialize() trova i chunk registrati
+            if self.blob_store.locate(checksum) is None:
+                return None
+            with self.engine.begin() as conn:
+                if conn.execute(
+                    text("SELECT 1 FROM file_versions WHERE file_id = :file_id"), {"file_id": file_id}
+                ).first() is not None:
+                    return None
+                unique = dict(manifest)
+                conn.execute(
+                    text(
+                        "INSERT INTO chunks (checksum, size, refcount, created_at) "
+                        "VALUES (:checksum, :size, 0, :now) ON CONFLICT (checksum) DO NOTHING"
+                    ),
+                    [{"checksum": c, "size": chunk_size, "now": now} for c, chunk_size in unique.items()],
+                )
+                conn.execute(
+                    text(
+                        "INSERT INTO chunk_owners (user_id, checksum) "
+                        "VALUES (:user_id, :checksum) ON CONFLICT (user_id, checksum) DO NOTHING"
+                    ),
+                    [{"user_id": user_id, "checksum": c} for c in unique],
+                )
+                version, obsolete = self._insert_version(conn, file_id, user_id, manifest, size, checksum)
+            self._remove_files(obsolete)
+        return version
+
+    # --- Chunk letti dal blob della versione corrente ---
+
+    def _adopt(self, conn: Connection, manifest: List[ManifestEntry], blob_checksum: str) -> List[str]:
+        """
+        I chunk del manifest si leggeranno dal blob `blob_checksum`, che li contiene tutti.
+        Restituisce i file dei chunk diventati superflui, da eliminare dopo il commit.
+        """
+        offsets = {}
+        offset = 0
+        for checksum, size in manifest:
+            offsets.setdefault(checksum, offset)
+            offset += size
+        if not offsets:
+            return []
+        conn.execute(
+            text("UPDATE chunks SET blob_checksum = :blob, blob_offset = :offset WHERE checksum = :checksum"),
+            [{"blob": blob_checksum, "offset": o, "checksum": c} for c, o in offsets.items()],
+        )
+        return [self.chunk_path(c) for c in offsets]
+
+    @staticmethod
+    def _remove_files(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _materialize(self, blob_checksum: str, path: str, codec: Optional[Codec]):
+        """
+        Hook del blob store: il blob sta per essere eliminato (`path` è la sua copia messa da
+        parte). I chunk che vi si leggevano e sono ancora usati diventano file.
+        """
+        with self._lock:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text(
+                        "SELECT checksum, size, blob_offset FROM chunks "
+                        "WHERE blob_checksum = :blob ORDER BY blob_offset"
+                    ),
+                    {"blob": blob_checksum},
+                ).all()
+            if not rows:
+                return
+            written = 0
+            with (codec.open(path) if codec is not None else open(path, "rb")) as f:
+                position = 0
+                for row in rows:
+                    if row.blob_offset > position:
+                        f.seek(row.blob_offset)
+                    data = f.read(row.size)
+                    position = row.blob_offset + len(data)
+                    if hashlib.sha256(data).hexdigest() != row.checksum:
+                        # Resta senza file: lo scrubber lo segnala come mancante
+                        logger.error(f"❌ Chunk {row.checksum} does not match blob {blob_checksum} at offset {row.blob_offset}")
+                        continue
+                    chunk_path = self.chunk_path(row.checksum)
+                    if not os.path.exists(chunk_path):
+                        fd, temp_path = make_temp(get_temp_dir(), "chunk_")
+                        with os.fdopen(fd, "wb") as out:
+                            out.write(data)
+                        commit_temp(temp_path, chunk_path)
+                    written += 1
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text("UPDATE chunks SET blob_checksum = NULL, blob_offset = NULL WHERE blob_checksum = :blob"),
+                    {"blob": blob_checksum},
+                )
+            self._materialized.notify_all()
+        logger.info(f"🧩 {written} chunks of removed blob {blob_checksum} kept for older versions")
+
+    def missing(self, checksums: List[str], user_id: Optional[str] = None) -> List[str]:
+        """
+        Chunk non disponibili. Con `user_id` contano solo i chunk che l'utente ha già
+        caricato o che appartengono ai suoi file: conoscere un hash non basta per usarlo.
+        """
+        if not checksums:
+            return []
+        if user_id is None:
+            query = text("SELECT checksum, blob_checksum FROM chunks WHERE checksum IN :checksums")
+        else:
+            query = text(
+                "SELECT c.checksum, c.blob_checksum FROM chunks c JOIN chunk_owners o ON o.checksum = c.checksum "
+                "WHERE o.user_id = :user_id AND c.checksum IN :checksums"
+            )
+        query = query.bindparams(bindparam("checksums", expanding=True))
+        rows = []
+        with self.engine.connect() as conn:
+            for i in range(0, len(checksums), QUERY_BATCH):
+                rows += conn.execute(query, {"checksums": checksums[i:i + QUERY_BATCH], "user_id": user_id}).all()
+        present = {row.checksum for row in rows if row.blob_checksum is not None or os.path.exists(self.chunk_path(row.checksum))}
+        return [c for c in checksums if c not in present]
+
+    def put_chunk(self, user_id: str, stored: StoredUpload, expected_checksum: str):
+        """Registra un chunk caricato dal client, dopo averne verificato il checksum"""
+        if stored.checksum != expected_checksum:
+            discard_temp(stored.temp_path)
+            raise ChunkError(f"Chunk checksum mismatch: expected {expected_checksum}, got {stored.checksum}")
+        if stored.size > self.max_size:
+            discard_temp(stored.temp_path)
+            raise ChunkError(f"Chunk exceeds maximum size of {self.max_size} bytes")
+        self._store(user_id, stored.checksum, stored.size, temp_path=stored.temp_path)
+
+    def _store(self, user_id: str, checksum: str, size: int, temp_path: Optional[str] = None):
+        """Registra il chunk e il suo proprietario; il file temporaneo, se c'è, viene spostato o scartato"""
+        path = self.chunk_path(checksum)
+        params = {"checksum": checksum, "size": size, "user_id": user_id, "now": datetime.now(timezone.utc)}
+        with self._lock:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT INTO chunks (checksum, size, refcount, created_at) "
+                        "VALUES (:checksum, :size, 0, :now) ON CONFLICT (checksum) DO NOTHING"
+                    ),
+                    params,
+                )
+                conn.execute(
+                    text(
+                        "INSERT INTO chunk_owners (user_id, checksum) "
+                        "VALUES (:user_id, :checksum) ON CONFLICT (user_id, checksum) DO NOTHING"
+                    ),
+                    params,
+                )
+                if temp_path is None:
+                    return
+                if os.path.exists(path):
+                    discard_temp(temp_path)
+                else:
+                    commit_temp(temp_path, path)
+
+    def remove_orphan(self, checksum: str) -> bool:
+        """Elimina il file di un chunk che non ha una riga in `chunks` (residuo di un crash)"""
+        with self._lock:
+            with self.engine.connect() as conn:
+                row = conn.execute(
+                    text("SELECT 1 FROM chunks WHERE checksum = :checksum"), {"checksum": checksum}
+                ).first()
+            if row is not None:
+                return False
+            try:
+                os.remove(self.chunk_path(checksum))
+            except FileNotFoundError:
+                return False
+        return True
+
+    def collect_unused(self, checksums: List[str], older_than: datetime) -> int:
+        """
+        Elimina, tra quelli indicati, i chunk caricati prima di `older_than` e mai usati
+        da una versione (upload delta abbandonati). Restituisce quanti ne ha eliminati.
+        """
+        if not checksums:
+            return 0
+        with self._lock:
+            with self.engine.begin() as conn:
+                rows = conn.execute(
+                    text(
+                        "SELECT checksum, size FROM chunks "
+                        "WHERE checksum IN :checksums AND refcount <= 0 AND created_at < :older_than"
+                    ).bindparams(bindparam("checksums", expanding=True)),
+                    {"checksums": checksums, "older_than": older_than},
+                ).all()
+                self._delete_unreferenced(conn, [(row.checksum, row.size) for row in rows])
+        return len(rows)
+
+    def _sources(self, checksums: List[str]) -> Dict[str, Tuple[Optional[str], Optional[int]]]:
+        query = text(
+            "SELECT checksum, blob_checksum, blob_offset FROM chunks WHERE checksum IN :checksums"
+        ).bindparams(bindparam("checksums", expanding=True))
+        rows = []
+        with self.engine.connect() as conn:
+            for i in range(0, len(checksums), QUERY_BATCH):
+                rows += conn.execute(query, {"checksums": checksums[i:i + QUERY_BATCH]}).all()
+        return {row.checksum: (row.blob_checksum, row.blob_offset) for row in rows}
+
+    def _copy_chunks(self, out: BinaryIO, checksums: List[str], positions: Dict[str, List[int]],
+                     sizes: Dict[str, int]) -> List[str]:
+        """
+        Scrive nel file di output i chunk indicati, ciascuno a tutte le sue posizioni.
+        Quelli letti da un blob si leggono in ordine di offset, una passata per blob
+        (un blob compresso si può solo leggere in avanti). Restituisce i chunk non trovati.
+        """
+        def place(checksum: str, data: bytes):
+            if len(data) != sizes[checksum]:
+                raise ChunkError(f"Chunk {checksum} has size {len(data)}, manifest says {sizes[checksum]}")
+            for position in positions[checksum]:
+                out.seek(position)
+                out.write(data)
+
+        sources = self._sources(checksums)
+        by_blob = defaultdict(list)
+        unavailable = []
+        for checksum in checksums:
+            try:
+                with open(self.chunk_path(checksum), "rb") as chunk:
+                    place(checksum, chunk.read())
+                continue
+            except FileNotFoundError:
+                pass
+            blob_checksum, offset = sources.get(checksum, (None, None))
+            if blob_checksum is None:
+                unavailable.append(checksum)
+            else:
+                by_blob[blob_checksum].append((offset, checksum))
+
+        for blob_checksum, entries in by_blob.items():
+            path = self.blob_store.locate(blob_checksum)
+            if path is None:
+                unavailable.extend(checksum for _, checksum in entries)
+                continue
+            with open_content(path) as f:
+                for offset, checksum in sorted(entries):
+                    f.seek(offset)
+                    place(checksum, f.read(sizes[checksum]))
+        return unavailable
+
+    def _wait_materialized(self, checksums: List[str]) -> bool:
+        """
+        Attende che i chunk che si leggevano da un blob già eliminato diventino file: il blob
+        store chiama _materialize fuori dal suo lock, quindi può non essere ancora iniziato.
+        False se l'attesa scade.
+        """
+        def pending() -> bool:
+            return any(
+                blob is not None and self.blob_store.locate(blob) is None
+                for blob, _ in self._sources(checksums).values()
+            )
+
+        with self._materialized:
+            return self._materialized.wait_for(lambda: not pending(), timeout=MATERIALIZE_WAIT)
+
+    def assemble_to_temp(self, manifest: List[ManifestEntry]) -> StoredUpload:
+        """Ricompone un file dai suoi chunk in un file temporaneo, calcolando size e SHA-256"""
+        missing = self.missing(list({c for c, _ in manifest}))
+        if missing:
+            raise ChunkError(f"Missing chunks: {', '.join(missing[:10])}")
+
+        positions: Dict[str, List[int]] = defaultdict(list)
+        sizes: Dict[str, int] = {}
+        size = 0
+        for checksum, chunk_size in manifest:
+            positions[checksum].append(size)
+            sizes[checksum] = chunk_size
+            size += chunk_size
+
+        fd, temp_path = make_temp(get_temp_dir(), "assemble_")
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "w+b") as out:
+                out.truncate(size)
+                unavailable = self._copy_chunks(out, list(sizes), positions, sizes)
+                for _ in range(MATERIALIZE_RETRIES):
+                    if not unavailable or not self._wait_materialized(unavailable):
+                        break
+                    unavailable = self._copy_chunks(out, unavailable, positions, sizes)
+                if unavailable:
+                    raise ChunkError(f"Missing chunks: {', '.join(unavailable[:10])}")
+                out.seek(0)
+                while True:
+                    data = out.read(HASH_READ_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                out.flush()
+                os.fsync(out.fileno())
+        except BaseException:
+            discard_temp(temp_path)
+            raise
+        return StoredUpload(temp_path=temp_path, size=size, checksum=hasher.hexdigest())
+
+    def _change_refs(self, conn: Connection, manifest: List[ManifestEntry], delta: int):
+        checksums = sorted({c for c, _ in manifest})
+        if not checksums:
+            return
+        conn.execute(
+            text("UPDATE chunks SET refcount = refcount + :delta WHERE checksum IN :checksums")
+            .bindparams(bindparam("checksums", expanding=True)),
+            {"delta": delta, "checksums": checksums},
+        )
+
+    def _delete_unreferenced(self, conn: Connection, manifest: List[ManifestEntry]):
+        checksums = sorted({c for c, _ in manifest})
+        if not checksums:
+            return
+        rows = conn.execute(
+            text("SELECT checksum FROM chunks WHERE checksum IN :checksums AND refcount <= 0")
+            .bindparams(bindparam("checksums", expanding=True)),
+            {"checksums": checksums},
+        ).all()
+        for row in rows:
+            conn.execute(text("DELETE FROM chunks WHERE checksum = :checksum"), {"checksum": row.checksum})
+            conn.execute(text("DELETE FROM chunk_owners WHERE checksum = :checksum"), {"checksum": row.checksum})
+            path = self.chunk_path(row.checksum)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add_version(self, file_id: str, user_id: str, manifest: List[ManifestEntry], size: int, checksum: str) -> int:
+        """
+        Registra una nuova versione del file e pota quelle oltre keep_versions. Va chiamata
+        prima di rilasciare il contenuto precedente: i chunk in comune passano al nuovo blob
+        e da quello vecchio si riscrivono solo quelli cambiati.
+        """
+        with self._lock:
+            with self.engine.begin() as conn:
+                version, obsolete = self._insert_version(conn, file_id, user_id, manifest, size, checksum)
+            self._remove_files(obsolete)
+        return version
+
+    def _insert_version(self, conn: Connection, file_id: str, user_id: str, manifest: List[ManifestEntry],
+                        size: int, checksum: str) -> Tuple[int, List[str]]:
+        """(versione, file di chunk da eliminare dopo il commit)"""
+        row = conn.execute(
+            text("SELECT COALESCE(MAX(version), 0) AS latest FROM file_versions WHERE file_id = :file_id"),
+            {"file_id": file_id},
+        ).first()
+        version = row.latest + 1
+        conn.execute(
+            text(
+                "INSERT INTO file_versions (file_id, user_id, version, size, checksum, manifest, created_at) "
+                "VALUES (:file_id, :user_id, :version, :size, :checksum, :manifest, :now)"
+            ),
+            {
+                "file_id": file_id,
+                "user_id": user_id,
+                "version": version,
+                "size": size,
+                "checksum": checksum,
+                "manifest": json.dumps(manifest),
+                "now": datetime.now(timezone.utc),
+            },
+        )
+        self._change_refs(conn, manifest, 1)
+        self._prune(conn, file_id, version - self.keep_versions)
+        # Contenuto mai salvato come blob (es. file legacy): i chunk restano file
+        obsolete = self._adopt(conn, manifest, checksum) if self.blob_store.locate(checksum) else []
+        return version, obsolete
+
+    def _prune(self, conn: Connection, file_id: str, up_to_version: int):
+        if up_to_version < 1:
+            return
+        rows = conn.execute(
+            text("SELECT id, manifest FROM file_versions WHERE file_id = :file_id AND version <= :version"),
+            {"file_id": file_id, "version": up_to_version},
+        ).all()
+        for row in rows:
+            manifest = [tuple(entry) for entry in json.loads(row.manifest)]
+            conn.execute(text("DELETE FROM file_versions WHERE id = :id"), {"id": row.id})
+            self._change_refs(conn, manifest, -1)
+            self._delete_unreferenced(conn, manifest)
+
+    def list_versions(self, file_id: str) -> List[Dict]:
+        """Versioni del file, dalla più recente"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT version, size, checksum, created_at FROM file_versions "
+                    "WHERE file_id = :file_id ORDER BY version DESC"
+                ),
+                {"file_id": file_id},
+            ).mappings().all()
+        return [dict(row) for row in rows]
+
+    def get_version(self, file_id: str, version: int) -> Optional[Dict]:
+        """Versione con il suo manifest, None se non esiste"""
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT version, size, checksum, manifest, created_at FROM file_versions "
+                    "WHERE file_id = :file_id AND version = :version"
+                ),
+                {"file_id": file_id, "version": version},
+            ).mappings().first()
+        if row is None:
+            return None
+        result = dict(row)
+        result["manifest"] = [tuple(entry) for entry in json.loads(result["manifest"])]
+        return result
+
+    def delete_versions(self, file_id: str):
+        """Elimina tutte le versioni di un file rilasciando i chunk non più usati"""
+        with self._lock:
+            with self.engine.begin() as conn:
+                self._prune(conn, file_id, 2 ** 31 - 1)
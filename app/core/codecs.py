@@ -0,0 +1,228 @@
+"""Compressione trasparente dei blob: codec scelto per mime type, decompressione in streaming"""
+from abc import ABC, abstractmethod
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+import gzip
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import struct
+import zlib
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:  # zstandard è opzionale: senza, si può usare solo gzip
+    ZSTD_AVAILABLE = False
+
+from app.core.config import settings
+from app.core.media_types import is_compressed_mime
+
+logger = logging.getLogger(__name__)
+
+COPY_SIZE = 1024 * 1024
+# Sotto questo risparmio il blob resta non compresso: decomprimerlo costerebbe più di quanto fa risparmiare
+MIN_SAVING = 0.1
+ZSTD_FRAME_HEADER_MAX = 18  # Byte sufficienti a leggere la dimensione dal frame header
+# Nel trailer gzip la dimensione originale è modulo 2^32
+GZIP_MAX_SIZE = 2 ** 32 - 1
+# Estensioni di testo che il modulo mimetypes non conosce
+_EXTRA_TYPES = {
+    ".yaml": "application/yaml",
+    ".yml": "application/yaml",
+    ".toml": "application/toml",
+    ".log": "text/plain",
+    ".ini": "text/plain",
+    ".conf": "text/plain",
+    ".cfg": "text/plain",
+    ".env": "text/plain",
+}
+
+
+class CodecError(ValueError):
+    """Contenuto compresso non decodificabile (o codec non disponibile)"""
+
+
+class Codec(ABC):
+    """
+    Formato di compressione di un blob, riconoscibile dal suffisso del file (<sha256>.zst).
+    `content_encoding` è il nome del formato in Content-Encoding / Accept-Encoding.
+    """
+    name = ""
+    suffix = ""
+    content_encoding = ""
+
+    @abstractmethod
+    def compress_file(self, src_path: str, dest_path: str, level: Optional[int] = None):
+        pass
+
+    @abstractmethod
+    def open(self, path: str) -> BinaryIO:
+        """Lettore del contenuto decompresso (supporta seek in avanti)"""
+        pass
+
+    @abstractmethod
+    def decoder(self) -> Callable[[bytes], bytes]:
+        """Decompressione incrementale: ogni chiamata restituisce i byte decodificati finora"""
+        pass
+
+    @abstractmethod
+    def content_size(self, path: str) -> Optional[int]:
+        """Dimensione del contenuto originale letta dall'header del file, senza decomprimere"""
+        pass
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    suffix = ".zst"
+    content_encoding = "zstd"
+
+    def _require(self):
+        if not ZSTD_AVAILABLE:
+            raise CodecError("zstandard is not installed: cannot read or write .zst blobs")
+
+    def compress_file(self, src_path: str, dest_path: str, level: Optional[int] = None):
+        self._require()
+        # La dimensione nell'header del frame permette di servire Range senza decomprimere tutto
+        compressor = zstandard.ZstdCompressor(level=level or 3, write_content_size=True)
+        with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+            compressor.copy_stream(src, dest, size=os.fstat(src.fileno()).st_size,
+                                   read_size=COPY_SIZE, write_size=COPY_SIZE)
+            dest.flush()
+            os.fsync(dest.fileno())
+
+    def open(self, path: str) -> BinaryIO:
+        self._require()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_size=COPY_SIZE, closefd=True)
+
+    def decoder(self) -> Callable[[bytes], bytes]:
+        self._require()
+        obj = zstandard.ZstdDecompressor().decompressobj()
+
+        def decode(data: bytes) -> bytes:
+            try:
+                return obj.decompress(data)
+            except zstandard.ZstdError as e:
+                raise CodecError(str(e)) from e
+        return decode
+
+    def content_size(self, path: str) -> Optional[int]:
+        self._require()
+        with open(path, "rb") as f:
+            header = f.read(ZSTD_FRAME_HEADER_MAX)
+        try:
+            size = zstandard.frame_content_size(header)
+        except zstandard.ZstdError:
+            return None
+        return size if size >= 0 else None
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    suffix = ".gz"
+    content_encoding = "gzip"
+
+    def compress_file(self, src_path: str, dest_path: str, level: Optional[int] = None):
+        with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+            with gzip.GzipFile(fileobj=dest, mode="wb", compresslevel=level or 6, mtime=0) as out:
+                shutil.copyfileobj(src, out, COPY_SIZE)
+            dest.flush()
+            os.fsync(dest.fileno())
+
+    def open(self, path: str) -> BinaryIO:
+        return gzip.open(path, "rb")
+
+    def decoder(self) -> Callable[[bytes], bytes]:
+        obj = zlib.decompressobj(wbits=31)
+
+        def decode(data: bytes) -> bytes:
+            try:
+                return obj.decompress(data)
+            except zlib.error as e:
+                raise CodecError(str(e)) from e
+        return decode
+
+    def content_size(self, path: str) -> Optional[int]:
+        with open(path, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack("<I", f.read(4))[0]
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (ZstdCodec(), GzipCodec())}
+# Suffissi con cui un blob può trovarsi su disco, il non compresso per primo
+BLOB_SUFFIXES = ("",) + tuple(codec.suffix for codec in CODECS.values())
+_ENCODED_BLOB_RE = re.compile(r"^[0-9a-f]{64}(" + "|".join(re.escape(c.suffix) for c in CODECS.values()) + r")$")
+
+
+def split_suffix(name: str) -> Tuple[str, Optional[Codec]]:
+    """(checksum, codec) dal nome di un file del blob store"""
+    for codec in CODECS.values():
+        if name.endswith(codec.suffix):
+            return name[:-len(codec.suffix)], codec
+    return name, None
+
+
+def codec_for_path(path: str) -> Optional[Codec]:
+    """
+    Codec di un blob compresso, None per qualunque altro file. Conta solo il nome
+    <sha256>.<suffisso>: un file legacy '<sha256>_log.gz' caricato dall'utente resta com'è.
+    """
+    name = os.path.basename(path)
+    if not _ENCODED_BLOB_RE.match(name):
+        return None
+    return split_suffix(name)[1]
+
+
+def open_content(path: str) -> BinaryIO:
+    """Apre un file restituendo il contenuto originale, decompresso se è un blob compresso"""
+    codec = codec_for_path(path)
+    return codec.open(path) if codec is not None else open(path, "rb")
+
+
+def _configured_codec() -> Optional[Codec]:
+    name = settings.STORAGE_COMPRESSION.strip().lower()
+    if name in ("", "none"):
+        return None
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unknown STORAGE_COMPRESSION '{settings.STORAGE_COMPRESSION}': expected none, zstd or gzip")
+    if codec.name == "zstd" and not ZSTD_AVAILABLE:
+        logger.warning("⚠️  zstandard not installed: compressing new blobs with gzip")
+        return CODECS["gzip"]
+    return codec
+
+
+write_codec = _configured_codec()
+
+
+def _matches(mime_type: str, pattern: str) -> bool:
+    if pattern.endswith("/"):
+        return mime_type.startswith(pattern)
+    if pattern.startswith("+"):
+        return mime_type.endswith(pattern)
+    return mime_type == pattern
+
+
+def codec_for(mime_type: Optional[str], size: int, name: Optional[str] = None) -> Optional[Codec]:
+    """
+    Codec con cui salvare un nuovo blob, None se va salvato così com'è: compressione
+    disattivata, file piccolo, mime type non in STORAGE_COMPRESSION_MIME_TYPES o già compresso.
+    Se il client non dichiara un mime type utile si ricava dal nome del file.
+    """
+    if write_codec is None or size < settings.STORAGE_COMPRESSION_MIN_SIZE:
+        return None
+    if write_codec.name == "gzip" and size > GZIP_MAX_SIZE:
+        return None
+    mime_type = (mime_type or "").split(";")[0].strip().lower()
+    if mime_type in ("", "application/octet-stream") and name:
+        guessed = mimetypes.guess_type(name)[0] or _EXTRA_TYPES.get(os.path.splitext(name)[1].lower())
+        mime_type = (guessed or "").lower()
+    if not mime_type or is_compressed_mime(mime_type):
+        return None
+    # Le immagini passano dalla pipeline delle miniature, che le legge direttamente da disco
+    if mime_type.startswith("image/") and mime_type != "image/svg+xml":
+        return None
+    if not any(_matches(mime_type, pattern) for pattern in settings.STORAGE_COMPRESSION_MIME_TYPES):
+        return None
+    return write_codec
@@ -1,5 +1,7 @@
+from pydantic import Field
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
+import secrets
 
 
 class Settings(BaseSettings):
@@ -24,6 +26,97 @@ class Settings(BaseSettings):
     
     # Storage
     STORAGE_PATH: str = "./shared_storage"
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # 1 MiB per lettura in streaming
+    UPLOAD_SESSION_CHUNK_SIZE: int = 8 * 1024 * 1024  # Chunk di default per upload riprendibili
+    UPLOAD_SESSION_MAX_CHUNK_SIZE: int = 64 * 1024 * 1024
+    UPLOAD_SESSION_TTL_HOURS: int = 24
+    UPLOAD_BY_HASH_CROSS_USER: bool = False  # Consente upload-by-hash su contenuti caricati da altri utenti
+    DOWNLOAD_CHUNK_SIZE: int = 256 * 1024
+    DOWNLOAD_MAX_RANGES: int = 16  # Range per richiesta: oltre si risponde 416
+    FILE_RECORD_CACHE_TTL: float = 5.0  # Secondi di validità dei record in cache (per worker)
+    FILE_RECORD_CACHE_SIZE: int = 10000
+    FILE_LIST_DEFAULT_LIMIT: int = 200
+    FILE_LIST_MAX_LIMIT: int = 1000
+    SEARCH_DEFAULT_LIMIT: int = 50
+    FILE_CHANGES_RETENTION_DAYS: int = 90  # Oltre, i client con un cursore più vecchio rifanno la sync completa
+    STORAGE_QUOTA_DEFAULT_MB: int = 0  # Quota per utente se non ne ha una propria in storage_usage (0 = illimitata)
+    STORAGE_QUOTA_RECONCILE_HOURS: float = 24.0  # Ogni quanto i contatori vengono ricalcolati dal catalogo
+    STORAGE_IO_WORKERS: int = 8  # Thread per I/O su disco e hashing
+    STORAGE_IO_MAX_PENDING: int = 64  # Operazioni in coda oltre le quali gli upload rallentano
+    
+    # Volumi aggiuntivi per i blob, come JSON: ["disco2=/mnt/disco2", "disco3=/mnt/disco3@2"]
+    # (@peso opzionale, default la capacità del disco). STORAGE_PATH resta il volume primario.
+    STORAGE_VOLUMES: List[str] = []
+    STORAGE_PRIMARY_WEIGHT: Optional[float] = None
+    STORAGE_VOLUME_MIN_FREE_MB: int = 1024  # Spazio da lasciare libero su ogni volume
+    STORAGE_REBALANCE_MAX_MBPS: float = 50.0  # Banda dello spostamento dei blob dopo un cambio di volumi
+    
+    # Compressione dei blob su disco: none | zstd (richiede zstandard) | gzip
+    STORAGE_COMPRESSION: str = "none"
+    STORAGE_COMPRESSION_LEVEL: Optional[int] = None  # None = default del codec (zstd 3, gzip 6)
+    STORAGE_COMPRESSION_MIN_SIZE: int = 4096  # Byte sotto i quali non conviene comprimere
+    # Mime type da comprimere: "tipo/" = prefisso, "+suffisso" (es. +json), altrimenti corrispondenza esatta
+    STORAGE_COMPRESSION_MIME_TYPES: List[str] = [
+        "text/",
+        "+json",
+        "+xml",
+        "application/json",
+        "application/x-ndjson",
+        "application/xml",
+        "application/yaml",
+        "application/x-yaml",
+        "application/toml",
+        "application/javascript",
+        "application/x-javascript",
+        "application/sql",
+        "application/x-sh",
+        "application/x-tar",
+        "application/rtf",
+        "application/postscript",
+        "image/svg+xml",
+    ]
+    
+    # Scrubber: verifica periodica dei checksum e recupero dei file orfani
+    SCRUBBER_ENABLED: bool = True
+    SCRUB_MAX_MBPS: float = 20.0  # Banda massima di lettura (0 = illimitata)
+    SCRUB_INTERVAL_HOURS: float = 168.0  # Attesa tra la fine di un passaggio e l'inizio del successivo
+    SCRUB_ORPHAN_GRACE_HOURS: float = 24.0  # Età minima prima di eliminare file orfani o chunk inutilizzati
+    
+    # Chunk store opzionale (versioni dei file e upload delta con chunk content-defined)
+    CHUNK_STORE_ENABLED: bool = False
+    CDC_MIN_SIZE: int = 256 * 1024
+    CDC_AVG_SIZE: int = 1024 * 1024
+    CDC_MAX_SIZE: int = 4 * 1024 * 1024
+    FILE_VERSIONS_KEEP: int = 10
+    
+    # Miniature e metadata EXIF (richiede Pillow)
+    MEDIA_PIPELINE_ENABLED: bool = True
+    MEDIA_PIPELINE_WORKERS: int = 2  # Processi dedicati alla decodifica delle immagini
+    MEDIA_PIPELINE_QUEUE_SIZE: int = 1000
+    THUMBNAIL_SIZES: List[int] = [256, 1024]  # Lato massimo in pixel
+    THUMBNAIL_QUALITY: int = 82
+    
+    # Download firmati e offload al reverse proxy
+    # SECRET_KEY va impostata in .env: se generata a caso, i link non valgono tra worker o dopo un riavvio
+    SECRET_KEY: str = Field(default_factory=lambda: secrets.token_hex(32))
+    SIGNED_URL_TTL: int = 300  # Secondi di validità dei link firmati
+    DOWNLOAD_OFFLOAD: str = "none"  # none | x-accel (nginx) | x-sendfile (apache/lighttpd)
+    DOWNLOAD_OFFLOAD_PREFIX: str = "/protected-storage"  # Location interna di nginx mappata su STORAGE_PATH
+    
+    # Dispositivi: lo stato è servito dalla cache e salvato su Supabase a intervalli
+    DEVICE_STATE_FLUSH_INTERVAL: float = 2.0  # Secondi tra un salvataggio degli stati e il successivo
+    DEVICE_STATE_REDIS: bool = True  # Cache su Redis (se raggiungibile), condivisa tra i worker
+    DEVICE_COMMAND_CONCURRENCY: int = 20  # Driver chiamati in parallelo da un comando di gruppo
+    DEVICE_COMMAND_TIMEOUT: float = 5.0  # Secondi per dispositivo prima di considerarlo non raggiungibile
+    DEVICE_COMMAND_QUEUE_MAX: int = 100  # Comandi in attesa per dispositivo oltre i quali si risponde 429
+    DEVICE_DRIVERS_MAX: int = 200  # Driver connessi contemporaneamente (oltre, si disconnette il meno usato)
+    DEVICE_DRIVER_IDLE_TIMEOUT: float = 1800.0  # Secondi senza comandi dopo i quali un driver viene disconnesso
+    DEVICE_PRELOAD_MAX: int = 50  # Dispositivi usati di recente da connettere all'avvio
+    DEVICE_PRELOAD_WINDOW_HOURS: float = 24.0
+    DEVICE_POLL_ENABLED: bool = True  # Lettura periodica dello stato dei driver connessi
+    DEVICE_POLL_FAST_INTERVAL: float = 2.0  # Secondi tra le letture dopo un comando o un cambiamento
+    DEVICE_POLL_SLOW_INTERVAL: float = 60.0  # Intervallo massimo per i dispositivi senza novità
+    DEVICE_POLL_CONCURRENCY: int = 10  # Letture in corso contemporaneamente, per tutti i dispositivi
     
     # API Settings
     API_V1_PREFIX: str = "/api/v1"
@@ -3,10 +3,20 @@ from fastapi import HTTPException, Depends, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from supabase import Client
 from redis import Redis
+from typing import Optional
 import logging
 
 from app.core.config import settings
 from app.core.device_manager import DeviceManager
+from app.core.device_state import DeviceStateCache
+from app.core.blob_store import BlobStore
+from app.core.folder_index import FolderIndex
+from app.core.chunk_store import ChunkStore
+from app.core.change_journal import ChangeJournal
+from app.core.search_index import SearchIndex
+from app.core.quota import StorageQuota
+from app.core.scrubber import StorageScrubber
+from app.core.rebalancer import VolumeRebalancer
 from app.drivers import VirtualLight
 
 # Globals che verranno inizializzati nel main
@@ -14,6 +24,15 @@ from app.drivers import VirtualLight
 supabase_client = None  # Union[Client, MockSupabaseClient]
 local_db_engine = None
 redis_client: Redis = None
+blob_store: BlobStore = None
+folder_index: FolderIndex = None
+change_journal: ChangeJournal = None
+search_index: SearchIndex = None
+storage_quota: StorageQuota = None
+chunk_store: ChunkStore = None  # None se CHUNK_STORE_ENABLED è disattivo
+storage_scrubber: StorageScrubber = None
+volume_rebalancer: VolumeRebalancer = None
+device_state_cache: DeviceStateCache = None
 device_manager: DeviceManager = DeviceManager.get_instance()
 security = HTTPBearer()
 logger = logging.getLogger(__name__)
@@ -42,6 +61,67 @@ def get_redis() -> Redis:
     return redis_client
 
 
+def get_blob_store() -> BlobStore:
+    """Dependency injection per il blob store (richiede il DB locale)"""
+    if blob_store is None:
+        raise HTTPException(status_code=500, detail="Blob store not initialized")
+    return blob_store
+
+
+def get_folder_index() -> FolderIndex:
+    """Dependency injection per l'indice delle cartelle (richiede il DB locale)"""
+    if folder_index is None:
+        raise HTTPException(status_code=500, detail="Folder index not initialized")
+    return folder_index
+
+
+def get_change_journal() -> ChangeJournal:
+    """Dependency injection per il journal delle modifiche ai file"""
+    if change_journal is None:
+        raise HTTPException(status_code=500, detail="Change journal not initialized")
+    return change_journal
+
+
+def get_search_index() -> SearchIndex:
+    """Dependency injection per l'indice di ricerca dei file"""
+    if search_index is None:
+        raise HTTPException(status_code=500, detail="Search index not initialized")
+    return search_index
+
+
+def get_storage_quota() -> StorageQuota:
+    """Dependency injection per le quote di storage degli utenti"""
+    if storage_quota is None:
+        raise HTTPException(status_code=500, detail="Storage quota not initialized")
+    return storage_quota
+
+
+def get_chunk_store() -> ChunkStore:
+    """Dependency injection per il chunk store (modalità opzionale)"""
+    if chunk_store is None:
+        raise HTTPException(status_code=503, detail="Chunk store not enabled")
+    return chunk_store
+
+
+def get_optional_chunk_store() -> Optional[ChunkStore]:
+    """Chunk store se attivo, altrimenti None (per gli endpoint che funzionano anche senza)"""
+    return chunk_store
+
+
+def get_storage_scrubber() -> StorageScrubber:
+    """Dependency injection per lo scrubber dello storage"""
+    if storage_scrubber is None:
+        raise HTTPException(status_code=503, detail="Storage scrubber not initialized")
+    return storage_scrubber
+
+
+def get_device_state_cache() -> DeviceStateCache:
+    """Dependency injection per la cache dello stato dei dispositivi"""
+    if device_state_cache is None:
+        raise HTTPException(status_code=500, detail="Device state cache not initialized")
+    return device_state_cache
+
+
 def get_device_manager() -> DeviceManager:
     """Dependency injection per Device Manager"""
     return device_manager
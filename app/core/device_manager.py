@@ -1,6 +1,12 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
+import asyncio
+import copy
 import logging
+import time
+
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -38,13 +44,55 @@ class DeviceDriver(ABC):
         return self.__class__.__name__
 
 
+class CommandQueueFull(Exception):
+    """Troppi comandi in attesa per lo stesso dispositivo"""
+
+
+class _CommandQueue:
+    """
+    Comandi di un dispositivo in attesa di essere applicati. Ce n'è al più un blocco in
+    sospeso: i comandi che arrivano mentre il driver è occupato si fondono in quello.
+    """
+
+    def __init__(self):
+        self.pending: Optional[Dict[str, Any]] = None
+        self.waiters: List[asyncio.Future] = []
+        self.waiting = 0  # Chiamanti non ancora serviti (blocco in corso compreso)
+        self.worker: Optional[asyncio.Task] = None
+
+
+# Chiamata dal poller con (device_id, stato) quando lo stato letto dal driver cambia
+StateChangeCallback = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
 class DeviceManager:
-    """Singleton per la gestione dei driver attivi"""
+    """
+    Singleton per la gestione dei driver attivi.
+    I driver si caricano al primo uso e restano connessi al più DEVICE_DRIVERS_MAX alla
+    volta: oltre, o dopo DEVICE_DRIVER_IDLE_TIMEOUT secondi senza comandi, il meno usato
+    di recente viene disconnesso (mai uno con comandi in coda).
+
+    Un poller legge in background lo stato dei driver connessi, per accorgersi dei
+    cambiamenti avvenuti fuori dall'app (es. un interruttore fisico). Ogni dispositivo ha
+    il suo intervallo: DEVICE_POLL_FAST_INTERVAL dopo un comando o un cambiamento, poi
+    raddoppia a ogni lettura senza novità fino a DEVICE_POLL_SLOW_INTERVAL. Al più
+    DEVICE_POLL_CONCURRENCY letture sono in corso insieme, le più in ritardo per prime.
+    """
     _instance = None
     
     def __init__(self):
-        self.drivers: Dict[str, DeviceDriver] = {}
+        self.drivers: "OrderedDict[str, DeviceDriver]" = OrderedDict()  # Dal meno usato di recente
         self.device_types: Dict[str, type] = {}  # Registry dei driver supportati
+        self._queues: Dict[str, _CommandQueue] = {}
+        self._last_used: Dict[str, float] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._tasks: List[asyncio.Task] = []
+        # Poller: ultimo stato letto, intervallo corrente e prossima lettura di ogni dispositivo
+        self._polled_state: Dict[str, Dict[str, Any]] = {}
+        self._poll_interval: Dict[str, float] = {}
+        self._next_poll: Dict[str, float] = {}
+        self._polling: Dict[str, asyncio.Task] = {}
+        self._on_state_change: Optional[StateChangeCallback] = None
 
     @classmethod
     def get_instance(cls):
@@ -57,6 +105,168 @@ class DeviceManager:
         self.device_types[type_name] = driver_class
         logger.info(f"Registered driver type: {type_name}")
 
+    def start(self, preload: Optional[List[Tuple[str, str, Dict[str, Any]]]] = None,
+              on_state_change: Optional[StateChangeCallback] = None):
+        """
+        Avvia l'eviction dei driver inattivi, in background il precaricamento di `preload`
+        e, con `on_state_change`, il poller dello stato dei dispositivi
+        """
+        self._tasks.append(asyncio.create_task(self._evict_loop()))
+        if preload:
+            self._tasks.append(asyncio.create_task(self.preload(preload)))
+        if on_state_change is not None and settings.DEVICE_POLL_ENABLED:
+            self._on_state_change = on_state_change
+            self._tasks.append(asyncio.create_task(self._poll_loop()))
+
+    async def stop(self):
+        """Ferma i task in background e disconnette tutti i driver"""
+        tasks = self._tasks + list(self._polling.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._polling = {}
+        for device_id in list(self.drivers):
+            await self.unload_device(device_id)
+
+    async def _evict_loop(self):
+        interval = min(60.0, settings.DEVICE_DRIVER_IDLE_TIMEOUT)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_idle()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Driver eviction failed: {e}")
+
+    # --- Poller ---
+
+    def _poll_soon(self, device_id: str):
+        """Torna all'intervallo veloce (dopo un comando o un cambiamento di stato)"""
+        self._poll_interval[device_id] = settings.DEVICE_POLL_FAST_INTERVAL
+        self._next_poll[device_id] = time.monotonic() + settings.DEVICE_POLL_FAST_INTERVAL
+
+    async def _poll_loop(self):
+        tick = min(1.0, settings.DEVICE_POLL_FAST_INTERVAL)
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                self._schedule_polls()
+            except Exception as e:
+                logger.error(f"❌ Device polling failed: {e}")
+
+    def _schedule_polls(self):
+        budget = settings.DEVICE_POLL_CONCURRENCY - len(self._polling)
+        if budget <= 0:
+            return
+        now = time.monotonic()
+        # Niente letture durante un comando: lo stato è a metà e lo notifica chi ha inviato il comando
+        due = [
+            device_id for device_id in self.drivers
+            if device_id not in self._polling and device_id not in self._queues
+            and self._next_poll.get(device_id, now) <= now
+        ]
+        due.sort(key=lambda device_id: self._next_poll.get(device_id, now))
+        for device_id in due[:budget]:
+            task = asyncio.create_task(self._poll(device_id))
+            self._polling[device_id] = task
+            task.add_done_callback(lambda _, device_id=device_id: self._polling.pop(device_id, None))
+
+    async def _poll(self, device_id: str):
+        driver = self.drivers.get(device_id)
+        if driver is None:
+            return
+        interval = self._poll_interval.get(device_id, settings.DEVICE_POLL_FAST_INTERVAL)
+        started = time.monotonic()
+        try:
+            state = await asyncio.wait_for(driver.get_state(), settings.DEVICE_COMMAND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Polling device {device_id} failed: {e}")
+            state = None
+        if device_id not in self.drivers:
+            return  # Disconnesso durante la lettura
+        if device_id in self._queues or self._last_used.get(device_id, 0) > started:
+            return  # Un comando nel frattempo: la lettura potrebbe essere vecchia
+        if state is None or state == self._polled_state.get(device_id):
+            interval = min(interval * 2, settings.DEVICE_POLL_SLOW_INTERVAL)
+        else:
+            self._polled_state[device_id] = copy.deepcopy(state)
+            interval = settings.DEVICE_POLL_FAST_INTERVAL
+            try:
+                await self._on_state_change(device_id, copy.deepcopy(state))
+            except Exception as e:
+                logger.error(f"❌ State change handler failed for device {device_id}: {e}")
+        self._poll_interval[device_id] = interval
+        self._next_poll[device_id] = time.monotonic() + interval
+
+    def _touch(self, device_id: str):
+        if device_id in self.drivers:
+            self.drivers.move_to_end(device_id)
+            self._last_used[device_id] = time.monotonic()
+
+    def _evictable(self, device_id: str) -> bool:
+        return device_id not in self._queues
+
+    async def evict_idle(self) -> int:
+        """Disconnette i driver inutilizzati da più di DEVICE_DRIVER_IDLE_TIMEOUT secondi"""
+        cutoff = time.monotonic() - settings.DEVICE_DRIVER_IDLE_TIMEOUT
+        idle = [
+            device_id for device_id in self.drivers
+            if self._last_used.get(device_id, 0) < cutoff and self._evictable(device_id)
+        ]
+        for device_id in idle:
+            await self.unload_device(device_id)
+        if idle:
+            logger.info(f"Evicted {len(idle)} idle device drivers")
+        return len(idle)
+
+    async def _evict_over_capacity(self):
+        while len(self.drivers) > settings.DEVICE_DRIVERS_MAX:
+            # OrderedDict: il primo evictable è il meno usato di recente
+            victim = next((device_id for device_id in self.drivers if self._evictable(device_id)), None)
+            if victim is None:
+                return
+            await self.unload_device(victim)
+
+    async def ensure_device(self, device_id: str, device_type: str, config: Dict[str, Any]) -> bool:
+        """
+        Carica il driver se non è già attivo. Chiamate concorrenti per lo stesso dispositivo
+        condividono la stessa connessione; se il chiamante rinuncia (timeout) il caricamento
+        prosegue comunque.
+        """
+        if device_id in self.drivers:
+            self._touch(device_id)
+            return True
+        task = self._loading.get(device_id)
+        if task is None:
+            task = asyncio.create_task(self.load_device(device_id, device_type, config))
+            self._loading[device_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(device_id, None))
+        return await asyncio.shield(task)
+
+    async def preload(self, devices: List[Tuple[str, str, Dict[str, Any]]]) -> int:
+        """Carica in parallelo i driver di (device_id, device_type, config), es. i dispositivi usati di recente"""
+        semaphore = asyncio.Semaphore(max(settings.DEVICE_COMMAND_CONCURRENCY, 1))
+
+        async def load(device_id: str, device_type: str, config: Dict[str, Any]) -> bool:
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(
+                        self.ensure_device(device_id, device_type, config), settings.DEVICE_COMMAND_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning(f"Preload of device {device_id} timed out")
+                    return False
+
+        devices = devices[:settings.DEVICE_DRIVERS_MAX]
+        started = time.monotonic()
+        loaded = sum(await asyncio.gather(*(load(*device) for device in devices)))
+        logger.info(f"✅ Preloaded {loaded}/{len(devices)} device drivers in {time.monotonic() - started:.2f}s")
+        return loaded
+
     async def load_device(self, device_id: str, device_type: str, config: Dict[str, Any]) -> bool:
         """Inizializza un driver per un dispositivo"""
         if device_type not in self.device_types:
@@ -69,7 +279,9 @@ class DeviceManager:
             connected = await driver.connect()
             if connected:
                 self.drivers[device_id] = driver
+                self._touch(device_id)
                 logger.info(f"Device loaded: {device_id} ({device_type})")
+                await self._evict_over_capacity()
                 return True
             else:
                 logger.warning(f"Failed to connect to device: {device_id}")
@@ -79,20 +291,125 @@ class DeviceManager:
             return False
 
     async def unload_device(self, device_id: str):
-        if device_id in self.drivers:
-            await self.drivers[device_id].disconnect()
-            del self.drivers[device_id]
+        driver = self.drivers.pop(device_id, None)
+        self._last_used.pop(device_id, None)
+        for poll_data in (self._polled_state, self._poll_interval, self._next_poll):
+            poll_data.pop(device_id, None)
+        if driver is not None:
+            try:
+                await driver.disconnect()
+            except Exception as e:
+                logger.warning(f"Error disconnecting device {device_id}: {e}")
             logger.info(f"Device unloaded: {device_id}")
 
     async def get_device_state(self, device_id: str) -> Optional[Dict[str, Any]]:
         if device_id in self.drivers:
+            self._touch(device_id)
             return await self.drivers[device_id].get_state()
         return None
 
-    async def send_command(self, device_id: str, command: Dict[str, Any]) -> bool:
-        if device_id in self.drivers:
-            logger.info(f"Sending command to {device_id}: {command}")
-            return await self.drivers[device_id].set_state(command)
-        else:
+    async def submit_command(self, device_id: str, command: Dict[str, Any]) -> Tuple[bool, bool]:
+        """
+        Accoda un comando al dispositivo e attende che venga applicato. I comandi di un
+        dispositivo arrivano al driver uno alla volta e nell'ordine di arrivo; quelli che
+        si accumulano mentre il driver è occupato vengono fusi in un solo set_state (per
+        ogni parametro vince l'ultimo valore, es. la luminosità di uno slider).
+
+        Restituisce (successo, ultimo): `ultimo` è True per il chiamante il cui comando è
+        stato fuso per ultimo nel blocco, l'unico che deve salvare e notificare lo stato.
+        Solleva CommandQueueFull oltre DEVICE_COMMAND_QUEUE_MAX comandi in attesa.
+        """
+        if device_id not in self.drivers:
             logger.warning(f"Device {device_id} not connected or driver not loaded")
-            return False
+            return False, True
+        
+        self._touch(device_id)
+        self._poll_soon(device_id)
+        queue = self._queues.setdefault(device_id, _CommandQueue())
+        if queue.waiting >= settings.DEVICE_COMMAND_QUEUE_MAX:
+            raise CommandQueueFull(f"Too many pending commands for device {device_id}")
+        
+        waiter = asyncio.get_running_loop().create_future()
+        if queue.pending is None:
+            queue.pending = dict(command)
+        else:
+            queue.pending.update(command)
+        queue.waiters.append(waiter)
+        queue.waiting += 1
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._drain(device_id, queue))
+        return await waiter
+
+    async def _drain(self, device_id: str, queue: _CommandQueue):
+        """Applica i blocchi di comandi del dispositivo finché ce ne sono in sospeso"""
+        while queue.pending is not None:
+            command, waiters = queue.pending, queue.waiters
+            queue.pending, queue.waiters = None, []
+            try:
+                driver = self.drivers.get(device_id)
+                if driver is None:
+                    result, error = False, None
+                else:
+                    logger.info(f"Sending command to {device_id}: {command} ({len(waiters)} merged)")
+                    result, error = await driver.set_state(command), None
+            except Exception as e:
+                result, error = False, e
+            for i, waiter in enumerate(waiters):
+                if waiter.done():
+                    continue  # Chiamante andato via (timeout): il comando è applicato comunque
+                if error is not None:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result((result, i == len(waiters) - 1))
+            queue.waiting -= len(waiters)
+        queue.worker = None
+        if self._queues.get(device_id) is queue:
+            del self._queues[device_id]
+
+    async def send_command(self, device_id: str, command: Dict[str, Any]) -> bool:
+        success, _ = await self.submit_command(device_id, command)
+        return success
+
+    async def _command_with_state(self, device_id: str, command: Dict[str, Any],
+                                  spec: Optional[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+        if spec is not None:
+            await self.ensure_device(device_id, *spec)
+        if device_id not in self.drivers:
+            return {"status": "failed", "state": None, "error": "Driver not loaded"}
+        if not await self.send_command(device_id, command):
+            return {"status": "failed", "state": None, "error": "Command rejected by device"}
+        return {"status": "ok", "state": await self.get_device_state(device_id), "error": None}
+
+    async def send_commands(
+        self,
+        commands: Dict[str, Dict[str, Any]],
+        specs: Optional[Dict[str, Tuple[str, Dict[str, Any]]]] = None,
+        concurrency: int = 20,
+        timeout: float = 5.0
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Invia i comandi {device_id: params} in parallelo, al massimo `concurrency` driver
+        alla volta, e restituisce per ogni dispositivo status (ok | failed | timeout), stato
+        ed errore. `specs` indica (device_type, config) per caricare i driver mancanti.
+        Il timeout vale per dispositivo (caricamento del driver compreso): uno lento non
+        blocca gli altri, il tempo totale è quello del più lento.
+        """
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        specs = specs or {}
+
+        async def run(device_id: str, command: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(
+                        self._command_with_state(device_id, command, specs.get(device_id)), timeout
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning(f"Command to {device_id} timed out after {timeout}s")
+                    return {"status": "timeout", "state": None, "error": f"No response within {timeout}s"}
+                except Exception as e:
+                    logger.error(f"Command to {device_id} failed: {e}")
+                    return {"status": "failed", "state": None, "error": str(e)}
+
+        device_ids = list(commands)
+        results = await asyncio.gather(*(run(device_id, commands[device_id]) for device_id in device_ids))
+        return dict(zip(device_ids, results))
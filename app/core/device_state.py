@@ -0,0 +1,230 @@
+"""Cache write-behind dei dispositivi: stato e proprietario in memoria (o Redis), scritti su Supabase a intervalli"""
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import copy
+import json
+import logging
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = "synthetix:device:"
+REDIS_DIRTY_KEY = "synthetix:devices:dirty"
+
+
+class DeviceStateCache:
+    """
+    Record dei dispositivi (proprietario e stato) letti da Supabase una volta e poi serviti
+    dalla cache, che è la fonte autorevole dello stato: un comando aggiorna solo la cache
+    e segna il dispositivo come da salvare. Ogni DEVICE_STATE_FLUSH_INTERVAL secondi i
+    dispositivi modificati vengono scritti su Supabase con un unico upsert, qualunque
+    sia il numero di comandi ricevuti nel frattempo (vince l'ultimo stato).
+
+    Con Redis i record e l'insieme dei dispositivi da salvare stanno su Redis, condivisi
+    tra i worker; senza, in memoria nel processo. Dagli handler async i metodi si chiamano
+    con run(), che con Redis li esegue nel threadpool.
+    """
+
+    def __init__(self, supabase, redis=None):
+        self.supabase = supabase
+        self.redis = redis
+        self._records: Dict[str, dict] = {}
+        self._dirty: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Ferma il flush periodico e salva gli stati ancora in sospeso"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.DEVICE_STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Device state flush failed: {e}")
+
+    async def run(self, method: Callable, *args, **kwargs):
+        """
+        Esegue un metodo della cache da codice async: con Redis nel threadpool (ogni accesso
+        è una chiamata di rete), in memoria direttamente nel loop, dove record e insieme
+        dei dispositivi da salvare si modificano senza lock
+        """
+        if self.redis is None:
+            return method(*args, **kwargs)
+        return await run_in_threadpool(method, *args, **kwargs)
+
+    # --- Archivio: Redis se disponibile, altrimenti memoria ---
+
+    def _read(self, device_id: str) -> Optional[dict]:
+        if self.redis is None:
+            return self._records.get(device_id)
+        raw = self.redis.get(REDIS_KEY_PREFIX + device_id)
+        return json.loads(raw) if raw else None
+
+    def _write(self, record: dict, dirty: bool = False):
+        device_id = str(record["id"])
+        if self.redis is None:
+            self._records[device_id] = record
+            if dirty:
+                self._dirty.add(device_id)
+            return
+        pipe = self.redis.pipeline()
+        pipe.set(REDIS_KEY_PREFIX + device_id, json.dumps(record, default=str))
+        if dirty:
+            pipe.sadd(REDIS_DIRTY_KEY, device_id)
+        pipe.execute()
+
+    def _take_dirty(self) -> List[str]:
+        """Dispositivi da salvare, rimossi dall'insieme (un nuovo comando li rimette)"""
+        if self.redis is None:
+            dirty, self._dirty = list(self._dirty), set()
+            return dirty
+        count = self.redis.scard(REDIS_DIRTY_KEY)
+        return self.redis.spop(REDIS_DIRTY_KEY, count) if count else []
+
+    def _mark_dirty(self, device_ids: List[str]):
+        if self.redis is None:
+            self._dirty.update(device_ids)
+        elif device_ids:
+            self.redis.sadd(REDIS_DIRTY_KEY, *device_ids)
+
+    def _is_dirty(self, device_id: str) -> bool:
+        if self.redis is None:
+            return device_id in self._dirty
+        return bool(self.redis.sismember(REDIS_DIRTY_KEY, device_id))
+
+    # --- API ---
+
+    def get(self, device_id: str, user_id: str) -> Optional[dict]:
+        """Record del dispositivo se appartiene all'utente (None altrimenti); Supabase solo al primo accesso"""
+        record = self._read(device_id)
+        if record is None:
+            result = self.supabase.table("devices").select("*").eq("id", device_id).execute()
+            if not result.data:
+                return None
+            record = copy.deepcopy(result.data[0])
+            self._write(record)
+        if str(record.get("user_id")) != str(user_id):
+            return None
+        # Copia: i record in memoria si modificano solo tramite la cache
+        return copy.deepcopy(record)
+
+    def get_many(self, device_ids: List[str], user_id: str) -> Dict[str, dict]:
+        """Come get() per più dispositivi, con una sola query su Supabase per quelli non in cache"""
+        records = {device_id: self._read(device_id) for device_id in dict.fromkeys(device_ids)}
+        missing = [device_id for device_id, record in records.items() if record is None]
+        if missing:
+            result = self.supabase.table("devices").select("*").in_("id", missing).execute()
+            for row in result.data:
+                record = copy.deepcopy(row)
+                self._write(record)
+                records[str(record["id"])] = record
+        return {
+            device_id: copy.deepcopy(record)
+            for device_id, record in records.items()
+            if record is not None and str(record.get("user_id")) == str(user_id)
+        }
+
+    def update_state(self, device_id: str, state: Dict[str, Any]) -> dict:
+        """Aggiorna stato e last_seen nella cache; verranno salvati al prossimo flush"""
+        record = self._read(device_id)
+        if record is None:
+            raise KeyError(device_id)
+        record["state"] = copy.deepcopy(state)
+        record["last_seen"] = datetime.utcnow().isoformat()
+        self._write(record, dirty=True)
+        return copy.deepcopy(record)
+
+    def refresh_state(self, device_id: str, state: Dict[str, Any]) -> bool:
+        """
+        Come update_state() ma solo se lo stato è diverso da quello in cache (es. letto dal
+        poller); False se è uguale o il dispositivo non è in cache
+        """
+        record = self._read(device_id)
+        if record is None or record.get("state") == state:
+            return False
+        self.update_state(device_id, state)
+        return True
+
+    def put(self, record: dict, keep_state: bool = True):
+        """
+        Aggiorna la cache dopo una modifica scritta direttamente su Supabase. Con `keep_state`
+        (la modifica non riguardava lo stato) resta lo stato in cache non ancora salvato.
+        """
+        device_id = str(record["id"])
+        cached = self._read(device_id)
+        record = copy.deepcopy(record)
+        if keep_state and cached is not None and self._is_dirty(device_id):
+            record["state"] = cached.get("state")
+            record["last_seen"] = cached.get("last_seen")
+        self._write(record)
+
+    def invalidate(self, device_id: str):
+        if self.redis is None:
+            self._records.pop(device_id, None)
+            self._dirty.discard(device_id)
+            return
+        pipe = self.redis.pipeline()
+        pipe.delete(REDIS_KEY_PREFIX + device_id)
+        pipe.srem(REDIS_DIRTY_KEY, device_id)
+        pipe.execute()
+
+    def overlay(self, records: List[dict]) -> List[dict]:
+        """Sostituisce stato e last_seen dei record letti da Supabase con quelli non ancora salvati"""
+        for record in records:
+            device_id = str(record["id"])
+            if not self._is_dirty(device_id):
+                continue
+            cached = self._read(device_id)
+            if cached is not None:
+                record["state"] = cached.get("state")
+                record["last_seen"] = cached.get("last_seen")
+        return records
+
+    def _dirty_records(self) -> List[dict]:
+        return [copy.deepcopy(record) for record in map(self._read, self._take_dirty()) if record is not None]
+
+    def _persist(self, records: List[dict]) -> List[str]:
+        """
+        Scrive gli stati su Supabase con un solo upsert (bloccante); restituisce i
+        dispositivi non salvati. Le righe sono i record completi in cache: un upsert
+        con le sole colonne dello stato violerebbe i NOT NULL del ramo insert.
+        """
+        device_ids = [str(record["id"]) for record in records]
+        try:
+            self.supabase.table("devices").upsert(records, on_conflict="id").execute()
+        except Exception as e:
+            logger.warning(f"Could not persist state of {len(records)} devices: {e}")
+            return device_ids
+        # Un dispositivo eliminato durante il flush (invalidate) sarebbe stato reinserito
+        deleted = [device_id for device_id in device_ids if self._read(device_id) is None]
+        if deleted:
+            try:
+                self.supabase.table("devices").delete().in_("id", deleted).execute()
+            except Exception as e:
+                logger.error(f"❌ Could not remove devices deleted during flush {deleted}: {e}")
+        return []
+
+    async def flush(self) -> int:
+        """Scrive su Supabase gli stati modificati dall'ultimo flush; restituisce quanti"""
+        # In memoria insieme e record si leggono nel loop, dove li modificano i comandi
+        records = await self.run(self._dirty_records)
+        if not records:
+            return 0
+        failed = await run_in_threadpool(self._persist, records)
+        # Riprova al prossimo flush
+        await self.run(self._mark_dirty, failed)
+        return len(records) - len(failed)
@@ -0,0 +1,96 @@
+"""
+Risposte di download: streaming da Python o offload al reverse proxy.
+
+Esempio di location nginx per DOWNLOAD_OFFLOAD=x-accel:
+
+    location /protected-storage/ {
+        internal;
+        alias /app/storage/;  # STORAGE_PATH
+        sendfile on;
+    }
+
+Ogni volume aggiuntivo (STORAGE_VOLUMES) ha la sua location, con il nome del volume
+in coda al prefisso: /protected-storage-disk2/ -> alias /mnt/disk2/.
+
+Il proxy apre i blob con il proprio utente: i blob sono creati 0666 meno la umask
+del processo, che deve lasciare la lettura al gruppo o agli altri (es. 022), oppure
+il proxy deve girare con lo stesso utente dell'app. Altrimenti nginx risponde 403.
+"""
+from datetime import datetime
+from typing import Optional
+from urllib.parse import quote
+from fastapi import Request
+from fastapi.responses import Response
+import os
+import stat
+
+from app.core.codecs import codec_for_path
+from app.core.config import settings
+from app.core.http_ranges import ranged_file_response, content_disposition, make_etag
+from app.core.storage import FILE_MODE
+from app.core.volumes import PRIMARY, storage_volumes
+
+
+def offload_prefix(volume_name: str) -> str:
+    """Location interna del proxy che corrisponde alla radice di un volume"""
+    prefix = settings.DOWNLOAD_OFFLOAD_PREFIX.rstrip("/")
+    return prefix if volume_name == PRIMARY else f"{prefix}-{volume_name}"
+
+
+def offload_response(path: str, filename: str, media_type: Optional[str], checksum: Optional[str]) -> Optional[Response]:
+    """
+    Delega l'invio dei byte al proxy (nginx X-Accel-Redirect o X-Sendfile),
+    che li serve con sendfile() gestendo anche Range e richieste condizionali.
+    Restituisce None se l'offload è disabilitato o non applicabile: i blob compressi
+    vanno decompressi (o negoziati con Accept-Encoding) e li serve sempre l'app.
+    """
+    mode = settings.DOWNLOAD_OFFLOAD
+    if mode not in ("x-accel", "x-sendfile") or codec_for_path(path) is not None:
+        return None
+
+    location = storage_volumes.relative_path(path)
+    if location is None:
+        return None
+    volume_name, relative = location
+
+    st = os.stat(path)
+    missing = FILE_MODE & ~stat.S_IMODE(st.st_mode)
+    if missing:
+        # Blob salvati quando i temporanei restavano 0600: il proxy non potrebbe leggerli
+        try:
+            os.chmod(path, stat.S_IMODE(st.st_mode) | missing)
+        except OSError:
+            return None
+
+    headers = {
+        "Content-Disposition": content_disposition(filename),
+        "ETag": make_etag(checksum, st),
+    }
+    if mode == "x-accel":
+        headers["X-Accel-Redirect"] = f"{offload_prefix(volume_name)}/{quote(relative)}"
+    else:
+        headers["X-Sendfile"] = os.path.abspath(path)
+
+    return Response(media_type=media_type or "application/octet-stream", headers=headers)
+
+
+def file_download_response(
+    request: Request,
+    path: str,
+    filename: str,
+    media_type: Optional[str] = None,
+    checksum: Optional[str] = None,
+    last_modified: Optional[datetime] = None
+) -> Response:
+    """Usa l'offload del proxy se configurato, altrimenti serve il file con supporto Range/ETag"""
+    response = offload_response(path, filename, media_type, checksum)
+    if response is not None:
+        return response
+    return ranged_file_response(
+        request,
+        path=path,
+        filename=filename,
+        media_type=media_type,
+        checksum=checksum,
+        last_modified=last_modified
+    )
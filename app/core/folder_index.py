@@ -0,0 +1,176 @@
+"""Indice delle cartelle virtuali con dimensioni aggregate"""
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import text, bindparam
+from sqlalchemy.engine import Engine, Connection
+import logging
+import posixpath
+
+logger = logging.getLogger(__name__)
+
+ROOT = "/"
+
+
+def normalize_virtual_path(path: str) -> str:
+    """
+    Normalizza un path virtuale: inizia con '/', senza '//' né '/' finale.
+    Solleva ValueError per path vuoti o con segmenti '.'/'..'.
+    """
+    parts = [p for p in path.replace("\\", "/").split("/") if p]
+    if not parts:
+        raise ValueError("Path cannot be empty")
+    if any(p in (".", "..") for p in parts):
+        raise ValueError("Path cannot contain '.' or '..' segments")
+    return "/" + "/".join(parts)
+
+
+def parent_folder(path: str) -> Optional[str]:
+    """Cartella che contiene `path` (None per la root)"""
+    if path == ROOT:
+        return None
+    return posixpath.dirname(path) or ROOT
+
+
+def ancestor_folders(file_path: str) -> List[str]:
+    """Cartelle che contengono il file, dalla root alla più profonda"""
+    folders = []
+    folder = parent_folder(file_path)
+    while folder is not None:
+        folders.append(folder)
+        folder = parent_folder(folder)
+    return list(reversed(folders))
+
+
+class FolderIndex:
+    """
+    Tabella `folders` sul DB locale: per ogni cartella virtuale di un utente
+    tiene byte e numero di file complessivi (sottocartelle incluse).
+    Viene aggiornata in modo incrementale a ogni upload, delete e move,
+    toccando solo le cartelle antenate del file: O(profondità).
+    La riga della root esiste sempre per un utente indicizzato e fornisce
+    l'uso totale dello storage in O(1).
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+
+    @staticmethod
+    def _has_root(conn: Connection, user_id: str) -> bool:
+        row = conn.execute(
+            text("SELECT 1 FROM folders WHERE user_id = :user_id AND path = :root"),
+            {"user_id": user_id, "root": ROOT},
+        ).first()
+        return row is not None
+
+    def is_indexed(self, user_id: str) -> bool:
+        with self.engine.connect() as conn:
+            return self._has_root(conn, user_id)
+
+    def _apply(self, conn: Connection, user_id: str, file_path: str, size_delta: int, count_delta: int):
+        folders = ancestor_folders(file_path)
+        for folder in folders:
+            conn.execute(
+                text(
+                    "INSERT INTO folders (user_id, path, parent_path, total_size, file_count) "
+                    "VALUES (:user_id, :path, :parent, :size, :count) "
+                    "ON CONFLICT (user_id, path) DO UPDATE SET "
+                    "total_size = folders.total_size + :size, file_count = folders.file_count + :count"
+                ),
+                {
+                    "user_id": user_id,
+                    "path": folder,
+                    "parent": parent_folder(folder),
+                    "size": size_delta,
+                    "count": count_delta,
+                },
+            )
+        if count_delta < 0:
+            # Le cartelle esistono solo finché contengono file (la root resta sempre)
+            conn.execute(
+                text(
+                    "DELETE FROM folders WHERE user_id = :user_id AND path IN :paths "
+                    "AND file_count <= 0 AND path <> :root"
+                ).bindparams(bindparam("paths", expanding=True)),
+                {"user_id": user_id, "paths": folders, "root": ROOT},
+            )
+
+    def _update(self, user_id: str, changes: List[Tuple[str, int, int]]):
+        """
+        Applica le variazioni (file_path, size_delta, count_delta) in un'unica transazione.
+        Se fallisce, l'indice dell'utente viene scartato e sarà ricostruito dal catalogo.
+        """
+        try:
+            with self.engine.begin() as conn:
+                if not self._has_root(conn, user_id):
+                    # Utente non ancora indicizzato: l'indice sarà costruito dal catalogo al primo accesso
+                    return
+                for file_path, size_delta, count_delta in changes:
+                    self._apply(conn, user_id, file_path, size_delta, count_delta)
+        except Exception as e:
+            logger.error(f"Folder index update failed for user {user_id}, dropping index: {e}")
+            self.invalidate(user_id)
+
+    def add_file(self, user_id: str, file_path: str, size: int):
+        self._update(user_id, [(file_path, size, 1)])
+
+    def remove_file(self, user_id: str, file_path: str, size: int):
+        self._update(user_id, [(file_path, -size, -1)])
+
+    def move_file(self, user_id: str, old_path: str, new_path: str, size: int):
+        self._update(user_id, [(old_path, -size, -1), (new_path, size, 1)])
+
+    def invalidate(self, user_id: str):
+        """Elimina l'indice dell'utente (verrà ricostruito al prossimo accesso)"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("DELETE FROM folders WHERE user_id = :user_id"), {"user_id": user_id})
+        except Exception as e:
+            logger.error(f"Could not drop folder index for user {user_id}: {e}")
+
+    def rebuild(self, user_id: str, files: Iterable[Tuple[str, int]]):
+        """Ricostruisce l'indice di un utente a partire da (path, size) di tutti i suoi file"""
+        totals: Dict[str, List[int]] = {ROOT: [0, 0]}
+        for file_path, size in files:
+            for folder in ancestor_folders(file_path):
+                entry = totals.setdefault(folder, [0, 0])
+                entry[0] += size or 0
+                entry[1] += 1
+
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM folders WHERE user_id = :user_id"), {"user_id": user_id})
+            conn.execute(
+                text(
+                    "INSERT INTO folders (user_id, path, parent_path, total_size, file_count) "
+                    "VALUES (:user_id, :path, :parent, :size, :count)"
+                ),
+                [
+                    {"user_id": user_id, "path": path, "parent": parent_folder(path), "size": size, "count": count}
+                    for path, (size, count) in totals.items()
+                ],
+            )
+        logger.info(f"Folder index rebuilt for user {user_id}: {len(totals)} folders")
+
+    def get_folders(self, user_id: str, paths: List[str]) -> Dict[str, dict]:
+        """Statistiche delle cartelle richieste, indicizzate per path"""
+        if not paths:
+            return {}
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT path, total_size, file_count FROM folders "
+                    "WHERE user_id = :user_id AND path IN :paths"
+                ).bindparams(bindparam("paths", expanding=True)),
+                {"user_id": user_id, "paths": paths},
+            ).mappings().all()
+        return {row["path"]: dict(row) for row in rows}
+
+    def list_children(self, user_id: str, path: str) -> List[dict]:
+        """Sottocartelle dirette di `path`, ordinate per path"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT path, total_size, file_count FROM folders "
+                    "WHERE user_id = :user_id AND parent_path = :path ORDER BY path"
+                ),
+                {"user_id": user_id, "path": path},
+            ).mappings().all()
+        return [dict(row) for row in rows]
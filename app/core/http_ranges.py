@@ -0,0 +1,287 @@
+"""Supporto a Range, ETag e GET condizionali per i download"""
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import quote
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+import os
+import uuid
+
+from app.core.codecs import CODECS, CodecError, codec_for_path, open_content
+from app.core.config import settings
+
+ByteRange = Tuple[int, int]  # (start, end) inclusivi
+
+
+class RangeNotSatisfiable(Exception):
+    """Nessuno dei range richiesti cade dentro il file (o ne sono richiesti troppi)"""
+
+
+def parse_range_header(value: str, size: int) -> Optional[List[ByteRange]]:
+    """
+    Interpreta un header Range (RFC 9110).
+    Restituisce None se l'header è malformato (va ignorato e si risponde 200),
+    solleva RangeNotSatisfiable se nessun range è soddisfacibile o se ne sono richiesti
+    più di DOWNLOAD_MAX_RANGES. I range sovrapposti o adiacenti vengono uniti.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    # Migliaia di range minuscoli moltiplicano parti multipart e seek (decompressioni per i blob compressi)
+    if spec.count(",") >= settings.DOWNLOAD_MAX_RANGES:
+        raise RangeNotSatisfiable()
+
+    ranges: List[ByteRange] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start_s, sep, end_s = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if not start_s:
+                # Suffix range: ultimi N byte
+                suffix = int(end_s)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+            else:
+                start = int(start_s)
+                end = int(end_s) if end_s else None
+                if end is not None and start > end:
+                    return None
+                if start >= size:
+                    continue
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+        if size > 0:
+            ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_etag(checksum: Optional[str], stat_result: os.stat_result, content_encoding: Optional[str] = None) -> str:
+    """
+    ETag forte dal checksum del contenuto, debole da size/mtime per i file legacy.
+    La rappresentazione compressa (Content-Encoding) ha byte diversi e quindi un ETag diverso.
+    """
+    if checksum:
+        return f'"{checksum}-{content_encoding}"' if content_encoding else f'"{checksum}"'
+    return f'W/"{stat_result.st_size:x}-{int(stat_result.st_mtime):x}"'
+
+
+def _representation_tag(etag: str) -> str:
+    """
+    ETag senza W/ e senza il suffisso della codifica: la rappresentazione compressa e
+    quella decompressa dello stesso contenuto devono validarsi a vicenda
+    """
+    tag = etag.strip().removeprefix("W/")
+    for codec in CODECS.values():
+        suffix = f'-{codec.content_encoding}"'
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Confronto debole degli ETag, come richiesto per If-None-Match, indipendente dalla codifica"""
+    if header.strip() == "*":
+        return True
+    bare = _representation_tag(etag)
+    return any(_representation_tag(candidate) == bare for candidate in header.split(","))
+
+
+def _parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Valuta If-None-Match (prioritario) e If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        since = _parse_http_date(if_modified_since)
+        if since is not None:
+            return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def accepts_encoding(request: Request, coding: str) -> bool:
+    """True se Accept-Encoding ammette esplicitamente `coding` (con q > 0)"""
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() != coding:
+            continue
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _if_range_allows(request: Request, etag: str, last_modified: datetime) -> bool:
+    """If-Range: il Range si applica solo se il validatore corrisponde ancora"""
+    if_range = request.headers.get("if-range")
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Serve un confronto forte
+        return not etag.startswith("W/") and if_range == etag
+    since = _parse_http_date(if_range)
+    return since is not None and last_modified.replace(microsecond=0) == since
+
+
+def _iter_file(path: str, start: int, length: int, decode: bool = True) -> Iterator[bytes]:
+    """
+    Legge `length` byte da `start` a blocchi (eseguito nel threadpool da StreamingResponse).
+    Per un blob compresso gli offset sono quelli del contenuto originale, che viene
+    decompresso al volo: la seek in avanti decomprime e scarta i byte precedenti.
+    """
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+    with (open_content(path) if decode else open(path, "rb")) as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _iter_multipart(path: str, parts: List[Tuple[bytes, int, int]], closing: bytes) -> Iterator[bytes]:
+    for header, start, end in parts:
+        yield header
+        yield from _iter_file(path, start, end - start + 1)
+        yield b"\r\n"
+    yield closing
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def ranged_file_response(
+    request: Request,
+    path: str,
+    filename: str,
+    media_type: Optional[str] = None,
+    checksum: Optional[str] = None,
+    last_modified: Optional[datetime] = None
+) -> Response:
+    """
+    Risponde a un download gestendo 304 Not Modified, 206 Partial Content
+    (anche multi-range con multipart/byteranges) e 416 per range non validi.
+    Un blob compresso viene inviato così com'è con Content-Encoding se il client lo
+    accetta e non chiede un Range, altrimenti viene decompresso in streaming.
+    """
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    media_type = media_type or "application/octet-stream"
+    codec = codec_for_path(path)
+    passthrough = False
+    if codec is not None:
+        passthrough = not request.headers.get("range") and accepts_encoding(request, codec.content_encoding)
+        if not passthrough:
+            size = codec.content_size(path)
+            if size is None:
+                raise CodecError(f"Unknown content size of {path}")
+    etag = make_etag(checksum, stat_result, codec.content_encoding if passthrough else None)
+    if last_modified is None:
+        last_modified = datetime.fromtimestamp(stat_result.st_mtime, tz=timezone.utc)
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.astimezone(timezone.utc), usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+    if codec is not None:
+        headers["Vary"] = "Accept-Encoding"
+
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Disposition"] = content_disposition(filename)
+
+    ranges = None
+    range_header = request.headers.get("range")
+    if range_header and _if_range_allows(request, etag, last_modified):
+        try:
+            ranges = parse_range_header(range_header, size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+    if passthrough:
+        headers["Content-Encoding"] = codec.content_encoding
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_iter_file(path, 0, size, decode=False), media_type=media_type, headers=headers)
+
+    if not ranges:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_iter_file(path, 0, size), media_type=media_type, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            _iter_file(path, start, end - start + 1),
+            status_code=206,
+            media_type=media_type,
+            headers=headers
+        )
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for start, end in ranges:
+        part_header = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode()
+        parts.append((part_header, start, end))
+        content_length += len(part_header) + (end - start + 1) + 2
+    closing = f"--{boundary}--\r\n".encode()
+    content_length += len(closing)
+
+    headers["Content-Length"] = str(content_length)
+    return StreamingResponse(
+        _iter_multipart(path, parts, closing),
+        status_code=206,
+        media_type=f"multipart/byteranges; boundary={boundary}",
+        headers=headers
+    )
@@ -0,0 +1,75 @@
+"""Pool di thread per l'I/O su disco e l'hashing, fuori dall'event loop"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import asyncio
+import functools
+import logging
+import time
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StorageIOPool:
+    """
+    Esegue le operazioni bloccanti dello storage (scritture, fsync, rename, unlink, hashing)
+    su un pool di thread dedicato e limitato, separato dal threadpool di Starlette.
+
+    Il numero di operazioni in attesa è limitato da un semaforo: quando il disco non tiene
+    il passo, un upload attende prima di leggere altri byte dalla rete (backpressure) invece
+    di accumulare buffer in memoria. L'event loop resta libero per WebSocket e dispositivi.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="storage-io")
+            self._slots = asyncio.Semaphore(self.max_pending)
+            logger.info(f"Storage I/O pool started ({self.max_workers} workers, {self.max_pending} pending)")
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Esegue `func` nel pool, attendendo uno slot libero se la coda è piena"""
+        self._ensure_started()
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        """Attende le operazioni in corso e chiude il pool (viene ricreato al primo uso)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+
+
+storage_io = StorageIOPool(settings.STORAGE_IO_WORKERS, settings.STORAGE_IO_MAX_PENDING)
+
+
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """Scorciatoia per storage_io.run"""
+    return await storage_io.run(func, *args, **kwargs)
+
+
+class Throttle:
+    """Token bucket sui byte letti: limita la banda media dei job in background (burst massimo di un secondo)"""
+
+    def __init__(self, bytes_per_second: float):
+        self.rate = bytes_per_second
+        self._allowance = 0.0
+        self._last = time.monotonic()
+
+    async def consume(self, nbytes: int):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._allowance = min(self._allowance + (now - self._last) * self.rate, self.rate)
+        self._last = now
+        self._allowance -= nbytes
+        if self._allowance < 0:
+            await asyncio.sleep(-self._allowance / self.rate)
@@ -0,0 +1,213 @@
+"""Schema delle tabelle gestite dall'API sul DB locale (PostgreSQL o SQLite)"""
+from sqlalchemy import MetaData, Table, Column, Index, String, Text, BigInteger, Integer, DateTime, inspect, text
+from sqlalchemy.engine import Engine
+import logging
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# Blob content-addressed: un record per contenuto fisico, condiviso tra file e utenti
+blobs = Table(
+    "blobs",
+    metadata,
+    Column("checksum", String(64), primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("refcount", Integer, nullable=False, default=0),
+    Column("created_at", DateTime(timezone=True)),
+)
+
+# Cartelle virtuali per utente, con byte e file aggregati (sottocartelle incluse)
+folders = Table(
+    "folders",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("path", Text, primary_key=True),
+    Column("parent_path", Text),
+    Column("total_size", BigInteger, nullable=False, default=0),
+    Column("file_count", BigInteger, nullable=False, default=0),
+    Index("idx_folders_parent", "user_id", "parent_path"),
+)
+
+# Chunk content-defined condivisi tra le versioni dei file (refcount 0 = caricato, non ancora usato)
+chunks = Table(
+    "chunks",
+    metadata,
+    Column("checksum", String(64), primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("refcount", Integer, nullable=False, default=0),
+    Column("created_at", DateTime(timezone=True)),
+    # Chunk dell'ultima versione di un file: si legge dal blob della versione invece che da un file proprio
+    Column("blob_checksum", String(64)),
+    Column("blob_offset", BigInteger),
+    Index("idx_chunks_blob", "blob_checksum"),
+)
+
+# Utenti che hanno caricato o possiedono un chunk (per non esporre chunk altrui)
+chunk_owners = Table(
+    "chunk_owners",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("checksum", String(64), primary_key=True),
+)
+
+# Versioni dei file come manifest di chunk
+file_versions = Table(
+    "file_versions",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("file_id", String(64), nullable=False),
+    Column("user_id", String(64), nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("checksum", String(64), nullable=False),
+    Column("manifest", Text, nullable=False),  # JSON: [[sha256, size], ...]
+    Column("created_at", DateTime(timezone=True)),
+    Index("idx_file_versions_file", "file_id", "version", unique=True),
+)
+
+# Journal delle modifiche al catalogo dei file, con sequenza monotona per utente
+file_changes = Table(
+    "file_changes",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("seq", BigInteger, primary_key=True),
+    Column("op", String(16), nullable=False),  # created | updated | moved | deleted
+    Column("file_id", String(64), nullable=False),
+    Column("path", Text, nullable=False),
+    Column("old_path", Text),
+    Column("size", BigInteger),
+    Column("checksum", String(64)),
+    Column("mime_type", String(255)),
+    Column("created_at", DateTime(timezone=True)),
+)
+
+# Ultima sequenza assegnata e ultima eliminata dalla retention, per utente
+file_change_heads = Table(
+    "file_change_heads",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("seq", BigInteger, nullable=False, default=0),
+    Column("pruned_seq", BigInteger, nullable=False, default=0),
+)
+
+# Indice di ricerca: campi restituiti dalla ricerca, per file
+search_documents = Table(
+    "search_documents",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("file_id", String(64), primary_key=True),
+    Column("name", Text, nullable=False),
+    Column("path", Text, nullable=False),
+    Column("size", BigInteger, nullable=False, default=0),
+    Column("mime_type", String(255)),
+    Column("tags", Text),  # JSON: lista dei tag
+    Column("metadata_text", Text),  # Parole estratte dai metadata
+    Column("modified_at", DateTime(timezone=True)),
+)
+
+# Indice invertito: trigrammi del nome ('t:abc') e parole intere ('w:parola') con il loro peso
+search_terms = Table(
+    "search_terms",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("term", String(72), primary_key=True),
+    Column("file_id", String(64), primary_key=True),
+    Column("weight", Integer, nullable=False),
+    Index("idx_search_terms_file", "user_id", "file_id"),
+)
+
+# Sequenza del journal delle modifiche già applicata all'indice di ricerca, per utente
+search_index_state = Table(
+    "search_index_state",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("seq", BigInteger, nullable=False, default=0),
+    Column("updated_at", DateTime(timezone=True)),
+)
+
+# Spazio occupato per utente, aggiornato a ogni upload e delete e riallineato periodicamente al catalogo
+storage_usage = Table(
+    "storage_usage",
+    metadata,
+    Column("user_id", String(64), primary_key=True),
+    Column("used_bytes", BigInteger, nullable=False, default=0),
+    Column("file_count", BigInteger, nullable=False, default=0),
+    Column("quota_bytes", BigInteger),  # NULL = STORAGE_QUOTA_DEFAULT_MB
+    Column("generation", BigInteger, nullable=False, default=0),  # Incrementata a ogni variazione
+    Column("reconciled_at", DateTime(timezone=True)),  # NULL = contatori non ancora calcolati
+    Column("updated_at", DateTime(timezone=True)),
+)
+
+# Avanzamento dello scrubber dello storage (una riga, per riprendere dopo un riavvio)
+storage_scrub_state = Table(
+    "storage_scrub_state",
+    metadata,
+    Column("name", String(32), primary_key=True),
+    Column("phase", String(16)),  # blobs | chunks | sweep, NULL tra un passaggio e l'altro
+    Column("cursor", Text),
+    Column("pass_started_at", DateTime(timezone=True)),
+    Column("last_pass_finished_at", DateTime(timezone=True)),
+    Column("stats", Text),  # JSON: contatori del passaggio in corso
+    Column("last_pass_stats", Text),
+)
+
+# Avanzamento dello spostamento dei blob dopo un cambio dei volumi di storage
+storage_rebalance_state = Table(
+    "storage_rebalance_state",
+    metadata,
+    Column("name", String(32), primary_key=True),
+    Column("signature", Text),  # Configurazione dei volumi già ribilanciata
+    Column("pending_signature", Text),  # Configurazione in corso di ribilanciamento
+    Column("cursor", String(64)),
+    Column("stats", Text),
+    Column("updated_at", DateTime(timezone=True)),
+)
+
+# Stato delle sessioni di upload a chunk, condiviso tra i worker (i dati restano in {STORAGE_PATH}/.uploads)
+upload_sessions = Table(
+    "upload_sessions",
+    metadata,
+    Column("id", String(64), primary_key=True),
+    Column("user_id", String(64), nullable=False),
+    Column("status", String(16), nullable=False),  # open | committing | discarding
+    Column("created_at", DateTime(timezone=True)),
+    Column("updated_at", DateTime(timezone=True)),
+)
+
+# Problemi trovati dallo scrubber e non ancora risolti
+storage_scrub_issues = Table(
+    "storage_scrub_issues",
+    metadata,
+    Column("object_key", Text, primary_key=True),  # blobs/<sha256> | chunks/<sha256>
+    Column("kind", String(16), primary_key=True),  # corrupt | missing | refcount
+    Column("detail", Text),  # JSON
+    Column("detected_at", DateTime(timezone=True)),
+)
+
+
+def _add_missing_columns(engine: Engine):
+    """
+    Aggiunge alle tabelle già esistenti le colonne (nullable) e gli indici introdotti dopo
+    la loro creazione: create_all() salta le tabelle che esistono
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"Added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def init_local_schema(engine: Engine):
+    """Crea le tabelle mancanti sul DB locale"""
+    _add_missing_columns(engine)
+    metadata.create_all(engine)
+    logger.info("Local schema ready")
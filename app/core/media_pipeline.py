@@ -0,0 +1,167 @@
+"""Pipeline in background per miniature e metadata dei file multimediali"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+import asyncio
+import logging
+import multiprocessing
+import os
+
+from app.core.config import settings
+from app.core.io_pool import run_io
+from app.core.thumbnails import PIL_AVAILABLE, process_image, load_cached_metadata, thumbnail_filename
+
+logger = logging.getLogger(__name__)
+
+# Formati che Pillow decodifica in modo affidabile
+SUPPORTED_MIME_TYPES = {
+    "image/jpeg",
+    "image/png",
+    "image/gif",
+    "image/webp",
+    "image/bmp",
+    "image/x-ms-bmp",
+    "image/tiff",
+}
+
+
+def is_supported_media(mime_type: Optional[str]) -> bool:
+    return bool(mime_type) and mime_type.split(";")[0].strip().lower() in SUPPORTED_MIME_TYPES
+
+
+class MediaPipeline:
+    """
+    Dopo un upload, genera le miniature e legge gli EXIF su un pool di processi
+    (la decodifica delle immagini è CPU-bound e non rilascia il GIL abbastanza).
+
+    I risultati sono salvati in {STORAGE_PATH}/.thumbnails/ab/cd/<sha256>/ e indicizzati
+    per checksum: un contenuto deduplicato viene elaborato una volta sola, e i file
+    successivi con lo stesso checksum ricevono subito i metadata dalla cache.
+    La coda è limitata: se è piena il job viene scartato e verrà rifatto alla prima
+    richiesta di miniatura.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # checksum -> future dell'elaborazione in corso, per non elaborare due volte lo stesso contenuto
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._on_metadata: Optional[Callable] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def root(self) -> str:
+        return os.path.join(settings.STORAGE_PATH, ".thumbnails")
+
+    def cache_dir(self, checksum: str) -> str:
+        return os.path.join(self.root, checksum[:2], checksum[2:4], checksum)
+
+    def thumbnail_path(self, checksum: str, size: int) -> str:
+        return os.path.join(self.cache_dir(checksum), thumbnail_filename(size))
+
+    def pick_size(self, requested: Optional[int]) -> int:
+        """La miniatura più piccola con lato almeno `requested` (la più grande se nessuna basta)"""
+        sizes = sorted(settings.THUMBNAIL_SIZES)
+        if requested is None:
+            return sizes[0]
+        for size in sizes:
+            if size >= requested:
+                return size
+        return sizes[-1]
+
+    def start(self, on_metadata: Callable):
+        """
+        Avvia il pool di processi e i worker della coda.
+        `on_metadata(file_id, user_id, metadata)` è una coroutine chiamata a elaborazione finita.
+        """
+        if not settings.MEDIA_PIPELINE_ENABLED:
+            return
+        if not PIL_AVAILABLE:
+            logger.warning("⚠️  Pillow not installed: thumbnail pipeline disabled")
+            return
+
+        # spawn: il fork di un processo con thread attivi (uvicorn, pool di I/O) non è sicuro
+        self._executor = ProcessPoolExecutor(
+            max_workers=settings.MEDIA_PIPELINE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self._queue = asyncio.Queue(maxsize=settings.MEDIA_PIPELINE_QUEUE_SIZE)
+        self._on_metadata = on_metadata
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(settings.MEDIA_PIPELINE_WORKERS)
+        ]
+        logger.info(f"✅ Media pipeline started ({settings.MEDIA_PIPELINE_WORKERS} processes)")
+
+    async def stop(self):
+        """Ferma i worker e il pool; i job in coda vengono persi (si rifanno su richiesta)"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._queue = None
+
+    def submit(self, file_id: str, user_id: str, checksum: Optional[str], storage_path: str,
+               mime_type: Optional[str]) -> bool:
+        """Accoda l'elaborazione di un file appena caricato; False se non viene elaborato"""
+        if not self.enabled or not checksum or not is_supported_media(mime_type):
+            return False
+        try:
+            self._queue.put_nowait((file_id, user_id, checksum, storage_path))
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Media pipeline queue full, skipping {file_id}")
+            return False
+
+    async def _worker(self):
+        while True:
+            file_id, user_id, checksum, storage_path = await self._queue.get()
+            try:
+                metadata = await self.process(checksum, storage_path)
+                if metadata is not None:
+                    await self._on_metadata(file_id, user_id, metadata)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Media pipeline failed for {file_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def process(self, checksum: str, storage_path: str) -> Optional[Dict]:
+        """Metadata del contenuto: dalla cache se già elaborato, altrimenti nel pool di processi"""
+        output_dir = self.cache_dir(checksum)
+        metadata = await run_io(load_cached_metadata, output_dir)
+        if metadata is not None:
+            return metadata
+        if not self.enabled:
+            return None
+
+        pending = self._inflight.get(checksum)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor,
+            process_image,
+            storage_path,
+            output_dir,
+            list(settings.THUMBNAIL_SIZES),
+            settings.THUMBNAIL_QUALITY
+        )
+        self._inflight[checksum] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._inflight.pop(checksum, None)
+            else:
+                future.add_done_callback(lambda _: self._inflight.pop(checksum, None))
+
+
+media_pipeline = MediaPipeline()
@@ -0,0 +1,34 @@
+"""Classificazione dei mime type per le decisioni di compressione"""
+from typing import Optional
+
+# Formati già compressi: ricomprimerli costa CPU senza ridurre la dimensione
+_COMPRESSED_PREFIXES = ("image/", "video/", "audio/")
+_UNCOMPRESSED_EXCEPTIONS = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav"}
+_COMPRESSED_TYPES = {
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/zstd",
+    "application/pdf",
+    "application/epub+zip",
+    "application/java-archive",
+    "application/vnd.android.package-archive",
+}
+_COMPRESSED_SUFFIXES = ("+zip", ".document", ".sheet", ".presentation")  # Office Open XML / ODF
+
+
+def is_compressed_mime(mime_type: Optional[str]) -> bool:
+    """True se il contenuto è già compresso (media, archivi, documenti Office)"""
+    if not mime_type:
+        return False
+    mime_type = mime_type.split(";")[0].strip().lower()
+    if mime_type in _UNCOMPRESSED_EXCEPTIONS:
+        return False
+    if mime_type in _COMPRESSED_TYPES or mime_type.startswith(_COMPRESSED_PREFIXES):
+        return True
+    return mime_type.endswith(_COMPRESSED_SUFFIXES)
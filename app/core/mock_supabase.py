@@ -1,4 +1,5 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
+import re
 import uuid
 from datetime import datetime
 import logging
@@ -83,6 +84,88 @@ class MockAuth:
              logger.warning(f"MockAuth: Invalid token {token}")
              return None
 
+def _compare(left: Any, op: str, right: Any) -> bool:
+    """Confronto in stile SQL: NULL non soddisfa nessun operatore"""
+    if left is None:
+        return False
+    if op == "like":
+        regex, escaped = "", False
+        for ch in right:
+            if escaped:
+                regex += re.escape(ch)
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            else:
+                regex += ".*" if ch == "%" else "." if ch == "_" else re.escape(ch)
+        return re.fullmatch(regex, str(left), re.DOTALL) is not None
+    if not isinstance(right, type(left)):
+        try:
+            right = type(left)(right)
+        except (TypeError, ValueError):
+            left, right = str(left), str(right)
+    if op == "eq":
+        return left == right
+    if op == "neq":
+        return left != right
+    if op == "gt":
+        return left > right
+    if op == "gte":
+        return left >= right
+    if op == "lt":
+        return left < right
+    if op == "lte":
+        return left <= right
+    raise ValueError(f"Unsupported operator: {op}")
+
+
+def _split_top_level(expr: str) -> List[str]:
+    """Divide per virgole ignorando quelle tra parentesi o virgolette"""
+    parts, depth, quoted, current = [], 0, False, ""
+    i = 0
+    while i < len(expr):
+        ch = expr[i]
+        if quoted and ch == "\\" and i + 1 < len(expr):
+            current += expr[i:i + 2]
+            i += 2
+            continue
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ",":
+            parts.append(current)
+            current = ""
+            i += 1
+            continue
+        current += ch
+        i += 1
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _parse_or_filter(expr: str) -> Callable[[Dict], bool]:
+    predicates = []
+    for term in _split_top_level(expr):
+        predicates.append(_parse_filter_term(term.strip()))
+    return lambda row: any(p(row) for p in predicates)
+
+
+def _parse_filter_term(term: str) -> Callable[[Dict], bool]:
+    for group, combine in (("and(", all), ("or(", any)):
+        if term.startswith(group) and term.endswith(")"):
+            inner = [_parse_filter_term(t.strip()) for t in _split_top_level(term[len(group):-1])]
+            return lambda row, inner=inner, combine=combine: combine(p(row) for p in inner)
+
+    column, op, value = term.split(".", 2)
+    if value.startswith('"') and value.endswith('"'):
+        value = re.sub(r'\\(.)', r'\1', value[1:-1])
+    return lambda row: _compare(row.get(column), op, value)
+
+
 class MockTableQuery:
     def __init__(self, data_list: List[Dict]):
         self.source_data = data_list
@@ -91,16 +174,27 @@ class MockTableQuery:
         self.filters = []
         self.action = "select" # select, insert, update, delete
         self.payload = None
+        self.order_by = []
+        self.row_limit = None
+        self.columns = None
+        self.on_conflict = "id"
 
     def select(self, columns: str):
         self.action = "select"
+        self.columns = None if columns.strip() == "*" else [c.strip() for c in columns.split(",")]
         return self
         
-    def insert(self, record: Dict):
+    def insert(self, record):
         self.action = "insert"
         self.payload = record
         return self
         
+    def upsert(self, record, on_conflict: str = "id"):
+        self.action = "upsert"
+        self.payload = record
+        self.on_conflict = on_conflict
+        return self
+
     def update(self, record: Dict):
         self.action = "update"
         self.payload = record
@@ -111,38 +205,98 @@ class MockTableQuery:
         return self
 
     def eq(self, column: str, value: Any):
-        self.filters.append((column, value))
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def neq(self, column: str, value: Any):
+        self.filters.append(lambda row: row.get(column) != value)
+        return self
+
+    def gt(self, column: str, value: Any):
+        self.filters.append(lambda row: _compare(row.get(column), "gt", value))
+        return self
+
+    def gte(self, column: str, value: Any):
+        self.filters.append(lambda row: _compare(row.get(column), "gte", value))
+        return self
+
+    def lt(self, column: str, value: Any):
+        self.filters.append(lambda row: _compare(row.get(column), "lt", value))
+        return self
+
+    def lte(self, column: str, value: Any):
+        self.filters.append(lambda row: _compare(row.get(column), "lte", value))
+        return self
+
+    def like(self, column: str, pattern: str):
+        self.filters.append(lambda row: _compare(row.get(column), "like", pattern))
+        return self
+
+    def in_(self, column: str, values: List[Any]):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, filters: str):
+        """Supporta la sintassi PostgREST: 'a.gt.1,and(a.eq.1,b.gt.x)'"""
+        predicate = _parse_or_filter(filters)
+        self.filters.append(predicate)
+        return self
+
+    def order(self, column: str, desc: bool = False):
+        self.order_by.append((column, desc))
         return self
         
     def limit(self, count: int):
-        # Not fully implemented but safe to ignore for mock logic usually
+        self.row_limit = count
         return self
 
     def execute(self):
         # Apply filters to find target rows
         target_indices = []
         for i, row in enumerate(self.source_data):
-            match = True
-            for col, val in self.filters:
-                if row.get(col) != val:
-                    match = False
-                    break
-            if match:
+            if all(predicate(row) for predicate in self.filters):
                 target_indices.append(i)
         
         if self.action == "select":
             result_data = [self.source_data[i] for i in target_indices]
-            # If no filters were applied (select *), return all? 
-            if not self.filters:
-                 result_data = list(self.source_data)
+            # Ordina partendo dalla chiave meno significativa (sort stabile)
+            for column, desc in reversed(self.order_by):
+                result_data.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            if self.row_limit is not None:
+                result_data = result_data[:self.row_limit]
+            if self.columns:
+                result_data = [{col: row.get(col) for col in self.columns} for row in result_data]
             return MockResult(result_data)
 
         elif self.action == "insert":
-            record = self.payload.copy()
-            if "id" not in record:
-                record["id"] = str(uuid.uuid4())
-            self.source_data.append(record)
-            return MockResult([record])
+            # Come supabase-py: un dict o una lista di dict (insert in blocco)
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            records = []
+            for item in payload:
+                record = item.copy()
+                if "id" not in record:
+                    record["id"] = str(uuid.uuid4())
+                self.source_data.append(record)
+                records.append(record)
+            return MockResult(records)
+
+        elif self.action == "upsert":
+            # Come insert, ma le righe con la stessa chiave `on_conflict` vengono aggiornate
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            existing = {row.get(self.on_conflict): row for row in self.source_data}
+            records = []
+            for item in payload:
+                record = existing.get(item.get(self.on_conflict))
+                if record is not None:
+                    record.update(item)
+                else:
+                    record = item.copy()
+                    if "id" not in record:
+                        record["id"] = str(uuid.uuid4())
+                    self.source_data.append(record)
+                    existing[record.get(self.on_conflict)] = record
+                records.append(record)
+            return MockResult(records)
 
         elif self.action == "update":
             updated_rows = []
@@ -0,0 +1,34 @@
+"""Cursori opachi per la paginazione keyset"""
+from typing import Any, Dict
+import base64
+import binascii
+import json
+
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Codifica la posizione dell'ultimo elemento restituito in un token opaco"""
+    raw = json.dumps(position, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Decodifica un cursore; solleva ValueError se non è valido"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def escape_like(value: str) -> str:
+    """Escape dei caratteri jolly di LIKE (%, _ e backslash)"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def postgrest_quote(value: Any) -> str:
+    """Quota un valore per i filtri logici di PostgREST (or/and)"""
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{text}"'
@@ -0,0 +1,261 @@
+"""Quote di storage per utente: contatori incrementali riallineati periodicamente al catalogo"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import asyncio
+import logging
+import threading
+
+from app.core.config import settings
+from app.core.io_pool import run_io
+
+logger = logging.getLogger(__name__)
+
+STARTUP_DELAY = 60
+POLL_INTERVAL = 3600
+BATCH_SIZE = 100
+# Tentativi di salvare i contatori ricalcolati mentre l'utente continua a caricare o eliminare file
+RECONCILE_ATTEMPTS = 3
+
+
+class QuotaExceeded(Exception):
+    """Lo spazio richiesto porterebbe l'utente oltre la sua quota"""
+
+    def __init__(self, used_bytes: int, quota_bytes: int, requested_bytes: int):
+        super().__init__(f"Storage quota exceeded: {used_bytes} + {requested_bytes} > {quota_bytes} bytes")
+        self.used_bytes = used_bytes
+        self.quota_bytes = quota_bytes
+        self.requested_bytes = requested_bytes
+
+
+class QuotaReservation:
+    """Spazio prenotato da un upload in corso, rilasciato all'uscita da StorageQuota.reserve()"""
+
+    def __init__(self, quota: "StorageQuota", user_id: str):
+        self.quota = quota
+        self.user_id = user_id
+        self.size = 0
+
+    def extend_to(self, size: int, usage: Optional[dict] = None):
+        """Porta la prenotazione a `size` byte (per upload di cui si conosce la dimensione solo alla fine)"""
+        if size > self.size:
+            self.quota._reserve(self.user_id, size - self.size, usage)
+            self.size = size
+
+
+class StorageQuota:
+    """
+    Tabella `storage_usage` sul DB locale: byte e file di ogni utente, aggiornati con
+    un incremento atomico a ogni upload, sostituzione e delete invece di una SUM(size)
+    sul catalogo. I contatori di un utente si calcolano dal catalogo al primo accesso e
+    vengono ricalcolati ogni STORAGE_QUOTA_RECONCILE_HOURS per correggere le variazioni
+    perse (crash tra l'insert nel catalogo e l'incremento, import da altri processi).
+
+    Gli upload prenotano lo spazio prima di scrivere i byte: le prenotazioni sono in
+    memoria, così un upload interrotto non lascia spazio occupato.
+    """
+
+    def __init__(self, engine: Engine, supabase):
+        self.engine = engine
+        self.supabase = supabase
+        self._reserved: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(STARTUP_DELAY)
+        while True:
+            try:
+                await run_io(self.reconcile_due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Storage usage reconciliation failed: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    @staticmethod
+    def _quota_bytes(quota_bytes: Optional[int]) -> Optional[int]:
+        """Quota effettiva in byte (None = illimitata)"""
+        if quota_bytes is None:
+            quota_bytes = settings.STORAGE_QUOTA_DEFAULT_MB * 1024 * 1024
+        return quota_bytes if quota_bytes > 0 else None
+
+    def _load(self, user_id: str):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text(
+                    "SELECT used_bytes, file_count, quota_bytes, generation, reconciled_at "
+                    "FROM storage_usage WHERE user_id = :user_id"
+                ),
+                {"user_id": user_id},
+            ).first()
+
+    def usage(self, user_id: str) -> dict:
+        """Byte e file dell'utente, quota e spazio prenotato dagli upload in corso"""
+        row = self._load(user_id)
+        if row is not None and row.reconciled_at is not None:
+            used, count, quota_bytes, reconciled_at = row.used_bytes, row.file_count, row.quota_bytes, row.reconciled_at
+        else:
+            used, count, quota_bytes, reconciled_at = self.reconcile(user_id)
+        with self._lock:
+            reserved = self._reserved.get(user_id, 0)
+        return {
+            "used_bytes": used,
+            "file_count": count,
+            "quota_bytes": self._quota_bytes(quota_bytes),
+            "reserved_bytes": reserved,
+            "reconciled_at": reconciled_at,
+        }
+
+    def check(self, user_id: str, size: int):
+        """Solleva QuotaExceeded se `size` byte in più non ci stanno nella quota dell'utente"""
+        usage = self.usage(user_id)
+        quota_bytes = usage["quota_bytes"]
+        if quota_bytes is not None and size > 0 and usage["used_bytes"] + usage["reserved_bytes"] + size > quota_bytes:
+            raise QuotaExceeded(usage["used_bytes"] + usage["reserved_bytes"], quota_bytes, size)
+
+    def _reserve(self, user_id: str, size: int, usage: Optional[dict] = None):
+        if usage is None:
+            usage = self.usage(user_id)
+        quota_bytes = usage["quota_bytes"]
+        with self._lock:
+            reserved = self._reserved.get(user_id, 0)
+            if quota_bytes is not None and usage["used_bytes"] + reserved + size > quota_bytes:
+                raise QuotaExceeded(usage["used_bytes"] + reserved, quota_bytes, size)
+            self._reserved[user_id] = reserved + size
+
+    def _release(self, user_id: str, size: int):
+        with self._lock:
+            reserved = self._reserved.get(user_id, 0) - size
+            if reserved > 0:
+                self._reserved[user_id] = reserved
+            else:
+                self._reserved.pop(user_id, None)
+
+    @contextmanager
+    def reserve(self, user_id: str, size: Optional[int] = None,
+                usage: Optional[dict] = None) -> Iterator[QuotaReservation]:
+        """
+        Prenota `size` byte per la durata del blocco, sollevando QuotaExceeded se non ci stanno.
+        Il blocco deve comprendere la registrazione nel catalogo: a quel punto apply() li
+        ha già aggiunti ai contatori e la prenotazione può essere rilasciata.
+        Dagli handler async `usage` va letto prima con run_io(usage): così all'ingresso
+        del blocco non si interroga il DB sull'event loop.
+        """
+        reservation = QuotaReservation(self, user_id)
+        if size:
+            reservation.extend_to(size, usage)
+        try:
+            yield reservation
+        finally:
+            if reservation.size:
+                self._release(user_id, reservation.size)
+
+    def apply(self, user_id: str, size_delta: int, count_delta: int):
+        """
+        Aggiorna i contatori dopo una modifica al catalogo (già avvenuta: un errore
+        viene solo loggato e sarà corretto dalla riconciliazione)
+        """
+        if not size_delta and not count_delta:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(
+                        "UPDATE storage_usage SET used_bytes = used_bytes + :size, "
+                        "file_count = file_count + :count, generation = generation + 1, updated_at = :now "
+                        "WHERE user_id = :user_id"
+                    ),
+                    {"user_id": user_id, "size": size_delta, "count": count_delta, "now": datetime.now(timezone.utc)},
+                )
+        except Exception as e:
+            logger.error(f"Could not update storage usage of user {user_id}: {e}")
+
+    def _catalog_totals(self, user_id: str) -> Tuple[int, int]:
+        """Byte e file dell'utente contati sul catalogo, a pagine"""
+        used = count = 0
+        last_path = None
+        while True:
+            query = self.supabase.table("files").select("path,size").eq("user_id", user_id)
+            if last_path is not None:
+                query = query.gt("path", last_path)
+            rows = query.order("path").limit(settings.FILE_LIST_MAX_LIMIT).execute().data
+            used += sum(row.get("size") or 0 for row in rows)
+            count += len(rows)
+            if len(rows) < settings.FILE_LIST_MAX_LIMIT:
+                return used, count
+            last_path = rows[-1]["path"]
+
+    def reconcile(self, user_id: str) -> Tuple[int, int, Optional[int], datetime]:
+        """
+        Ricalcola i contatori dal catalogo. Si salvano solo se nessuna apply() li ha
+        toccati durante il conteggio (`generation` invariata); dopo RECONCILE_ATTEMPTS
+        tentativi restituisce il conteggio senza salvarlo, ci riproverà il prossimo giro.
+        Restituisce (used_bytes, file_count, quota_bytes, reconciled_at).
+        """
+        with self.engine.begin() as conn:
+            # La riga va creata prima del conteggio: le apply() concorrenti devono poterla incrementare
+            conn.execute(
+                text(
+                    "INSERT INTO storage_usage (user_id, used_bytes, file_count, generation) "
+                    "VALUES (:user_id, 0, 0, 0) ON CONFLICT (user_id) DO NOTHING"
+                ),
+                {"user_id": user_id},
+            )
+
+        for _ in range(RECONCILE_ATTEMPTS):
+            row = self._load(user_id)
+            used, count = self._catalog_totals(user_id)
+            now = datetime.now(timezone.utc)
+            with self.engine.begin() as conn:
+                saved = conn.execute(
+                    text(
+                        "UPDATE storage_usage SET used_bytes = :used, file_count = :count, "
+                        "generation = generation + 1, reconciled_at = :now, updated_at = :now "
+                        "WHERE user_id = :user_id AND generation = :generation"
+                    ),
+                    {"user_id": user_id, "used": used, "count": count, "now": now, "generation": row.generation},
+                ).rowcount
+            if saved:
+                if row.reconciled_at is not None and (row.used_bytes, row.file_count) != (used, count):
+                    logger.warning(
+                        f"Storage usage of user {user_id} corrected: {row.used_bytes} -> {used} bytes, "
+                        f"{row.file_count} -> {count} files"
+                    )
+                return used, count, row.quota_bytes, now
+        logger.info(f"Storage usage of user {user_id} changed while reconciling, will retry later")
+        return used, count, row.quota_bytes, now
+
+    def reconcile_due(self):
+        """Riconcilia gli utenti il cui ultimo ricalcolo è più vecchio di STORAGE_QUOTA_RECONCILE_HOURS"""
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.STORAGE_QUOTA_RECONCILE_HOURS)
+        cursor = ""
+        reconciled = 0
+        while True:
+            with self.engine.connect() as conn:
+                users = conn.execute(
+                    text(
+                        "SELECT user_id FROM storage_usage WHERE user_id > :cursor "
+                        "AND (reconciled_at IS NULL OR reconciled_at < :cutoff) ORDER BY user_id LIMIT :limit"
+                    ),
+                    {"cursor": cursor, "cutoff": cutoff, "limit": BATCH_SIZE},
+                ).scalars().all()
+            for user_id in users:
+                self.reconcile(user_id)
+            reconciled += len(users)
+            if len(users) < BATCH_SIZE:
+                break
+            cursor = users[-1]
+        if reconciled:
+            logger.info(f"✅ Storage usage reconciled for {reconciled} users")
@@ -0,0 +1,231 @@
+"""Ribilanciamento dei blob tra i volumi dopo un cambio di configurazione"""
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from app.core.config import settings
+from app.core.blob_store import BlobStore
+from app.core.codecs import CodecError, codec_for_path
+from app.core.io_pool import Throttle, run_io
+from app.core.storage import discard_temp, make_temp
+from app.core.volumes import StorageVolume
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = "rebalance"
+BATCH_SIZE = 100
+READ_SIZE = 1024 * 1024
+SLICE_SIZE = 8 * READ_SIZE
+STARTUP_DELAY = 30
+RETRY_DELAY = 3600
+
+
+def _open_copy(source_path: str, volume: StorageVolume):
+    os.makedirs(volume.temp_dir, exist_ok=True)
+    src = open(source_path, "rb", buffering=0)
+    fd, temp_path = make_temp(volume.temp_dir, "rebalance_")
+    return src, os.fdopen(fd, "wb"), temp_path
+
+
+def _copy_slice(src, dest, hasher, buffer: bytearray, decode=None) -> Tuple[int, int]:
+    """
+    Copia i byte così come sono su disco; l'hash è sul contenuto originale (decompresso
+    se c'è `decode`). Restituisce (byte copiati, byte di contenuto), (0, 0) a fine file
+    """
+    view = memoryview(buffer)
+    copied = content = 0
+    while copied < SLICE_SIZE:
+        n = src.readinto(view)
+        if not n:
+            break
+        data = view[:n] if decode is None else decode(view[:n])
+        hasher.update(data)
+        dest.write(view[:n])
+        copied += n
+        content += len(data)
+    return copied, content
+
+
+def _finish_copy(src, dest, synced: bool):
+    try:
+        if synced:
+            dest.flush()
+            os.fsync(dest.fileno())
+    finally:
+        dest.close()
+        src.close()
+
+
+class VolumeRebalancer:
+    """
+    Quando cambia l'insieme dei volumi (o i loro pesi) sposta i blob che non sono più sul
+    volume preferito. Con il rendezvous hashing si spostano solo i blob che spettano ai
+    volumi nuovi, circa la loro quota del totale. Un blob finito su un volume meno preferito
+    perché il suo era pieno viene riportato indietro se ora c'è spazio.
+
+    La copia è limitata da STORAGE_REBALANCE_MAX_MBPS, verificata con lo SHA-256 e resa
+    definitiva sotto il lock del blob store; il cursore (checksum) viene salvato dopo ogni
+    blocco in `storage_rebalance_state`, quindi un riavvio riprende dal punto in cui era.
+    """
+
+    def __init__(self, engine: Engine, blob_store: BlobStore):
+        self.engine = engine
+        self.blob_store = blob_store
+        self.volumes = blob_store.volumes
+        self.throttle = Throttle(settings.STORAGE_REBALANCE_MAX_MBPS * 1024 * 1024)
+        self._buffer = bytearray(READ_SIZE)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(STARTUP_DELAY)
+        while True:
+            try:
+                await self.run()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Volume rebalance failed: {e}")
+            await asyncio.sleep(RETRY_DELAY)
+
+    def _load_state(self):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text("SELECT signature, pending_signature, cursor, stats FROM storage_rebalance_state WHERE name = :name"),
+                {"name": STATE_NAME},
+            ).first()
+
+    def _save_state(self, pending_signature: Optional[str], cursor: Optional[str], stats: Dict,
+                    signature: Optional[str] = None):
+        """Salva l'avanzamento; con `signature` segna il ribilanciamento come completato"""
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO storage_rebalance_state (name, signature, pending_signature, cursor, stats, updated_at) "
+                    "VALUES (:name, :signature, :pending, :cursor, :stats, :now) "
+                    "ON CONFLICT (name) DO UPDATE SET pending_signature = :pending, cursor = :cursor, "
+                    "stats = :stats, updated_at = :now, "
+                    "signature = COALESCE(:signature, storage_rebalance_state.signature)"
+                ),
+                {
+                    "name": STATE_NAME,
+                    "signature": signature,
+                    "pending": pending_signature,
+                    "cursor": cursor,
+                    "stats": json.dumps(stats),
+                    "now": now,
+                },
+            )
+
+    async def run(self):
+        """Ribilancia se la configurazione è cambiata dall'ultima volta (riprende se interrotto)"""
+        signature = await run_io(self.volumes.signature)
+        state = await run_io(self._load_state)
+        if state is not None and state.signature == signature:
+            return
+        if state is None and len(self.volumes.volumes) == 1:
+            # Installazione a volume singolo: niente da spostare
+            await run_io(self._save_state, None, None, {}, signature)
+            return
+
+        if state is not None and state.pending_signature == signature:
+            cursor, stats = state.cursor, Counter(json.loads(state.stats or "{}"))
+            logger.info(f"⚖️  Resuming volume rebalance after {cursor}")
+        else:
+            cursor, stats = None, Counter()
+            logger.info(f"⚖️  Storage volumes changed, rebalancing blobs ({signature})")
+
+        while True:
+            rows = await run_io(self._next_rows, cursor)
+            if not rows:
+                break
+            for row in rows:
+                await self._rebalance_blob(row.checksum, row.size, stats)
+            cursor = rows[-1].checksum
+            await run_io(self._save_state, signature, cursor, dict(stats))
+
+        await run_io(self._save_state, None, None, dict(stats), signature)
+        logger.info(f"✅ Volume rebalance completed: {dict(stats)}")
+
+    def _next_rows(self, cursor: Optional[str]):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text("SELECT checksum, size FROM blobs WHERE checksum > :cursor ORDER BY checksum LIMIT :limit"),
+                {"cursor": cursor or "", "limit": BATCH_SIZE},
+            ).all()
+
+    def _plan(self, checksum: str, size: int):
+        """(path attuale, volume di destinazione) se il blob va spostato, altrimenti None"""
+        source = self.blob_store.locate(checksum)
+        if source is None:
+            return None  # Mancante: lo segnala lo scrubber
+        current = self.volumes.volume_of(source)
+        ranked = self.volumes.ranked(checksum)
+        try:
+            target = self.volumes.choose(checksum, size)
+        except OSError:
+            return None
+        # Solo verso un volume più preferito di quello attuale
+        if current is not None and current in ranked and ranked.index(target) >= ranked.index(current):
+            return None
+        return source, target
+
+    async def _rebalance_blob(self, checksum: str, size: int, stats: Counter):
+        plan = await run_io(self._plan, checksum, size)
+        if plan is None:
+            return
+        source, target = plan
+        codec = codec_for_path(source)
+        decode = codec.decoder() if codec is not None else None
+        try:
+            src, dest, temp_path = await run_io(_open_copy, source, target)
+        except FileNotFoundError:
+            return  # Eliminato nel frattempo
+
+        hasher = hashlib.sha256()
+        copied = 0
+        content_size = 0
+        completed = False
+        try:
+            while True:
+                try:
+                    n, content = await run_io(_copy_slice, src, dest, hasher, self._buffer, decode)
+                except CodecError:
+                    break  # Compresso illeggibile: lo segnala lo scrubber
+                if not n:
+                    completed = True
+                    break
+                copied += n
+                content_size += content
+                await self.throttle.consume(n)
+        finally:
+            await run_io(_finish_copy, src, dest, completed)
+            if not completed:
+                await run_io(discard_temp, temp_path)
+
+        if not completed or hasher.hexdigest() != checksum or content_size != size:
+            await run_io(discard_temp, temp_path)
+            stats["skipped_corrupt"] += 1
+            logger.warning(f"Not moving blob {checksum}: content does not match its checksum")
+            return
+
+        if await run_io(self.blob_store.commit_move, checksum, temp_path, source, target):
+            stats["moved"] += 1
+            stats["bytes_moved"] += copied
@@ -0,0 +1,617 @@
+"""Scrubber dello storage: verifica dei checksum e recupero dello spazio orfano"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import text, bindparam
+from sqlalchemy.engine import Engine
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from app.core.config import settings
+from app.core.blob_store import BlobStore
+from app.core.chunk_store import ChunkStore
+from app.core.codecs import BLOB_SUFFIXES, CodecError, codec_for_path, split_suffix
+from app.core.io_pool import Throttle, run_io
+from app.core.storage import INTERNAL_DIRS, discard_temp
+
+logger = logging.getLogger(__name__)
+
+STATE_NAME = "scrubber"
+PHASES = ("blobs", "chunks", "sweep")
+BATCH_SIZE = 100
+READ_SIZE = 1024 * 1024
+SLICE_SIZE = 8 * READ_SIZE  # Byte letti per ogni chiamata al pool di I/O
+STARTUP_DELAY = 60  # Secondi dopo l'avvio prima di toccare il disco
+POLL_INTERVAL = 3600
+# Righe oltre le quali PostgREST tronca la risposta: un conteggio così non è affidabile
+CATALOG_MAX_ROWS = 1000
+
+_CHECKSUM_RE = re.compile(r"^[0-9a-f]{64}$")
+_BLOB_RE = re.compile(r"^[0-9a-f]{64}(" + "|".join(re.escape(suffix) for suffix in BLOB_SUFFIXES) + r")$")
+# File salvati prima del blob store: {STORAGE_PATH}/{user_id}/{sha256}_{nome}
+_LEGACY_RE = re.compile(r"^([0-9a-f]{64})_")
+
+
+def _open_for_scrub(path: str):
+    f = open(path, "rb", buffering=0)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f
+
+
+def _hash_slice(f, hasher, buffer: bytearray, decode=None) -> Tuple[int, int]:
+    """
+    Legge in sequenza fino a SLICE_SIZE byte aggiornando l'hash, calcolato sul contenuto
+    decompresso se c'è `decode`. Restituisce (byte letti, byte di contenuto), (0, 0) a fine file
+    """
+    view = memoryview(buffer)
+    read = content = 0
+    while read < SLICE_SIZE:
+        n = f.readinto(view)
+        if not n:
+            break
+        data = view[:n] if decode is None else decode(view[:n])
+        hasher.update(data)
+        read += n
+        content += len(data)
+    return read, content
+
+
+def _close_scrubbed(f):
+    # I dati letti solo per la verifica non devono scalzare dalla page cache quelli usati davvero
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+    f.close()
+
+
+def _subdirs(path: str) -> List[str]:
+    try:
+        with os.scandir(path) as entries:
+            return sorted(e.name for e in entries if e.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return []
+
+
+def _list_files(path: str) -> List[Tuple[str, int, float]]:
+    """(nome, size, mtime) dei file regolari di una directory"""
+    result = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    result.append((entry.name, st.st_size, st.st_mtime))
+    except FileNotFoundError:
+        pass
+    return sorted(result)
+
+
+def _remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class StorageScrubber:
+    """
+    Rilegge blob e chunk a banda limitata confrontandone lo SHA-256 con il nome (bit-rot),
+    riallinea i refcount dei blob al catalogo `files` ed elimina i file rimasti senza
+    riferimenti (blob e chunk orfani, temporanei abbandonati, file legacy senza record).
+
+    Un passaggio è diviso in fasi (blobs, chunks, sweep); l'avanzamento è salvato dopo ogni
+    blocco in `storage_scrub_state`, quindi dopo un riavvio riprende dal punto in cui era.
+    Le letture passano dal pool di I/O a fette di 8 MiB: un blob grande non tiene occupato
+    un thread e gli upload non restano in coda dietro allo scrubber.
+    """
+
+    def __init__(self, storage_root: str, engine: Engine, blob_store: BlobStore,
+                 chunk_store: Optional[ChunkStore] = None, supabase=None):
+        self.storage_root = storage_root
+        self.engine = engine
+        self.blob_store = blob_store
+        self.chunk_store = chunk_store
+        self.supabase = supabase
+        self.throttle = Throttle(settings.SCRUB_MAX_MBPS * 1024 * 1024)
+        self.grace = timedelta(hours=settings.SCRUB_ORPHAN_GRACE_HOURS)
+        self.interval = timedelta(hours=settings.SCRUB_INTERVAL_HOURS)
+        self._buffer = bytearray(READ_SIZE)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not settings.SCRUBBER_ENABLED:
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"✅ Storage scrubber started ({settings.SCRUB_MAX_MBPS:g} MB/s)")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        await asyncio.sleep(STARTUP_DELAY)
+        while True:
+            try:
+                if await run_io(self._pass_due):
+                    await self.run_pass()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Storage scrub failed: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    # --- Stato persistente ---
+
+    def _cutoff(self) -> datetime:
+        return datetime.now(timezone.utc) - self.grace
+
+    def _pass_due(self) -> bool:
+        """True se c'è un passaggio da riprendere o l'ultimo è finito da più di SCRUB_INTERVAL_HOURS"""
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT phase, CASE WHEN last_pass_finished_at IS NULL "
+                    "OR last_pass_finished_at < :due_before THEN 1 ELSE 0 END AS due "
+                    "FROM storage_scrub_state WHERE name = :name"
+                ),
+                {"name": STATE_NAME, "due_before": datetime.now(timezone.utc) - self.interval},
+            ).first()
+        return row is None or row.phase is not None or bool(row.due)
+
+    def _load_state(self) -> Optional[Dict]:
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT phase, cursor, stats FROM storage_scrub_state WHERE name = :name"),
+                {"name": STATE_NAME},
+            ).first()
+        if row is None or row.phase is None:
+            return None
+        return {"phase": row.phase, "cursor": row.cursor, "stats": Counter(json.loads(row.stats or "{}"))}
+
+    def _begin_pass(self) -> Dict:
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO storage_scrub_state (name, phase, cursor, pass_started_at, stats) "
+                    "VALUES (:name, :phase, NULL, :now, '{}') "
+                    "ON CONFLICT (name) DO UPDATE SET phase = :phase, cursor = NULL, "
+                    "pass_started_at = :now, stats = '{}'"
+                ),
+                {"name": STATE_NAME, "phase": PHASES[0], "now": datetime.now(timezone.utc)},
+            )
+        return {"phase": PHASES[0], "cursor": None, "stats": Counter()}
+
+    def _save_state(self, state: Dict):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("UPDATE storage_scrub_state SET phase = :phase, cursor = :cursor, stats = :stats WHERE name = :name"),
+                {"name": STATE_NAME, "phase": state["phase"], "cursor": state["cursor"], "stats": json.dumps(state["stats"])},
+            )
+
+    def _finish_pass(self, stats: Dict):
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE storage_scrub_state SET phase = NULL, cursor = NULL, stats = NULL, "
+                    "last_pass_finished_at = :now, last_pass_stats = :stats WHERE name = :name"
+                ),
+                {"name": STATE_NAME, "now": datetime.now(timezone.utc), "stats": json.dumps(stats)},
+            )
+
+    # --- Problemi trovati ---
+
+    def _record_issue(self, object_key: str, kind: str, detail: Dict, keep_detected_at: bool = True):
+        params = {
+            "object_key": object_key,
+            "kind": kind,
+            "detail": json.dumps(detail),
+            "now": datetime.now(timezone.utc),
+        }
+        update = "detail = :detail" if keep_detected_at else "detail = :detail, detected_at = :now"
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO storage_scrub_issues (object_key, kind, detail, detected_at) "
+                    "VALUES (:object_key, :kind, :detail, :now) "
+                    f"ON CONFLICT (object_key, kind) DO UPDATE SET {update}"
+                ),
+                params,
+            )
+
+    def _clear_issues(self, object_keys: List[str], kinds: Tuple[str, ...]):
+        if not object_keys:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("DELETE FROM storage_scrub_issues WHERE object_key IN :keys AND kind IN :kinds")
+                .bindparams(bindparam("keys", expanding=True), bindparam("kinds", expanding=True)),
+                {"keys": object_keys, "kinds": list(kinds)},
+            )
+
+    def _refcount_observations(self, object_keys: List[str]) -> Dict[str, Tuple[Dict, bool]]:
+        """Osservazioni dei passaggi precedenti: object_key -> (detail, più vecchia della grace)"""
+        if not object_keys:
+            return {}
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT object_key, detail, CASE WHEN detected_at < :cutoff THEN 1 ELSE 0 END AS settled "
+                    "FROM storage_scrub_issues WHERE kind = 'refcount' AND object_key IN :keys"
+                ).bindparams(bindparam("keys", expanding=True)),
+                {"keys": object_keys, "cutoff": self._cutoff()},
+            ).all()
+        return {row.object_key: (json.loads(row.detail), bool(row.settled)) for row in rows}
+
+    def _affected_files(self, checksum: str) -> List[Dict]:
+        if self.supabase is None:
+            return []
+        try:
+            result = self.supabase.table("files").select("id, user_id, path").eq("checksum", checksum).limit(50).execute()
+            return result.data or []
+        except Exception as e:
+            logger.warning(f"Could not look up files for {checksum}: {e}")
+            return []
+
+    async def _report(self, table: str, checksum: str, kind: str, detail: Dict, stats: Counter):
+        if table == "blobs":
+            detail["files"] = await run_io(self._affected_files, checksum)
+        await run_io(self._record_issue, f"{table}/{checksum}", kind, detail)
+        stats[kind] += 1
+        logger.error(f"❌ Storage integrity: {table}/{checksum} is {kind} ({len(detail.get('files', []))} files affected)")
+
+    # --- Passaggio ---
+
+    async def run_pass(self):
+        """Esegue un passaggio completo, riprendendo quello interrotto se c'è"""
+        state = await run_io(self._load_state)
+        if state is None:
+            state = await run_io(self._begin_pass)
+            logger.info("🔍 Storage scrub pass started")
+        else:
+            logger.info(f"🔍 Resuming storage scrub ({state['phase']} after {state['cursor']})")
+
+        for phase in PHASES[PHASES.index(state["phase"]):]:
+            if state["phase"] != phase:
+                state["phase"], state["cursor"] = phase, None
+                await run_io(self._save_state, state)
+            if phase == "blobs":
+                await self._scrub_objects("blobs", self._blob_path, state)
+            elif phase == "chunks" and self.chunk_store is not None:
+                await self._scrub_objects("chunks", self.chunk_store.chunk_path, state)
+            elif phase == "sweep":
+                await self._sweep(state)
+
+        stats = dict(state["stats"])
+        await run_io(self._finish_pass, stats)
+        logger.info(f"✅ Storage scrub pass completed: {stats}")
+
+    def _blob_path(self, checksum: str) -> str:
+        return self.blob_store.locate(checksum) or self.blob_store.blob_path(checksum)
+
+    def _next_rows(self, table: str, cursor: Optional[str]):
+        # I chunk letti dal blob della versione corrente non hanno un file: li copre la verifica del blob
+        own_file = " AND blob_checksum IS NULL" if table == "chunks" else ""
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text(
+                    f"SELECT checksum, size, refcount FROM {table} "
+                    f"WHERE checksum > :cursor{own_file} ORDER BY checksum LIMIT :limit"
+                ),
+                {"cursor": cursor or "", "limit": BATCH_SIZE},
+            ).all()
+
+    def _row_exists(self, table: str, checksum: str) -> bool:
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text(f"SELECT 1 FROM {table} WHERE checksum = :checksum"), {"checksum": checksum}
+            ).first() is not None
+
+    def _row_settled(self, table: str, checksum: str) -> bool:
+        """
+        La riga esiste ed è più vecchia della grace: l'import in blocco inserisce i
+        riferimenti prima di mettere i file in posizione (come per il mtime nello sweep)
+        """
+        with self.engine.connect() as conn:
+            return conn.execute(
+                text(f"SELECT 1 FROM {table} WHERE checksum = :checksum AND created_at < :older_than"),
+                {"checksum": checksum, "older_than": self._cutoff()},
+            ).first() is not None
+
+    async def _scrub_objects(self, table: str, path_for, state: Dict):
+        stats = state["stats"]
+        while True:
+            rows = await run_io(self._next_rows, table, state["cursor"])
+            if not rows:
+                return
+            if table == "blobs":
+                await self._reconcile_refcounts(rows, stats)
+            else:
+                # Chunk caricati per un upload delta mai completato
+                collected = await run_io(
+                    self.chunk_store.collect_unused,
+                    [row.checksum for row in rows if row.refcount <= 0],
+                    self._cutoff()
+                )
+                stats["chunks_collected"] += collected
+
+            healthy = []
+            for row in rows:
+                path = await run_io(path_for, row.checksum)
+                if await self._verify(table, row.checksum, row.size, path, stats):
+                    healthy.append(f"{table}/{row.checksum}")
+            await run_io(self._clear_issues, healthy, ("corrupt", "missing"))
+
+            state["cursor"] = rows[-1].checksum
+            await run_io(self._save_state, state)
+
+    async def _verify(self, table: str, checksum: str, size: int, path: str, stats: Counter) -> bool:
+        """
+        Rilegge un oggetto e ne confronta SHA-256 e dimensione; False se c'è un problema.
+        Un blob compresso viene decompresso in streaming: si verifica il contenuto originale.
+        """
+        codec = codec_for_path(path)
+        decode = codec.decoder() if codec is not None else None
+        try:
+            f = await run_io(_open_for_scrub, path)
+        except FileNotFoundError:
+            # Può essere stato eliminato mentre lo scrubber lo raggiungeva, o non ancora messo in posizione
+            if await run_io(self._row_settled, table, checksum):
+                await self._report(table, checksum, "missing", {"size": size}, stats)
+            return False
+
+        hasher = hashlib.sha256()
+        read = 0
+        disk_read = 0
+        error = None
+        try:
+            while True:
+                try:
+                    n, content = await run_io(_hash_slice, f, hasher, self._buffer, decode)
+                except CodecError as e:
+                    error = str(e)
+                    break
+                if not n:
+                    break
+                disk_read += n
+                read += content
+                await self.throttle.consume(n)
+        finally:
+            await run_io(_close_scrubbed, f)
+        stats["objects"] += 1
+        stats["bytes"] += disk_read
+
+        actual = hasher.hexdigest()
+        if error is None and actual == checksum and read == size:
+            return True
+        if not await run_io(self._row_exists, table, checksum):
+            return False
+        detail = {"size": size, "read": read, "sha256": actual}
+        if error is not None:
+            detail["error"] = error
+        await self._report(table, checksum, "corrupt", detail, stats)
+        return False
+
+    def _catalog_counts(self, checksums: List[str]) -> Dict[str, Optional[int]]:
+        """File del catalogo che usano ciascun blob (None se il conteggio non è affidabile)"""
+        def count(rows) -> Counter:
+            return Counter(
+                row["checksum"] for row in rows
+                if row.get("storage_path") and self.blob_store.is_blob_path(row["storage_path"])
+            )
+
+        result = self.supabase.table("files").select("checksum, storage_path").in_("checksum", checksums).execute()
+        if len(result.data) < CATALOG_MAX_ROWS:
+            counts = count(result.data)
+            return {checksum: counts.get(checksum, 0) for checksum in checksums}
+
+        counts = {}
+        for checksum in checksums:
+            rows = self.supabase.table("files").select("checksum, storage_path").eq("checksum", checksum).execute().data
+            counts[checksum] = count(rows).get(checksum, 0) if len(rows) < CATALOG_MAX_ROWS else None
+        return counts
+
+    async def _reconcile_refcounts(self, rows, stats: Counter):
+        """
+        Allinea i refcount dei blob al numero di file del catalogo che li usano.
+        Un refcount troppo basso si corregge subito (un delete eliminerebbe un blob ancora usato).
+        Uno troppo alto può essere un upload in corso (riferimento preso, riga non ancora
+        inserita): si corregge solo se un passaggio precedente, più vecchio della grace,
+        aveva osservato gli stessi valori. Blob senza file = spazio recuperato.
+        """
+        if self.supabase is None:
+            return
+        try:
+            counts = await run_io(self._catalog_counts, [row.checksum for row in rows])
+        except Exception as e:
+            logger.warning(f"Catalog unavailable, skipping refcount check: {e}")
+            return
+
+        observations = await run_io(self._refcount_observations, [f"blobs/{row.checksum}" for row in rows])
+        resolved = []
+        for row in rows:
+            key = f"blobs/{row.checksum}"
+            catalog = counts.get(row.checksum)
+            if catalog is None:
+                continue
+            if catalog == row.refcount:
+                if key in observations:
+                    resolved.append(key)
+                continue
+
+            if catalog < row.refcount:
+                observed = {"refcount": row.refcount, "catalog": catalog}
+                previous = observations.get(key)
+                if previous is None or previous[0] != observed:
+                    await run_io(self._record_issue, key, "refcount", observed, False)
+                    continue
+                if not previous[1]:
+                    continue
+                resolved.append(key)
+
+            if await run_io(self.blob_store.set_refcount, row.checksum, row.refcount, catalog):
+                stats["refcounts_fixed"] += 1
+                if catalog == 0:
+                    stats["bytes_reclaimed"] += row.size
+                logger.warning(f"Blob {row.checksum} refcount {row.refcount} -> {catalog} (catalog)")
+        await run_io(self._clear_issues, resolved, ("refcount",))
+
+    # --- Sweep del filesystem ---
+
+    def _sweep_units(self) -> List[Tuple[str, str]]:
+        """Unità di lavoro ordinate (chiave per il cursore, directory)"""
+        units = []
+        volumes = self.blob_store.volumes.volumes
+        stores = [("1", f"blobs/{volume.name}", volume.blobs_root) for volume in volumes]
+        if self.chunk_store is not None:
+            stores.append(("2", "chunks", self.chunk_store.root))
+        for order, name, root in stores:
+            for a in _subdirs(root):
+                for b in _subdirs(os.path.join(root, a)):
+                    units.append((f"{order}:{name}/{a}/{b}", os.path.join(root, a, b)))
+        units += [(f"3:tmp/{volume.name}", volume.temp_dir) for volume in volumes]
+        if self.supabase is not None:
+            for name in _subdirs(self.storage_root):
+                if name not in INTERNAL_DIRS:
+                    units.append((f"4:legacy/{name}", os.path.join(self.storage_root, name)))
+        return units
+
+    async def _sweep(self, state: Dict):
+        stats = state["stats"]
+        units = await run_io(self._sweep_units)
+        for key, directory in units:
+            if state["cursor"] is not None and key <= state["cursor"]:
+                continue
+            files = await run_io(_list_files, directory)
+            old_before = time.time() - self.grace.total_seconds()
+            old = [(name, size) for name, size, mtime in files if mtime < old_before]
+
+            if key.startswith("1:"):
+                await self._sweep_objects("blobs", directory, old, stats)
+            elif key.startswith("2:"):
+                await self._sweep_objects("chunks", directory, old, stats)
+            elif key.startswith("3:"):
+                for name, size in old:
+                    await run_io(discard_temp, os.path.join(directory, name))
+                    stats["temp_removed"] += 1
+                    stats["bytes_reclaimed"] += size
+            else:
+                if not await self._sweep_legacy(directory, old, stats):
+                    continue  # Catalogo non raggiungibile: si riproverà al prossimo passaggio
+
+            state["cursor"] = key
+            await run_io(self._save_state, state)
+
+    def _existing(self, table: str, checksums: List[str]) -> set:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(f"SELECT checksum FROM {table} WHERE checksum IN :checksums")
+                .bindparams(bindparam("checksums", expanding=True)),
+                {"checksums": checksums},
+            ).all()
+        return {row.checksum for row in rows}
+
+    async def _sweep_objects(self, table: str, directory: str, files: List[Tuple[str, int]], stats: Counter):
+        """Elimina i file del fan-out senza riga nel DB (rimozione ricontrollata sotto lock dallo store)"""
+        pattern = _BLOB_RE if table == "blobs" else _CHECKSUM_RE
+        files = [(name, size) for name, size in files if pattern.match(name)]
+        if not files:
+            return
+        checksums = {name: split_suffix(name)[0] for name, _ in files}
+        existing = await run_io(self._existing, table, list(set(checksums.values())))
+        for name, size in files:
+            path = os.path.join(directory, name)
+            checksum = checksums[name]
+            if table == "chunks":
+                if checksum in existing:
+                    continue
+                removed = await run_io(self.chunk_store.remove_orphan, checksum)
+            else:
+                # Anche le copie da cui il blob non viene letto: spostamento tra volumi interrotto,
+                # o versione compressa e non compressa dello stesso contenuto
+                if checksum in existing and await run_io(self.blob_store.locate, checksum) == path:
+                    continue
+                removed = await run_io(self.blob_store.remove_stray, path)
+            if removed:
+                stats["orphans_removed"] += 1
+                stats["bytes_reclaimed"] += size
+                logger.warning(f"Removed orphan {table}/{name} ({size} bytes)")
+
+    def _legacy_referenced(self, checksums: List[str]) -> Tuple[set, set]:
+        """(path reali usati dal catalogo, checksum per cui la risposta potrebbe essere troncata)"""
+        query = self.supabase.table("files").select("checksum, storage_path")
+        rows = query.in_("checksum", checksums).execute().data
+        uncertain = set()
+        if len(rows) >= CATALOG_MAX_ROWS:
+            rows = []
+            for checksum in checksums:
+                data = self.supabase.table("files").select("checksum, storage_path").eq("checksum", checksum).execute().data
+                if len(data) >= CATALOG_MAX_ROWS:
+                    uncertain.add(checksum)
+                rows.extend(data)
+        return {os.path.realpath(row["storage_path"]) for row in rows if row.get("storage_path")}, uncertain
+
+    async def _sweep_legacy(self, directory: str, files: List[Tuple[str, int]], stats: Counter) -> bool:
+        """
+        File salvati prima del blob store ({user_id}/{sha256}_{nome}) senza record nel catalogo,
+        per esempio dopo un insert fallito. Tutto ciò che non segue quel formato non viene toccato.
+        """
+        candidates = [(name, size, _LEGACY_RE.match(name).group(1)) for name, size in files if _LEGACY_RE.match(name)]
+        for start in range(0, len(candidates), BATCH_SIZE):
+            batch = candidates[start:start + BATCH_SIZE]
+            try:
+                referenced, uncertain = await run_io(
+                    self._legacy_referenced, sorted({checksum for _, _, checksum in batch})
+                )
+            except Exception as e:
+                logger.warning(f"Catalog unavailable, skipping legacy sweep of {directory}: {e}")
+                return False
+            for name, size, checksum in batch:
+                path = os.path.join(directory, name)
+                if checksum in uncertain or os.path.realpath(path) in referenced:
+                    continue
+                if await run_io(_remove_file, path):
+                    stats["orphans_removed"] += 1
+                    stats["bytes_reclaimed"] += size
+                    logger.warning(f"Removed orphan legacy file {path} ({size} bytes)")
+        return True
+
+    # --- Report ---
+
+    def report(self, limit: int = 100) -> Dict:
+        """Stato dello scrubber e problemi aperti, per l'healthcheck"""
+        with self.engine.connect() as conn:
+            state = conn.execute(
+                text(
+                    "SELECT phase, cursor, pass_started_at, last_pass_finished_at, stats, last_pass_stats "
+                    "FROM storage_scrub_state WHERE name = :name"
+                ),
+                {"name": STATE_NAME},
+            ).mappings().first()
+            issues = conn.execute(
+                text(
+                    "SELECT object_key, kind, detail, detected_at FROM storage_scrub_issues "
+                    "WHERE kind <> 'refcount' ORDER BY detected_at DESC LIMIT :limit"
+                ),
+                {"limit": limit},
+            ).mappings().all()
+
+        state = dict(state) if state else {}
+        for field in ("stats", "last_pass_stats"):
+            state[field] = json.loads(state[field]) if state.get(field) else None
+        return {
+            "enabled": self._task is not None,
+            "max_mbps": settings.SCRUB_MAX_MBPS,
+            **state,
+            "issues": [{**dict(issue), "detail": json.loads(issue["detail"] or "{}")} for issue in issues],
+        }
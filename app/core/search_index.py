@@ -0,0 +1,321 @@
+"""Indice di ricerca full-text e fuzzy sui file del catalogo"""
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import text, bindparam
+from sqlalchemy.engine import Engine, Connection
+import json
+import logging
+import math
+import posixpath
+import re
+import unicodedata
+
+from app.core.change_journal import ChangeJournal, CursorExpired
+from app.core.pagination import escape_like
+
+logger = logging.getLogger(__name__)
+
+# Peso dei termini nel punteggio: i trigrammi del nome valgono 1 ciascuno
+NAME_WORD_WEIGHT = 6
+TAG_WEIGHT = 5
+FOLDER_WEIGHT = 3
+METADATA_WEIGHT = 2
+# Frazione dei trigrammi della query che il nome deve contenere se nessuna parola corrisponde esattamente
+MIN_SIMILARITY = 0.5
+MAX_QUERY_WORDS = 16
+MAX_WORD_LENGTH = 64
+MAX_METADATA_WORDS = 64
+CATCH_UP_BATCH = 1000
+# Chiavi dei metadata che non contengono testo da cercare
+_SKIPPED_METADATA_KEYS = {"thumbnails"}
+
+_CAMEL_RE = re.compile(r"([a-z0-9])([A-Z])")
+_WORD_RE = re.compile(r"[^\W_]+")
+
+
+def tokenize(value: str) -> List[str]:
+    """Parole in minuscolo e senza accenti; separa anche camelCase e numeri (MyReport2024 -> my report 2024)"""
+    value = _CAMEL_RE.sub(r"\1 \2", value)
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(c for c in value if not unicodedata.combining(c)).lower()
+    words = []
+    for word in _WORD_RE.findall(value):
+        words.extend(part for part in re.split(r"(\d+)", word) if part)
+    return [word[:MAX_WORD_LENGTH] for word in words]
+
+
+def trigrams(word: str) -> Set[str]:
+    """Trigrammi di una parola, con padding come pg_trgm: '  ab', ' ab ' contano l'inizio e la fine"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _metadata_words(metadata: Optional[dict]) -> List[str]:
+    """Parole dei valori testuali dei metadata (EXIF e simili), in ordine e senza duplicati"""
+    words: List[str] = []
+    seen = set()
+
+    def walk(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key not in _SKIPPED_METADATA_KEYS:
+                    walk(item)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item)
+        elif isinstance(value, str):
+            for word in tokenize(value):
+                if word not in seen:
+                    seen.add(word)
+                    words.append(word)
+
+    walk(metadata or {})
+    return words[:MAX_METADATA_WORDS]
+
+
+def document_terms(path: str, tags: List[str], metadata_text: str) -> Dict[str, int]:
+    """
+    Termini di un file con il loro peso: 't:' + trigramma delle parole del nome (ricerca
+    fuzzy), 'w:' + parola intera di nome, cartelle, tag e metadata. Un termine presente in
+    più campi tiene il peso più alto.
+    """
+    terms: Dict[str, int] = {}
+
+    def add(term: str, weight: int):
+        if weight > terms.get(term, 0):
+            terms[term] = weight
+
+    name_words = tokenize(posixpath.basename(path))
+    for word in name_words:
+        add(f"w:{word}", NAME_WORD_WEIGHT)
+        for gram in trigrams(word):
+            add(f"t:{gram}", 1)
+    for word in tokenize(posixpath.dirname(path)):
+        add(f"w:{word}", FOLDER_WEIGHT)
+    for tag in tags:
+        for word in tokenize(tag):
+            add(f"w:{word}", TAG_WEIGHT)
+    for word in metadata_text.split():
+        add(f"w:{word}", METADATA_WEIGHT)
+    return terms
+
+
+def query_terms(query: str) -> Tuple[List[str], List[str]]:
+    """(trigrammi, parole) di una query; solleva ValueError se non contiene parole"""
+    words = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_WORDS]
+    if not words:
+        raise ValueError("Search query must contain at least one letter or digit")
+    grams = sorted({f"t:{gram}" for word in words for gram in trigrams(word)})
+    return grams, [f"w:{word}" for word in words]
+
+
+class SearchIndex:
+    """
+    Indice di ricerca per utente sul DB locale. `search_terms` è un indice invertito
+    (user_id, term, file_id, weight): i trigrammi delle parole del nome rendono la ricerca
+    tollerante a errori di battitura e a parole parziali, le parole intere coprono cartelle,
+    tag e metadata. Una ricerca è una sola GROUP BY sui termini della query servita dalla
+    chiave primaria, senza scorrere il catalogo; `search_documents` tiene i campi da
+    restituire, così la risposta non passa da Supabase.
+
+    L'indice segue il journal delle modifiche: prima di ogni ricerca applica le modifiche
+    successive alla sequenza salvata in `search_index_state`, quindi è aggiornato anche per
+    import in blocco e client diversi. Se l'utente non è indicizzato o il journal non copre
+    più quella sequenza, l'indice viene ricostruito dal catalogo (vedi rebuild).
+    """
+
+    def __init__(self, engine: Engine, change_journal: ChangeJournal):
+        self.engine = engine
+        self.change_journal = change_journal
+
+    def _indexed_seq(self, conn: Connection, user_id: str) -> Optional[int]:
+        return conn.execute(
+            text("SELECT seq FROM search_index_state WHERE user_id = :user_id"),
+            {"user_id": user_id},
+        ).scalar()
+
+    def _delete_document(self, conn: Connection, user_id: str, file_id: str):
+        params = {"user_id": user_id, "file_id": file_id}
+        conn.execute(text("DELETE FROM search_terms WHERE user_id = :user_id AND file_id = :file_id"), params)
+        conn.execute(text("DELETE FROM search_documents WHERE user_id = :user_id AND file_id = :file_id"), params)
+
+    def _insert_documents(self, conn: Connection, user_id: str, documents: List[Dict]):
+        if not documents:
+            return
+        conn.execute(
+            text(
+                "INSERT INTO search_documents "
+                "(user_id, file_id, name, path, size, mime_type, tags, metadata_text, modified_at) "
+                "VALUES (:user_id, :file_id, :name, :path, :size, :mime_type, :tags, :metadata_text, :modified_at)"
+            ),
+            [{**document, "user_id": user_id, "tags": json.dumps(document["tags"])} for document in documents],
+        )
+        conn.execute(
+            text("INSERT INTO search_terms (user_id, term, file_id, weight) VALUES (:user_id, :term, :file_id, :weight)"),
+            [
+                {"user_id": user_id, "term": term, "file_id": document["file_id"], "weight": weight}
+                for document in documents
+                for term, weight in document_terms(document["path"], document["tags"], document["metadata_text"]).items()
+            ],
+        )
+
+    def _put_document(self, conn: Connection, user_id: str, document: Dict):
+        self._delete_document(conn, user_id, document["file_id"])
+        self._insert_documents(conn, user_id, [document])
+
+    @staticmethod
+    def _document(record: Dict) -> Dict:
+        """Documento da indicizzare a partire da un record del catalogo `files`"""
+        return {
+            "file_id": str(record["id"]),
+            "name": record.get("name") or posixpath.basename(record["path"]),
+            "path": record["path"],
+            "size": record.get("size") or 0,
+            "mime_type": record.get("mime_type"),
+            "tags": [tag for tag in record.get("tags") or [] if isinstance(tag, str)],
+            "metadata_text": " ".join(_metadata_words(record.get("metadata"))),
+            "modified_at": record.get("updated_at") or record.get("created_at"),
+        }
+
+    def _load_document(self, conn: Connection, user_id: str, file_id: str) -> Optional[Dict]:
+        row = conn.execute(
+            text(
+                "SELECT file_id, name, path, size, mime_type, tags, metadata_text, modified_at "
+                "FROM search_documents WHERE user_id = :user_id AND file_id = :file_id"
+            ),
+            {"user_id": user_id, "file_id": file_id},
+        ).mappings().first()
+        if row is None:
+            return None
+        document = dict(row)
+        document["tags"] = json.loads(document["tags"] or "[]")
+        return document
+
+    def _apply_change(self, conn: Connection, user_id: str, change: Dict):
+        """Applica una voce del journal; tag e metadata restano quelli già indicizzati"""
+        if change["op"] == "deleted":
+            self._delete_document(conn, user_id, change["file_id"])
+            return
+        document = self._load_document(conn, user_id, change["file_id"]) or {"tags": [], "metadata_text": ""}
+        document.update({
+            "file_id": change["file_id"],
+            "name": posixpath.basename(change["path"]),
+            "path": change["path"],
+            "size": change["size"] or 0,
+            "mime_type": change["mime_type"],
+            "modified_at": change["created_at"],
+        })
+        self._put_document(conn, user_id, document)
+
+    def catch_up(self, user_id: str) -> bool:
+        """
+        Porta l'indice dell'utente alla testa del journal.
+        False se va ricostruito dal catalogo (utente mai indicizzato o journal già potato).
+        """
+        while True:
+            with self.engine.connect() as conn:
+                seq = self._indexed_seq(conn, user_id)
+            if seq is None:
+                return False
+            try:
+                changes = self.change_journal.changes_since(user_id, seq, CATCH_UP_BATCH)
+            except CursorExpired:
+                return False
+            if not changes:
+                return True
+
+            with self.engine.begin() as conn:
+                # Aggiornare prima la riga di stato la blocca: due ricerche concorrenti non applicano
+                # lo stesso blocco due volte (la seconda trova la sequenza già avanzata e ricomincia)
+                updated = conn.execute(
+                    text(
+                        "UPDATE search_index_state SET seq = :new_seq, updated_at = :now "
+                        "WHERE user_id = :user_id AND seq = :seq"
+                    ),
+                    {"user_id": user_id, "seq": seq, "new_seq": changes[-1]["seq"], "now": datetime.now(timezone.utc)},
+                ).rowcount
+                if updated:
+                    for change in changes:
+                        self._apply_change(conn, user_id, change)
+
+    def rebuild(self, user_id: str, seq: int, records: Iterable[Dict]):
+        """
+        Ricostruisce l'indice dell'utente da tutti i suoi record del catalogo.
+        `seq` è la testa del journal letta prima di scorrere il catalogo: le modifiche
+        avvenute durante la scansione vengono riapplicate dal catch_up successivo.
+        """
+        documents = [self._document(record) for record in records]
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM search_terms WHERE user_id = :user_id"), {"user_id": user_id})
+            conn.execute(text("DELETE FROM search_documents WHERE user_id = :user_id"), {"user_id": user_id})
+            self._insert_documents(conn, user_id, documents)
+            conn.execute(
+                text(
+                    "INSERT INTO search_index_state (user_id, seq, updated_at) VALUES (:user_id, :seq, :now) "
+                    "ON CONFLICT (user_id) DO UPDATE SET seq = :seq, updated_at = :now"
+                ),
+                {"user_id": user_id, "seq": seq, "now": datetime.now(timezone.utc)},
+            )
+        logger.info(f"Search index rebuilt for user {user_id}: {len(documents)} files")
+
+    def invalidate(self, user_id: str):
+        """Scarta l'indice dell'utente (verrà ricostruito alla prossima ricerca)"""
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("DELETE FROM search_index_state WHERE user_id = :user_id"), {"user_id": user_id})
+        except Exception as e:
+            logger.error(f"Could not drop search index for user {user_id}: {e}")
+
+    def set_metadata(self, user_id: str, file_id: str, metadata: Optional[dict]):
+        """Reindicizza i metadata di un file (es. EXIF dalla pipeline delle miniature)"""
+        try:
+            with self.engine.begin() as conn:
+                document = self._load_document(conn, user_id, file_id)
+                if document is None:
+                    return  # Non ancora indicizzato: lo farà il catch_up o il rebuild
+                document["metadata_text"] = " ".join(_metadata_words(metadata))
+                self._put_document(conn, user_id, document)
+        except Exception as e:
+            logger.error(f"Could not index metadata of {file_id}, dropping search index of {user_id}: {e}")
+            self.invalidate(user_id)
+
+    def search(self, user_id: str, query: str, limit: int, position: Optional[Dict] = None,
+               prefix: Optional[str] = None) -> List[Dict]:
+        """
+        File che corrispondono alla query, dal punteggio più alto (a parità, per path).
+        Un file corrisponde se contiene una parola della query o se il nome contiene almeno
+        metà dei suoi trigrammi. `position` (score, path, file_id dell'ultimo risultato)
+        riprende dalla pagina precedente. Solleva ValueError per query senza parole.
+        """
+        grams, words = query_terms(query)
+        params = {
+            "user_id": user_id,
+            "terms": grams + words,
+            "min_grams": max(1, math.ceil(MIN_SIMILARITY * len(grams))),
+            "limit": limit,
+        }
+        conditions = ["(m.words > 0 OR m.grams >= :min_grams)"]
+        if prefix:
+            conditions.append("d.path LIKE :prefix ESCAPE '\\'")
+            params["prefix"] = escape_like(prefix) + "%"
+        if position:
+            conditions.append(
+                "(m.score < :score OR (m.score = :score AND (d.path > :path OR (d.path = :path AND d.file_id > :file_id))))"
+            )
+            params.update(score=position["score"], path=position["path"], file_id=position["file_id"])
+
+        sql = (
+            "SELECT d.file_id, d.name, d.path, d.size, d.mime_type, d.modified_at, m.score "
+            "FROM (SELECT file_id, SUM(weight) AS score, "
+            "SUM(CASE WHEN term LIKE 't:%' THEN 1 ELSE 0 END) AS grams, "
+            "SUM(CASE WHEN term LIKE 'w:%' THEN 1 ELSE 0 END) AS words "
+            "FROM search_terms WHERE user_id = :user_id AND term IN :terms GROUP BY file_id) m "
+            "JOIN search_documents d ON d.user_id = :user_id AND d.file_id = m.file_id "
+            f"WHERE {' AND '.join(conditions)} "
+            "ORDER BY m.score DESC, d.path, d.file_id LIMIT :limit"
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(sql).bindparams(bindparam("terms", expanding=True)), params
+            ).mappings().all()
+        return [dict(row) for row in rows]
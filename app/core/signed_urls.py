@@ -0,0 +1,47 @@
+"""URL di download firmati con HMAC, verificabili senza DB né auth"""
+from typing import Any, Dict
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+
+from app.core.config import settings
+
+
+class InvalidSignature(Exception):
+    """Token malformato, firma non valida o scaduto"""
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _signature(payload: str) -> str:
+    digest = hmac.new(settings.SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return _b64encode(digest)
+
+
+def sign_token(claims: Dict[str, Any], ttl: int) -> str:
+    """Firma i claim aggiungendo la scadenza (`exp`, epoch in secondi)"""
+    payload = _b64encode(json.dumps({**claims, "exp": int(time.time()) + ttl}, separators=(",", ":")).encode())
+    return f"{payload}.{_signature(payload)}"
+
+
+def verify_token(token: str) -> Dict[str, Any]:
+    """Verifica firma e scadenza, restituisce i claim"""
+    payload, _, signature = token.partition(".")
+    if not payload or not signature or not hmac.compare_digest(signature, _signature(payload)):
+        raise InvalidSignature("Invalid signature")
+    try:
+        claims = json.loads(_b64decode(payload))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise InvalidSignature("Malformed token")
+    if claims.get("exp", 0) < time.time():
+        raise InvalidSignature("Link expired")
+    return claims
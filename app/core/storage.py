@@ -0,0 +1,130 @@
+"""Helper per la scrittura su disco dei file del personal cloud"""
+from dataclasses import dataclass
+from typing import AsyncIterator, BinaryIO, Optional, Tuple
+from fastapi import UploadFile
+import hashlib
+import logging
+import os
+import tempfile
+
+from app.core.config import settings
+from app.core.io_pool import run_io
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StoredUpload:
+    """Risultato di una scrittura in streaming su file temporaneo"""
+    temp_path: str
+    size: int
+    checksum: str
+
+
+# Directory interne del volume di storage (non contengono file degli utenti)
+INTERNAL_DIRS = {"blobs", "chunks", ".tmp", ".uploads", ".thumbnails", ".imports"}
+
+_created_dirs = set()
+
+
+def _current_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Permessi di un file creato con open(): mkstemp userebbe 0600
+FILE_MODE = 0o666 & ~_current_umask()
+
+
+def get_temp_dir() -> str:
+    """
+    Directory per i file temporanei, dentro il volume di storage.
+    Deve stare sullo stesso filesystem della destinazione finale
+    perché os.replace sia atomico.
+    """
+    temp_dir = os.path.join(settings.STORAGE_PATH, ".tmp")
+    if temp_dir not in _created_dirs:
+        os.makedirs(temp_dir, exist_ok=True)
+        _created_dirs.add(temp_dir)
+    return temp_dir
+
+
+async def iter_upload_file(file: UploadFile, chunk_size: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Legge un UploadFile a blocchi senza caricarlo tutto in memoria"""
+    chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def make_temp(directory: str, prefix: str) -> Tuple[int, str]:
+    """
+    tempfile.mkstemp con i permessi di un file normale: i temporanei diventano blob
+    con os.replace e il proxy (X-Accel/X-Sendfile) deve poterli leggere
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        os.fchmod(fd, FILE_MODE)
+    except BaseException:
+        os.close(fd)
+        discard_temp(temp_path)
+        raise
+    return fd, temp_path
+
+
+def _make_temp(prefix: str) -> Tuple[int, str]:
+    return make_temp(get_temp_dir(), prefix)
+
+
+def _write_and_hash(out: BinaryIO, hasher, chunk: bytes):
+    hasher.update(chunk)
+    out.write(chunk)
+
+
+def _sync_and_close(out: BinaryIO):
+    try:
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        out.close()
+
+
+async def write_stream_to_temp(chunks: AsyncIterator[bytes]) -> StoredUpload:
+    """
+    Scrive uno stream di byte su un file temporaneo nel volume di storage,
+    calcolando dimensione e SHA-256 nello stesso passaggio.
+    Scrittura e hashing girano nel pool di I/O: l'event loop attende solo la rete.
+    """
+    fd, temp_path = await run_io(_make_temp, "upload_")
+    out = os.fdopen(fd, "wb")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in chunks:
+            await run_io(_write_and_hash, out, hasher, chunk)
+            size += len(chunk)
+        await run_io(_sync_and_close, out)
+    except BaseException:
+        out.close()
+        await run_io(discard_temp, temp_path)
+        raise
+    return StoredUpload(temp_path=temp_path, size=size, checksum=hasher.hexdigest())
+
+
+def commit_temp(temp_path: str, final_path: str):
+    """Sposta atomicamente il file temporaneo nel suo path definitivo"""
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(temp_path, final_path)
+
+
+def discard_temp(temp_path: str):
+    """Rimuove un file temporaneo ignorando gli errori"""
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove temp file {temp_path}: {e}")
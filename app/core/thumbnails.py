@@ -0,0 +1,160 @@
+"""
+Generazione di miniature ed estrazione dei metadata EXIF.
+Le funzioni girano nei processi del pool di MediaPipeline: niente import dell'app qui.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+import json
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps, ExifTags
+    PIL_AVAILABLE = True
+except ImportError:  # Pillow è opzionale: senza, la pipeline resta disattivata
+    PIL_AVAILABLE = False
+
+THUMBNAIL_FORMAT = "jpeg"
+THUMBNAIL_MEDIA_TYPE = "image/jpeg"
+META_FILENAME = "meta.json"
+
+# Tag EXIF riportati nei metadata del file (nome EXIF -> chiave nei metadata)
+_EXIF_FIELDS = {
+    "Make": "camera_make",
+    "Model": "camera_model",
+    "LensModel": "lens_model",
+    "DateTimeOriginal": "taken_at",
+    "ExposureTime": "exposure_time",
+    "FNumber": "f_number",
+    "ISOSpeedRatings": "iso",
+    "FocalLength": "focal_length",
+    "Orientation": "orientation",
+}
+
+
+def thumbnail_filename(size: int) -> str:
+    return f"{size}.jpg"
+
+
+def _to_json_value(value):
+    """Converte i valori EXIF (rational, bytes, tuple) in tipi serializzabili"""
+    if isinstance(value, bytes):
+        return None
+    if isinstance(value, (tuple, list)):
+        return [_to_json_value(v) for v in value]
+    if isinstance(value, (int, str)):
+        return value.strip("\x00 ") if isinstance(value, str) else value
+    try:
+        return round(float(value), 6)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def _gps_to_degrees(values, ref: Optional[str]) -> Optional[float]:
+    try:
+        degrees = float(values[0]) + float(values[1]) / 60 + float(values[2]) / 3600
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return None
+    return round(-degrees if ref in ("S", "W") else degrees, 7)
+
+
+def _extract_exif(image) -> Dict:
+    exif = image.getexif()
+    if not exif:
+        return {}
+
+    tags = dict(exif)
+    tags.update(exif.get_ifd(ExifTags.IFD.Exif))
+    result = {}
+    for tag_id, value in tags.items():
+        key = _EXIF_FIELDS.get(ExifTags.TAGS.get(tag_id))
+        if key is None:
+            continue
+        value = _to_json_value(value)
+        if value in (None, "", []):
+            continue
+        if key == "taken_at":
+            try:
+                value = datetime.strptime(value, "%Y:%m:%d %H:%M:%S").isoformat()
+            except (TypeError, ValueError):
+                continue
+        result[key] = value
+
+    gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+    if gps:
+        latitude = _gps_to_degrees(gps.get(2), gps.get(1))
+        longitude = _gps_to_degrees(gps.get(4), gps.get(3))
+        if latitude is not None and longitude is not None:
+            result["gps"] = {"latitude": latitude, "longitude": longitude}
+    return result
+
+
+def _write_atomic(directory: str, filename: str, write):
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temp_path, os.path.join(directory, filename))
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def process_image(source_path: str, output_dir: str, sizes: List[int], quality: int = 82) -> Dict:
+    """
+    Genera una miniatura JPEG per ogni lato massimo in `sizes` dentro `output_dir`
+    ed estrae dimensioni ed EXIF. Restituisce i metadata (salvati anche in meta.json).
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError("Pillow is not installed")
+
+    os.makedirs(output_dir, exist_ok=True)
+    with Image.open(source_path) as image:
+        metadata = {
+            "width": image.width,
+            "height": image.height,
+            "format": image.format,
+            "exif": _extract_exif(image),
+        }
+        if getattr(image, "n_frames", 1) > 1:
+            metadata["frames"] = image.n_frames
+
+        # draft() fa decodificare i JPEG già ridotti: molto più veloce per le foto grandi
+        image.draft("RGB", (max(sizes), max(sizes)))
+        frame = ImageOps.exif_transpose(image)
+        if frame.mode not in ("RGB", "L"):
+            background = Image.new("RGB", frame.size, (255, 255, 255))
+            if frame.mode in ("RGBA", "LA", "P"):
+                frame = frame.convert("RGBA")
+                background.paste(frame, mask=frame.getchannel("A"))
+            else:
+                background.paste(frame.convert("RGB"))
+            frame = background
+
+        generated = []
+        for size in sorted(sizes, reverse=True):
+            thumb = frame.copy()
+            thumb.thumbnail((size, size), Image.Resampling.LANCZOS)
+            _write_atomic(
+                output_dir,
+                thumbnail_filename(size),
+                lambda f: thumb.save(f, THUMBNAIL_FORMAT, quality=quality, optimize=True)
+            )
+            generated.append(size)
+            frame = thumb  # La miniatura successiva parte da quella appena fatta
+
+    metadata["thumbnails"] = sorted(generated)
+    _write_atomic(output_dir, META_FILENAME, lambda f: f.write(json.dumps(metadata).encode()))
+    return metadata
+
+
+def load_cached_metadata(output_dir: str) -> Optional[Dict]:
+    """Metadata già calcolati per questo contenuto, None se non ancora elaborato"""
+    try:
+        with open(os.path.join(output_dir, META_FILENAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,328 @@
+"""Sessioni di upload a chunk, riprendibili e parallelizzabili"""
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from app.core.config import settings
+from app.core.io_pool import run_io
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UploadSession:
+    """Stato persistente di una sessione di upload"""
+    id: str
+    user_id: str
+    name: str
+    path: str
+    size: int
+    chunk_size: int
+    mime_type: Optional[str] = None
+    checksum: Optional[str] = None  # SHA256 atteso, se dichiarato dal client
+    created_at: str = field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+    @property
+    def total_chunks(self) -> int:
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def chunk_length(self, index: int) -> int:
+        """Lunghezza attesa del chunk `index` (l'ultimo può essere più corto)"""
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+def _pwrite_and_hash(fd: int, hasher, data: bytes, offset: int):
+    os.pwrite(fd, data, offset)
+    hasher.update(data)
+
+
+def _touch(path: str):
+    open(path, "w").close()
+
+
+class ChunkError(ValueError):
+    """Chunk non valido (indice fuori range, lunghezza o checksum errati)"""
+
+
+class UploadSessionManager:
+    """
+    Ogni sessione vive in {STORAGE_PATH}/.uploads/{session_id}/:
+    - session.json: metadati della sessione
+    - data: file finale, pre-allocato, in cui ogni chunk è scritto al suo offset
+    - chunks/{index}: marker dei chunk ricevuti (sopravvivono a un riavvio)
+
+    I chunk possono arrivare in qualsiasi ordine e in parallelo. Il file `data`
+    è già il file assemblato, quindi il commit non copia nulla. Lo SHA-256 viene
+    avanzato in memoria man mano che si completa un prefisso contiguo di chunk,
+    così al commit resta da leggere solo la parte non ancora verificata.
+
+    Lo stato della sessione (open | committing | discarding) sta nella tabella
+    upload_sessions del DB locale, così commit e annullamenti sono serializzati
+    anche tra più worker.
+    """
+
+    def __init__(self):
+        self.engine: Optional[Engine] = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # session_id -> (hasher, indice del prossimo chunk da includere nel digest)
+        self._hashers: Dict[str, tuple] = {}
+
+    def start(self, engine: Engine):
+        """Collega il DB locale che contiene lo stato delle sessioni"""
+        self.engine = engine
+
+    @property
+    def root(self) -> str:
+        return os.path.join(settings.STORAGE_PATH, ".uploads")
+
+    def _session_dir(self, session_id: str) -> str:
+        return os.path.join(self.root, session_id)
+
+    def _data_path(self, session_id: str) -> str:
+        return os.path.join(self._session_dir(session_id), "data")
+
+    def _chunks_dir(self, session_id: str) -> str:
+        return os.path.join(self._session_dir(session_id), "chunks")
+
+    def _lock(self, session_id: str) -> asyncio.Lock:
+        if session_id not in self._locks:
+            self._locks[session_id] = asyncio.Lock()
+        return self._locks[session_id]
+
+    def create(self, user_id: str, name: str, path: str, size: int,
+               chunk_size: Optional[int] = None, mime_type: Optional[str] = None,
+               checksum: Optional[str] = None) -> UploadSession:
+        """Crea una nuova sessione e pre-alloca il file di destinazione"""
+        self.cleanup_expired()
+
+        session = UploadSession(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            name=name,
+            path=path,
+            size=size,
+            chunk_size=chunk_size or settings.UPLOAD_SESSION_CHUNK_SIZE,
+            mime_type=mime_type,
+            checksum=checksum.lower() if checksum else None,
+        )
+        os.makedirs(self._chunks_dir(session.id), exist_ok=True)
+        with open(self._data_path(session.id), "wb") as f:
+            f.truncate(size)
+        with open(os.path.join(self._session_dir(session.id), "session.json"), "w") as f:
+            json.dump(asdict(session), f)
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO upload_sessions (id, user_id, status, created_at, updated_at) "
+                    "VALUES (:id, :user_id, 'open', :now, :now)"
+                ),
+                {"id": session.id, "user_id": user_id, "now": now},
+            )
+
+        logger.info(f"Upload session {session.id} created: {name} ({size} bytes, {session.total_chunks} chunks)")
+        return session
+
+    def get(self, session_id: str) -> Optional[UploadSession]:
+        """Carica una sessione dal disco, None se non esiste"""
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return None
+        try:
+            with open(os.path.join(self._session_dir(session_id), "session.json")) as f:
+                return UploadSession(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def received_chunks(self, session: UploadSession) -> List[int]:
+        """Indici dei chunk già ricevuti, ordinati"""
+        try:
+            return sorted(int(name) for name in os.listdir(self._chunks_dir(session.id)))
+        except FileNotFoundError:
+            return []
+
+    def missing_chunks(self, session: UploadSession) -> List[int]:
+        received = set(self.received_chunks(session))
+        return [i for i in range(session.total_chunks) if i not in received]
+
+    async def write_chunk(self, session: UploadSession, index: int, body: AsyncIterator[bytes],
+                          expected_sha256: Optional[str] = None):
+        """
+        Scrive un chunk direttamente al suo offset nel file finale.
+        Il chunk è segnato come ricevuto solo se lunghezza (e checksum, se fornito) sono corretti.
+        """
+        if index < 0 or index >= session.total_chunks:
+            raise ChunkError(f"Chunk index {index} out of range (0-{session.total_chunks - 1})")
+
+        marker = os.path.join(self._chunks_dir(session.id), str(index))
+        if await run_io(os.path.exists, marker):
+            # Ritrasmissione di un chunk già ricevuto (es. dopo un timeout): idempotente
+            async for _ in body:
+                pass
+            return
+
+        expected_length = session.chunk_length(index)
+        offset = index * session.chunk_size
+        hasher = hashlib.sha256()
+        written = 0
+
+        fd = await run_io(os.open, self._data_path(session.id), os.O_WRONLY)
+        try:
+            async for piece in body:
+                if written + len(piece) > expected_length:
+                    raise ChunkError(f"Chunk {index} exceeds expected length {expected_length}")
+                await run_io(_pwrite_and_hash, fd, hasher, piece, offset + written)
+                written += len(piece)
+        finally:
+            os.close(fd)
+
+        if written != expected_length:
+            raise ChunkError(f"Chunk {index} has {written} bytes, expected {expected_length}")
+        if expected_sha256 and hasher.hexdigest() != expected_sha256.lower():
+            raise ChunkError(f"Chunk {index} checksum mismatch")
+
+        await run_io(_touch, marker)
+        await self._advance_hash(session)
+
+    async def _advance_hash(self, session: UploadSession):
+        """Include nel digest tutti i chunk contigui già ricevuti"""
+        async with self._lock(session.id):
+            hasher, next_index = self._hashers.get(session.id, (hashlib.sha256(), 0))
+            received = set(self.received_chunks(session))
+            if next_index in received:
+                next_index = await run_io(self._hash_contiguous, session, hasher, next_index, received)
+            self._hashers[session.id] = (hasher, next_index)
+
+    def _hash_contiguous(self, session: UploadSession, hasher, next_index: int, received: set) -> int:
+        """Legge e aggiunge al digest i chunk contigui a partire da next_index (bloccante)"""
+        with open(self._data_path(session.id), "rb") as f:
+            f.seek(next_index * session.chunk_size)
+            while next_index in received:
+                hasher.update(f.read(session.chunk_length(next_index)))
+                next_index += 1
+        return next_index
+
+    async def finalize(self, session: UploadSession) -> tuple:
+        """
+        Completa il digest e restituisce (data_path, checksum).
+        Il chiamante deve verificare che non manchino chunk.
+        """
+        await self._advance_hash(session)
+        hasher, _ = self._hashers[session.id]
+        return self._data_path(session.id), hasher.hexdigest()
+
+    def _claim(self, session_id: str, status: str) -> bool:
+        """
+        Porta la sessione da open a `status`; False se un altro worker l'ha già presa.
+        L'UPDATE condizionale è atomico: di due richieste concorrenti ne passa una sola.
+        """
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as conn:
+            updated = conn.execute(
+                text(
+                    "UPDATE upload_sessions SET status = :status, updated_at = :now "
+                    "WHERE id = :id AND status = 'open'"
+                ),
+                {"id": session_id, "status": status, "now": now},
+            ).rowcount
+        if updated:
+            return True
+
+        # Sessione creata prima della tabella di stato: la riga nasce già nello stato richiesto
+        # (la chiave primaria fa fallire l'insert concorrente, o quello di una sessione già presa)
+        session = self.get(session_id)
+        if session is None:
+            return False
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    text(
+                        "INSERT INTO upload_sessions (id, user_id, status, created_at, updated_at) "
+                        "VALUES (:id, :user_id, :status, :created_at, :now)"
+                    ),
+                    {
+                        "id": session_id,
+                        "user_id": session.user_id,
+                        "status": status,
+                        "created_at": datetime.fromisoformat(session.created_at),
+                        "now": now,
+                    },
+                )
+            return True
+        except IntegrityError:
+            return False
+
+    def begin_commit(self, session_id: str) -> bool:
+        """Segna la sessione come in commit; False se è già in commit o in annullamento"""
+        return self._claim(session_id, "committing")
+
+    def end_commit(self, session_id: str):
+        """Riapre una sessione il cui commit non è andato a buon fine (se non è stata eliminata)"""
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "UPDATE upload_sessions SET status = 'open', updated_at = :now "
+                    "WHERE id = :id AND status = 'committing'"
+                ),
+                {"id": session_id, "now": datetime.now(timezone.utc)},
+            )
+
+    def discard_if_open(self, session_id: str) -> bool:
+        """Elimina la sessione se non è in commit; False se un commit è in corso"""
+        if not self._claim(session_id, "discarding"):
+            return False
+        self.discard(session_id)
+        return True
+
+    def discard(self, session_id: str):
+        """Elimina la sessione e i dati parziali"""
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+        self._hashers.pop(session_id, None)
+        self._locks.pop(session_id, None)
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM upload_sessions WHERE id = :id"), {"id": session_id})
+
+    def cleanup_expired(self):
+        """Rimuove le sessioni più vecchie di UPLOAD_SESSION_TTL_HOURS"""
+        if not os.path.isdir(self.root):
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+        with self.engine.begin() as conn:
+            # Un commit fermo da più del TTL appartiene a un worker terminato
+            conn.execute(
+                text(
+                    "UPDATE upload_sessions SET status = 'open', updated_at = :now "
+                    "WHERE status IN ('committing', 'discarding') AND updated_at < :cutoff"
+                ),
+                {"now": datetime.now(timezone.utc), "cutoff": cutoff},
+            )
+            expired_ids = conn.execute(
+                text("SELECT id FROM upload_sessions WHERE created_at < :cutoff"), {"cutoff": cutoff}
+            ).scalars().all()
+        session_ids = os.listdir(self.root)
+        for session_id in session_ids:
+            session = self.get(session_id)
+            if session is not None and datetime.fromisoformat(session.created_at) >= cutoff:
+                continue
+            if session is not None and not self._claim(session_id, "discarding"):
+                continue  # Commit in corso
+            logger.info(f"Removing expired upload session {session_id}")
+            self.discard(session_id)
+        # Righe rimaste senza la cartella della sessione (es. riavvio durante un discard)
+        for session_id in set(expired_ids) - set(session_ids):
+            self.discard(session_id)
+
+
+upload_sessions = UploadSessionManager()
@@ -0,0 +1,153 @@
+"""Registro dei volumi di storage: distribuzione dei blob su più dischi"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import errno
+import hashlib
+import logging
+import math
+import os
+import shutil
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"
+
+
+@dataclass(frozen=True)
+class StorageVolume:
+    """Un disco (o una directory) che ospita blob in {path}/blobs/ab/cd/<sha256>"""
+    name: str
+    path: str
+    weight: Optional[float] = None  # Quota relativa dei blob; None = capacità del disco in GiB
+
+    @property
+    def blobs_root(self) -> str:
+        return os.path.join(self.path, "blobs")
+
+    @property
+    def temp_dir(self) -> str:
+        """Temporanei sullo stesso filesystem dei blob, perché os.replace sia atomico"""
+        return os.path.join(self.path, ".tmp")
+
+
+def parse_volume_spec(spec: str) -> StorageVolume:
+    """'nome=/mnt/disco2' oppure 'nome=/mnt/disco2@peso'"""
+    name, sep, rest = spec.partition("=")
+    if not sep or not name.strip() or not rest.strip():
+        raise ValueError(f"Invalid storage volume '{spec}': expected name=/path[@weight]")
+    path, _, weight = rest.partition("@")
+    return StorageVolume(name=name.strip(), path=path.strip(), weight=float(weight) if weight else None)
+
+
+def _rendezvous_score(volume: str, checksum: str, weight: float) -> float:
+    """Punteggio del rendezvous hashing pesato: il volume con il punteggio più alto è il preferito"""
+    digest = hashlib.blake2b(f"{volume}:{checksum}".encode(), digest_size=8).digest()
+    uniform = (int.from_bytes(digest, "big") + 0.5) / 2 ** 64
+    return weight / -math.log(uniform)
+
+
+class VolumeRegistry:
+    """
+    Volumi su cui distribuire i blob. Il primario è STORAGE_PATH (temporanei, sessioni di
+    upload, miniature, chunk e file legacy restano lì); gli altri ospitano solo blob.
+
+    Ogni checksum ha un ordine di preferenza dei volumi calcolato con rendezvous hashing
+    pesato (un consistent hash senza ring): aggiungere un volume sposta su di esso solo la
+    quota di blob che gli spetta, e una lettura trova il blob con una stat sul primo volume
+    della lista, senza nessuna tabella di lookup. In scrittura si salta un volume senza
+    abbastanza spazio libero e si passa al successivo nell'ordine.
+    """
+
+    def __init__(self, volumes: List[StorageVolume], min_free_bytes: int = 0):
+        if not volumes:
+            raise ValueError("At least one storage volume is required")
+        names = [volume.name for volume in volumes]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Duplicate storage volume names: {names}")
+        self.volumes = volumes
+        self.min_free_bytes = min_free_bytes
+        self._by_name = {volume.name: volume for volume in volumes}
+        self._weights: Optional[Dict[str, float]] = None
+
+    @classmethod
+    def from_settings(cls) -> "VolumeRegistry":
+        volumes = [StorageVolume(PRIMARY, settings.STORAGE_PATH, settings.STORAGE_PRIMARY_WEIGHT)]
+        volumes += [parse_volume_spec(spec) for spec in settings.STORAGE_VOLUMES]
+        return cls(volumes, min_free_bytes=settings.STORAGE_VOLUME_MIN_FREE_MB * 1024 * 1024)
+
+    @property
+    def primary(self) -> StorageVolume:
+        return self.volumes[0]
+
+    def get(self, name: str) -> Optional[StorageVolume]:
+        return self._by_name.get(name)
+
+    def weights(self) -> Dict[str, float]:
+        """Pesi dei volumi, calcolati al primo uso (la capacità di un disco non cambia)"""
+        if self._weights is None:
+            weights = {}
+            for volume in self.volumes:
+                if volume.weight is not None:
+                    weights[volume.name] = volume.weight
+                    continue
+                try:
+                    weights[volume.name] = max(shutil.disk_usage(volume.path).total / 1024 ** 3, 1.0)
+                except OSError:
+                    weights[volume.name] = 1.0
+            self._weights = weights
+        return self._weights
+
+    def signature(self) -> str:
+        """Identifica la configurazione: se cambia, la posizione preferita dei blob cambia"""
+        weights = self.weights()
+        return ",".join(f"{v.name}={os.path.abspath(v.path)}@{weights[v.name]:.3f}" for v in self.volumes)
+
+    def ranked(self, checksum: str) -> List[StorageVolume]:
+        """Volumi in ordine di preferenza per il blob `checksum`"""
+        if len(self.volumes) == 1:
+            return self.volumes
+        weights = self.weights()
+        return sorted(self.volumes, key=lambda v: _rendezvous_score(v.name, checksum, weights[v.name]), reverse=True)
+
+    def free_bytes(self, volume: StorageVolume) -> int:
+        try:
+            return shutil.disk_usage(volume.path).free
+        except FileNotFoundError:
+            return 0
+
+    def choose(self, checksum: str, size: int) -> StorageVolume:
+        """Il primo volume in ordine di preferenza con spazio per `size` byte oltre la riserva"""
+        ranked = self.ranked(checksum)
+        if len(ranked) == 1:
+            return ranked[0]
+        for volume in ranked:
+            if self.free_bytes(volume) >= size + self.min_free_bytes:
+                return volume
+        raise OSError(errno.ENOSPC, f"No storage volume has {size} bytes free")
+
+    def volume_of(self, path: str) -> Optional[StorageVolume]:
+        """Volume a cui appartiene un path, None se è fuori da tutti"""
+        path = os.path.abspath(path)
+        for volume in self.volumes:
+            if path.startswith(os.path.abspath(volume.path) + os.sep):
+                return volume
+        return None
+
+    def relative_path(self, path: str) -> Optional[tuple]:
+        """(nome del volume, path relativo alla sua radice), None se il path è fuori dai volumi"""
+        volume = self.volume_of(path)
+        if volume is None:
+            return None
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(volume.path))
+        return volume.name, relative.replace(os.sep, "/")
+
+    def same_filesystem(self, path: str, volume: StorageVolume) -> bool:
+        try:
+            return os.stat(path).st_dev == os.stat(volume.path).st_dev
+        except FileNotFoundError:
+            return False
+
+
+storage_volumes = VolumeRegistry.from_settings()
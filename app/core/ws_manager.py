@@ -1,25 +1,38 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 from fastapi import WebSocket
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Oltre questo tempo un client lento non rallenta chi pubblica l'evento
+SEND_TIMEOUT = 5.0
+
 class ConnectionManager:
     """Gestisce le connessioni WebSocket attive"""
     
     def __init__(self):
         # Lista di connessioni attive
         self.active_connections: List[WebSocket] = []
+        # Connessioni autenticate per utente, per gli eventi privati (es. modifiche ai file)
+        self.user_connections: Dict[str, List[WebSocket]] = {}
         
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, user_id: Optional[str] = None):
         await websocket.accept()
         self.active_connections.append(websocket)
+        if user_id:
+            self.user_connections.setdefault(user_id, []).append(websocket)
         logger.info(f"WebSocket client connected. Total: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
             logger.info(f"WebSocket client disconnected. Total: {len(self.active_connections)}")
+        for user_id, connections in list(self.user_connections.items()):
+            if websocket in connections:
+                connections.remove(websocket)
+                if not connections:
+                    del self.user_connections[user_id]
 
     async def broadcast(self, message: Dict):
         """Invia un messaggio a tutti i client connessi"""
@@ -35,4 +48,18 @@ class ConnectionManager:
         for conn in disconnected:
             self.disconnect(conn)
 
-manager = ConnectionManager()            
+    async def send_to_user(self, user_id: str, message: Dict):
+        """Invia un messaggio solo alle connessioni dell'utente, in parallelo"""
+        connections = list(self.user_connections.get(user_id, []))
+        if not connections:
+            return
+        results = await asyncio.gather(
+            *(asyncio.wait_for(connection.send_json(message), SEND_TIMEOUT) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error sending to user {user_id}: {result!r}")
+                self.disconnect(connection)
+
+manager = ConnectionManager()
@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from supabase import create_client
 from contextlib import asynccontextmanager
+import functools
 import os
 from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
@@ -12,6 +13,20 @@ import logging
 from app.core.config import settings
 from app.core import deps
 from app.core.mock_supabase import MockSupabaseClient
+from app.core.local_db import init_local_schema
+from app.core.blob_store import BlobStore
+from app.core.folder_index import FolderIndex
+from app.core.change_journal import ChangeJournal
+from app.core.search_index import SearchIndex
+from app.core.quota import StorageQuota
+from app.core.device_state import DeviceStateCache
+from app.core.chunk_store import ChunkStore
+from app.core.scrubber import StorageScrubber
+from app.core.rebalancer import VolumeRebalancer
+from app.core.volumes import storage_volumes
+from app.core.io_pool import storage_io
+from app.core.media_pipeline import media_pipeline
+from app.core.upload_sessions import upload_sessions
 from app.api import auth, healthcheck, devices, files, ws, profiles
 
 # Setup logging
@@ -73,21 +88,92 @@ async def lifespan(app: FastAPI):
         with deps.local_db_engine.connect() as conn:
             conn.execute(text("SELECT 1"))
         logger.info("✅ Local Database connected")
+        
+        init_local_schema(deps.local_db_engine)
+        upload_sessions.start(deps.local_db_engine)
+        deps.blob_store = BlobStore(settings.STORAGE_PATH, deps.local_db_engine, storage_volumes)
+        if len(storage_volumes.volumes) > 1:
+            logger.info(f"✅ Storage volumes: {', '.join(v.name for v in storage_volumes.volumes)}")
+        deps.volume_rebalancer = VolumeRebalancer(deps.local_db_engine, deps.blob_store)
+        deps.volume_rebalancer.start()
+        deps.folder_index = FolderIndex(deps.local_db_engine)
+        deps.change_journal = ChangeJournal(deps.local_db_engine, settings.FILE_CHANGES_RETENTION_DAYS)
+        deps.search_index = SearchIndex(deps.local_db_engine, deps.change_journal)
+        deps.storage_quota = StorageQuota(deps.local_db_engine, deps.supabase_client)
+        deps.storage_quota.start()
+        if settings.CHUNK_STORE_ENABLED:
+            deps.chunk_store = ChunkStore(
+                settings.STORAGE_PATH,
+                deps.local_db_engine,
+                deps.blob_store,
+                min_size=settings.CDC_MIN_SIZE,
+                avg_size=settings.CDC_AVG_SIZE,
+                max_size=settings.CDC_MAX_SIZE,
+                keep_versions=settings.FILE_VERSIONS_KEEP
+            )
+            deps.chunk_store.start()
+            logger.info("✅ Chunk store enabled")
+        deps.storage_scrubber = StorageScrubber(
+            settings.STORAGE_PATH,
+            deps.local_db_engine,
+            deps.blob_store,
+            chunk_store=deps.chunk_store,
+            supabase=deps.supabase_client
+        )
+        deps.storage_scrubber.start()
     except Exception as e:
         logger.error(f"❌ Failed to connect to local PostgreSQL: {e}")
     
+    # Pipeline delle miniature (dopo Supabase: salva i metadata nei record dei file)
+    media_pipeline.start(
+        on_metadata=functools.partial(files.on_media_processed, deps.supabase_client, deps.search_index)
+    )
+    
     # Inizializza Redis
+    redis_available = False
     try:
         deps.redis_client = Redis.from_url(settings.REDIS_URL, decode_responses=True)
         deps.redis_client.ping()
+        redis_available = True
         logger.info("✅ Redis connected")
     except Exception as e:
         logger.warning(f"⚠️  Redis not available: {e}")
     
+    # Cache dello stato dei dispositivi (su Redis se disponibile, altrimenti in memoria)
+    deps.device_state_cache = DeviceStateCache(
+        deps.supabase_client,
+        redis=deps.redis_client if redis_available and settings.DEVICE_STATE_REDIS else None
+    )
+    deps.device_state_cache.start()
+    
+    # Driver dei dispositivi: connette in background quelli usati di recente e ne legge lo stato
+    try:
+        recent = devices.recent_devices(deps.supabase_client, deps.device_state_cache)
+    except Exception as e:
+        logger.warning(f"⚠️  Could not load recent devices for preloading: {e}")
+        recent = []
+    deps.device_manager.start(
+        preload=recent,
+        on_state_change=functools.partial(devices.on_polled_state, deps.device_state_cache)
+    )
+    
     yield
     
     # Shutdown
     logger.info("👋 Shutting down Synthetix OS API...")
+    await media_pipeline.stop()
+    await deps.device_manager.stop()
+    if deps.device_state_cache:
+        await deps.device_state_cache.stop()
+    if deps.storage_scrubber:
+        await deps.storage_scrubber.stop()
+    if deps.volume_rebalancer:
+        await deps.volume_rebalancer.stop()
+    if deps.storage_quota:
+        await deps.storage_quota.stop()
+    if deps.chunk_store:
+        await deps.chunk_store.stop()
+    storage_io.shutdown()
     if deps.local_db_engine:
         deps.local_db_engine.dispose()
     if deps.redis_client:
@@ -115,6 +201,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Content-Range", "Accept-Ranges"],
 )
 
 # Include routers
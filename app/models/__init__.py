@@ -1,7 +1,31 @@
 """Models package initialization"""
 
 from .device import DeviceBase, DeviceCreate, DeviceUpdate, DeviceResponse, DeviceLog
-from .file import FileBase, FileCreate, FileResponse, FileUploadResponse
+from .file import (
+    ArchiveRequest,
+    ChunkedCommitRequest,
+    ChunkParams,
+    ChunkRef,
+    FileBase,
+    FileChange,
+    FileChangesResponse,
+    FileCreate,
+    FileResponse,
+    FileUploadResponse,
+    FileUpdate,
+    FileVersionDetail,
+    FileVersionResponse,
+    FolderStats,
+    FolderResponse,
+    HashCheckRequest,
+    HashCheckResponse,
+    SearchResult,
+    SignedUrlResponse,
+    StorageUsageResponse,
+    UploadByHashRequest,
+    UploadSessionCreate,
+    UploadSessionResponse,
+)
 
 __all__ = [
     "DeviceBase",
@@ -9,8 +33,27 @@ __all__ = [
     "DeviceUpdate",
     "DeviceResponse",
     "DeviceLog",
+    "ArchiveRequest",
+    "ChunkedCommitRequest",
+    "ChunkParams",
+    "ChunkRef",
     "FileBase",
+    "FileChange",
+    "FileChangesResponse",
     "FileCreate",
     "FileResponse",
     "FileUploadResponse",
+    "FileUpdate",
+    "FileVersionDetail",
+    "FileVersionResponse",
+    "FolderStats",
+    "FolderResponse",
+    "HashCheckRequest",
+    "HashCheckResponse",
+    "SearchResult",
+    "SignedUrlResponse",
+    "StorageUsageResponse",
+    "UploadByHashRequest",
+    "UploadSessionCreate",
+    "UploadSessionResponse",
 ]
@@ -1,7 +1,36 @@
-from pydantic import BaseModel
-from typing import Dict, Any
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Optional
 
 class DeviceCommand(BaseModel):
     """Schema per inviare comandi a un device"""
     command: str
     params: Dict[str, Any]
+
+
+class DeviceCommandTarget(BaseModel):
+    """Dispositivo di un comando di gruppo, con parametri propri opzionali (scene)"""
+    device_id: str
+    params: Optional[Dict[str, Any]] = None  # None = params del comando di gruppo
+
+
+class DeviceGroupCommand(BaseModel):
+    """Comando inviato in parallelo a più dispositivi (gruppo o scena)"""
+    command: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+    devices: List[DeviceCommandTarget] = Field(..., min_length=1)
+    timeout: Optional[float] = Field(None, gt=0)  # Secondi per dispositivo (default DEVICE_COMMAND_TIMEOUT)
+
+
+class DeviceCommandResult(BaseModel):
+    """Esito del comando su un singolo dispositivo"""
+    device_id: str
+    status: str  # ok | failed | timeout | not_found
+    state: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+
+class DeviceGroupCommandResponse(BaseModel):
+    """Esiti per dispositivo di un comando di gruppo"""
+    results: List[DeviceCommandResult]
+    succeeded: int
+    failed: int
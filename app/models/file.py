@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Optional, List
 from datetime import datetime
 
 
@@ -22,6 +22,7 @@ class FileResponse(FileBase):
     user_id: str
     storage_path: str
     checksum: Optional[str] = None
+    metadata: Optional[dict] = None  # Dimensioni, EXIF e miniature disponibili (per le immagini)
     created_at: datetime
     updated_at: Optional[datetime] = None
     
@@ -35,3 +36,153 @@ class FileUploadResponse(BaseModel):
     name: str
     size: int
     url: str
+
+
+class ArchiveRequest(BaseModel):
+    """Schema per scaricare una cartella o più file come ZIP"""
+    prefix: Optional[str] = None  # Cartella virtuale (es: /Photos/2024)
+    file_ids: Optional[List[str]] = None
+    name: Optional[str] = None  # Nome dell'archivio
+
+
+class SignedUrlResponse(BaseModel):
+    """Link di download firmato e temporaneo"""
+    url: str
+    expires_at: datetime
+
+
+class FileUpdate(BaseModel):
+    """Schema per rinominare o spostare un file"""
+    name: Optional[str] = None
+    path: Optional[str] = None  # Nuovo path virtuale completo (es: /Documents/report.pdf)
+
+
+class FolderStats(BaseModel):
+    """Cartella virtuale con dimensioni aggregate (sottocartelle incluse)"""
+    path: str
+    name: str
+    total_size: int
+    file_count: int
+
+
+class FolderResponse(FolderStats):
+    """Contenuto di una cartella: sottocartelle dirette e breadcrumb"""
+    parent: Optional[str] = None
+    breadcrumbs: List[FolderStats]
+    folders: List[FolderStats]
+
+
+class UploadByHashRequest(BaseModel):
+    """Schema per creare un file da un contenuto già presente sul server"""
+    name: str
+    path: Optional[str] = None
+    size: int = Field(..., ge=0)
+    checksum: str = Field(..., pattern="^[0-9a-fA-F]{64}$")
+    mime_type: Optional[str] = None
+
+
+class HashCheckRequest(BaseModel):
+    """Lista di checksum da verificare prima di un upload"""
+    checksums: List[str] = Field(..., max_length=10000)
+
+
+class HashCheckResponse(BaseModel):
+    """Checksum già presenti nel cloud dell'utente e checksum da caricare"""
+    present: List[str]
+    missing: List[str]
+
+
+class UploadSessionCreate(BaseModel):
+    """Schema per aprire una sessione di upload a chunk"""
+    name: str
+    path: Optional[str] = None
+    size: int = Field(..., ge=0)
+    mime_type: Optional[str] = None
+    checksum: Optional[str] = None  # SHA256 atteso del file completo
+    chunk_size: Optional[int] = Field(None, gt=0)
+
+
+class UploadSessionResponse(BaseModel):
+    """Stato di una sessione di upload a chunk"""
+    session_id: str
+    name: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int]
+    missing_chunks: List[int]
+
+
+class ChunkRef(BaseModel):
+    """Chunk di un manifest: SHA256 e dimensione"""
+    checksum: str = Field(..., pattern="^[0-9a-fA-F]{64}$")
+    size: int = Field(..., gt=0)
+
+
+class ChunkParams(BaseModel):
+    """Parametri del chunking content-defined usati dal server"""
+    algorithm: str
+    min_size: int
+    avg_size: int
+    max_size: int
+
+
+class ChunkedCommitRequest(BaseModel):
+    """Schema per creare o aggiornare un file a partire da un manifest di chunk"""
+    path: str  # Path virtuale completo (es: /Documents/report.pdf)
+    mime_type: Optional[str] = None
+    chunks: List[ChunkRef] = Field(..., max_length=100000)
+
+
+class FileVersionResponse(BaseModel):
+    """Versione di un file"""
+    version: int
+    size: int
+    checksum: str
+    created_at: datetime
+
+
+class FileVersionDetail(FileVersionResponse):
+    """Versione di un file con il suo manifest di chunk"""
+    chunks: List[ChunkRef]
+
+
+class FileChange(BaseModel):
+    """Modifica al catalogo dei file"""
+    seq: int
+    op: str  # created | updated | moved | deleted
+    file_id: str
+    path: str
+    old_path: Optional[str] = None  # Solo per moved
+    size: Optional[int] = None
+    checksum: Optional[str] = None
+    mime_type: Optional[str] = None
+    created_at: datetime
+
+
+class SearchResult(BaseModel):
+    """File trovato dalla ricerca, con il suo punteggio di rilevanza"""
+    id: str
+    name: str
+    path: str
+    size: int
+    mime_type: Optional[str] = None
+    score: int
+    modified_at: Optional[datetime] = None
+
+
+class FileChangesResponse(BaseModel):
+    """Pagina del journal delle modifiche con il cursore da usare alla richiesta successiva"""
+    changes: List[FileChange]
+    cursor: str
+    has_more: bool
+
+
+class StorageUsageResponse(BaseModel):
+    """Spazio occupato dall'utente e quota (None = illimitata)"""
+    used_bytes: int
+    file_count: int
+    quota_bytes: Optional[int] = None
+    available_bytes: Optional[int] = None
+    reserved_bytes: int = 0  # Prenotati dagli upload in corso
+    reconciled_at: Optional[datetime] = None
@@ -0,0 +1 @@
+"""Strumenti da riga di comando per la manutenzione del server"""
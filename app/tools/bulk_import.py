@@ -0,0 +1,396 @@
+"""
+Import in blocco di una directory già presente sul server nel catalogo di un utente.
+
+    python -m app.tools.bulk_import --user-id <uuid> --source /data/storage/import/alice --dest /Photos
+
+I file vengono hashati in parallelo su più processi, spostati o collegati (hardlink)
+nel layout dei blob e registrati in `files` a blocchi. Dopo ogni blocco viene salvato
+un checkpoint: se l'import si interrompe, rilanciando lo stesso comando riparte dal
+punto in cui era arrivato.
+
+Modalità:
+- move (default): il file viene collegato nel layout dei blob e l'originale eliminato
+  dopo la registrazione nel catalogo.
+- copy: copia, anche da fuori dal volume di storage.
+- hardlink: il file originale resta dov'è e condivide l'inode con il blob, quindi viene
+  reso di sola lettura. Modificarlo comunque sul posto corrompe il blob per tutti gli
+  utenti che lo deduplicano: da usare solo su sorgenti che nessuno tocca più.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+import argparse
+import errno
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from supabase import create_client
+
+from app.core.config import settings
+from app.core.blob_store import BlobStore
+from app.core.change_journal import ChangeJournal
+from app.core.folder_index import FolderIndex, normalize_virtual_path
+from app.core.quota import StorageQuota
+from app.core.local_db import init_local_schema
+from app.core.mock_supabase import MockSupabaseClient
+from app.core.storage import INTERNAL_DIRS, make_temp
+from app.core.volumes import storage_volumes
+
+logger = logging.getLogger("bulk_import")
+
+MODES = ("move", "copy", "hardlink")
+HASH_READ_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> Tuple[str, int, Optional[str], Optional[str]]:
+    """(path, size, sha256, errore) - eseguita nei processi del pool"""
+    try:
+        hasher = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(HASH_READ_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                size += len(data)
+        return path, size, hasher.hexdigest(), None
+    except OSError as e:
+        return path, 0, None, str(e)
+
+
+def walk_sorted(root: str, resume_after: Optional[List[str]] = None) -> Iterator[List[str]]:
+    """
+    Visita in profondità con file e directory ordinati per nome insieme: l'ordine di
+    visita coincide con l'ordine lessicografico delle liste di componenti, quindi per
+    riprendere basta saltare tutto ciò che è <= dell'ultimo elemento importato.
+    """
+    skip_internal = os.path.isdir(settings.STORAGE_PATH) and os.path.samefile(root, settings.STORAGE_PATH)
+
+    def visit(parts: List[str]):
+        directory = os.path.join(root, *parts)
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError as e:
+            logger.warning(f"Cannot read {directory}: {e}")
+            return
+        for entry in entries:
+            current = parts + [entry.name]
+            if not parts and skip_internal and entry.name in INTERNAL_DIRS:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                # Salta le directory interamente già importate
+                if resume_after is not None and current < resume_after[:len(current)]:
+                    continue
+                yield from visit(current)
+            elif entry.is_file(follow_symlinks=False):
+                if resume_after is not None and current <= resume_after:
+                    continue
+                yield current
+
+    yield from visit([])
+
+
+@dataclass
+class ImportCheckpoint:
+    """Stato salvato dopo ogni blocco importato"""
+    user_id: str
+    source: str
+    dest: str
+    last: Optional[List[str]] = None  # Componenti dell'ultimo file registrato
+    files: int = 0
+    bytes: int = 0
+    duplicates: int = 0
+    skipped: int = 0
+    errors: int = 0
+
+    @staticmethod
+    def path_for(user_id: str, source: str) -> str:
+        key = hashlib.sha1(f"{user_id}:{os.path.abspath(source)}".encode()).hexdigest()[:16]
+        return os.path.join(settings.STORAGE_PATH, ".imports", f"{user_id}-{key}.json")
+
+    @classmethod
+    def load(cls, path: str, user_id: str, source: str, dest: str) -> "ImportCheckpoint":
+        try:
+            with open(path) as f:
+                checkpoint = cls(**json.load(f))
+        except FileNotFoundError:
+            return cls(user_id=user_id, source=os.path.abspath(source), dest=dest)
+        if checkpoint.dest != dest:
+            raise SystemExit(f"Checkpoint {path} was created with --dest {checkpoint.dest}")
+        return checkpoint
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".checkpoint_")
+        with os.fdopen(fd, "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(temp_path, path)
+
+
+class BulkImporter:
+    """Importa i file di `source` sotto il path virtuale `dest` dell'utente"""
+
+    def __init__(self, supabase, engine, user_id: str, source: str, dest: str, mode: str,
+                 workers: int, batch_size: int, checkpoint: ImportCheckpoint, checkpoint_path: str):
+        self.supabase = supabase
+        self.blob_store = BlobStore(settings.STORAGE_PATH, engine, storage_volumes)
+        self.folder_index = FolderIndex(engine)
+        self.change_journal = ChangeJournal(engine, settings.FILE_CHANGES_RETENTION_DAYS)
+        self.storage_quota = StorageQuota(engine, supabase)
+        self.user_id = user_id
+        self.source = os.path.abspath(source)
+        self.dest = normalize_virtual_path(dest) if dest.strip("/") else ""  # "" = radice
+        self.mode = mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.checkpoint_path = checkpoint_path
+        self._hardlink_fallback_logged = False
+        self._started = time.monotonic()
+        self._hashed_bytes = 0
+
+    def run(self):
+        logger.info(f"Importing {self.source} -> {self.user_id}:{self.dest} ({self.mode}, {self.workers} workers)")
+        if self.checkpoint.last:
+            logger.info(f"Resuming after {'/'.join(self.checkpoint.last)} ({self.checkpoint.files} files already imported)")
+
+        batch = []
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for parts, result in self._hash_in_parallel(pool):
+                batch.append((parts, result))
+                if len(batch) >= self.batch_size:
+                    self._commit_batch(batch)
+                    batch = []
+            if batch:
+                self._commit_batch(batch)
+
+        self._report(final=True)
+        # Import completo: un nuovo lancio ripartirà da capo (i file già registrati vengono saltati)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _hash_in_parallel(self, pool: ProcessPoolExecutor):
+        """Risultati dell'hashing nell'ordine di visita, con un numero limitato di job in volo"""
+        window = deque()
+        max_in_flight = self.workers * 8
+        for parts in walk_sorted(self.source, self.checkpoint.last):
+            window.append((parts, pool.submit(hash_file, os.path.join(self.source, *parts))))
+            if len(window) >= max_in_flight:
+                parts_done, future = window.popleft()
+                yield parts_done, future.result()
+        while window:
+            parts_done, future = window.popleft()
+            yield parts_done, future.result()
+
+    def _commit_batch(self, batch: List[Tuple[List[str], tuple]]):
+        entries = []
+        for parts, (path, size, checksum, error) in batch:
+            self._hashed_bytes += size
+            if error:
+                logger.warning(f"Skipping {path}: {error}")
+                self.checkpoint.errors += 1
+                continue
+            try:
+                virtual_path = normalize_virtual_path(f"{self.dest}/{'/'.join(parts)}")
+            except ValueError as e:
+                logger.warning(f"Skipping {path}: {e}")
+                self.checkpoint.skipped += 1
+                continue
+            entries.append((path, virtual_path, size, checksum))
+
+        # Un rilancio dopo un crash può ritrovare righe già inserite dall'ultimo blocco
+        existing = {}
+        paths = [virtual_path for _, virtual_path, _, _ in entries]
+        for i in range(0, len(paths), settings.FILE_LIST_MAX_LIMIT):
+            result = self.supabase.table("files").select("path,checksum").eq("user_id", self.user_id) \
+                .in_("path", paths[i:i + settings.FILE_LIST_MAX_LIMIT]).execute()
+            existing.update((row["path"], row.get("checksum")) for row in result.data)
+        if existing:
+            self.checkpoint.skipped += len(existing)
+            if self.mode == "move":
+                self._remove_imported([entry for entry in entries if existing.get(entry[1]) == entry[3]])
+            entries = [entry for entry in entries if entry[1] not in existing]
+
+        # Prima i riferimenti, poi i file su disco: un release() concorrente del server
+        # non può eliminare un blob che stiamo per riusare
+        self.blob_store.add_references([(checksum, size) for _, _, size, checksum in entries])
+        rows = []
+        try:
+            for source_path, virtual_path, size, checksum in entries:
+                blob_path, duplicate = self._place(source_path, checksum, size)
+                if duplicate:
+                    self.checkpoint.duplicates += 1
+                rows.append({
+                    "user_id": self.user_id,
+                    "name": os.path.basename(virtual_path),
+                    "path": virtual_path,
+                    "size": size,
+                    "mime_type": mimetypes.guess_type(virtual_path)[0],
+                    "storage_path": blob_path,
+                    "checksum": checksum,
+                    "created_at": datetime.utcnow().isoformat(),
+                })
+            inserted = self.supabase.table("files").insert(rows).execute().data if rows else []
+        except BaseException:
+            # Riferimenti presi per tutto il blocco: anche per i file non ancora messi in posizione
+            for _, _, _, checksum in entries:
+                self.blob_store.release(checksum)
+            raise
+
+        if rows:
+            self.change_journal.record_many(self.user_id, "created", [
+                {"file_id": row["id"], **{k: row.get(k) for k in ("path", "size", "checksum", "mime_type")}}
+                for row in inserted
+            ])
+            # L'indice delle cartelle si ricostruisce dal catalogo al prossimo accesso
+            self.folder_index.invalidate(self.user_id)
+            self.storage_quota.apply(self.user_id, sum(row["size"] for row in rows), len(rows))
+            self.checkpoint.files += len(rows)
+            self.checkpoint.bytes += sum(row["size"] for row in rows)
+            
+            # Gli originali si eliminano solo quando il catalogo punta ai blob
+            if self.mode == "move":
+                self._remove_imported(entries)
+
+        self.checkpoint.last = batch[-1][0]
+        self.checkpoint.save(self.checkpoint_path)
+        self._report()
+
+    def _place(self, source_path: str, checksum: str, size: int) -> Tuple[str, bool]:
+        """
+        Mette il contenuto nel blob store; restituisce il path del blob e True se esisteva
+        già (duplicato). Anche in modalità move si usa un hardlink: l'originale resta finché
+        il blocco non è registrato, così un errore del catalogo non perde dati.
+        """
+        blob_path = self.blob_store.locate(checksum)
+        if blob_path is not None:
+            return blob_path, True
+
+        volume = storage_volumes.choose(checksum, size)
+        blob_path = self.blob_store.blob_path(checksum, volume)
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if self.mode != "copy":
+            try:
+                os.link(source_path, blob_path)
+            except FileExistsError:
+                # Un upload del server ha salvato lo stesso checksum dopo locate()
+                return self.blob_store.locate(checksum) or blob_path, True
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                if not self._hardlink_fallback_logged:
+                    logger.warning("Source is on another filesystem: copying instead of hardlinking")
+                    self._hardlink_fallback_logged = True
+            else:
+                if self.mode == "hardlink":
+                    self._make_read_only(source_path)
+                return blob_path, False
+
+        os.makedirs(volume.temp_dir, exist_ok=True)
+        fd, temp_path = make_temp(volume.temp_dir, "import_")
+        os.close(fd)
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, blob_path)
+        return blob_path, False
+
+    @staticmethod
+    def _remove_imported(entries: List[tuple]):
+        """
+        Elimina gli originali già registrati (modalità move). Vale anche per quelli che un
+        crash tra l'insert e la rimozione ha lasciato: resterebbero hardlink scrivibili
+        a blob condivisi tramite la deduplica.
+        """
+        for source_path, _, _, _ in entries:
+            try:
+                os.remove(source_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _make_read_only(path: str):
+        """L'originale condivide l'inode con il blob: toglie i permessi di scrittura"""
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def _report(self, final: bool = False):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        c = self.checkpoint
+        message = (
+            f"{c.files} files, {c.bytes / 1024 ** 3:.2f} GiB imported | "
+            f"{c.duplicates} duplicates, {c.skipped} skipped, {c.errors} errors | "
+            f"hashing {self._hashed_bytes / 1024 ** 2 / elapsed:.1f} MB/s"
+        )
+        if final:
+            logger.info(f"Import completed in {elapsed:.0f}s: {message}")
+        else:
+            logger.info(message)
+
+
+def _supabase_client():
+    if "mock_key" in settings.SUPABASE_KEY or settings.SUPABASE_URL == "https://example.supabase.co":
+        logger.warning("Using MOCK Supabase Client: imported rows will not be persisted")
+        return MockSupabaseClient(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+    return create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Import an existing directory tree into a user's cloud")
+    parser.add_argument("--user-id", required=True, help="Owner of the imported files")
+    parser.add_argument("--source", required=True, help="Directory to import")
+    parser.add_argument("--dest", default="/", help="Destination virtual folder (default: /)")
+    parser.add_argument("--mode", choices=MODES, default="move",
+                        help="hardlink keeps the originals, read-only, sharing the blobs' inodes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Hashing processes")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per catalog insert")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    source = os.path.abspath(args.source)
+    if not os.path.isdir(source):
+        parser.error(f"{source} is not a directory")
+    storage_root = os.path.abspath(settings.STORAGE_PATH)
+    if args.mode != "copy" and os.path.commonpath([source, storage_root]) != storage_root:
+        parser.error(f"--mode {args.mode} requires a source inside STORAGE_PATH ({storage_root}); use --mode copy")
+
+    if args.dest.strip("/"):
+        try:
+            normalize_virtual_path(args.dest)
+        except ValueError as e:
+            parser.error(f"Invalid --dest: {e}")
+
+    connect_args = {"check_same_thread": False} if settings.DATABASE_URL.startswith("sqlite") else {}
+    engine = create_engine(settings.DATABASE_URL, connect_args=connect_args)
+    init_local_schema(engine)
+
+    checkpoint_path = ImportCheckpoint.path_for(args.user_id, source)
+    checkpoint = ImportCheckpoint.load(checkpoint_path, args.user_id, source, args.dest)
+    BulkImporter(
+        _supabase_client(),
+        engine,
+        user_id=args.user_id,
+        source=source,
+        dest=args.dest,
+        mode=args.mode,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        checkpoint=checkpoint,
+        checkpoint_path=checkpoint_path,
+    ).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
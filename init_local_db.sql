@@ -50,6 +50,152 @@ CREATE TABLE IF NOT EXISTS system_events (
     INDEX idx_system_events_type (event_type)
 );
 
+-- Blob content-addressed con reference counting (deduplicazione dello storage)
+CREATE TABLE IF NOT EXISTS blobs (
+    checksum VARCHAR(64) PRIMARY KEY,  -- SHA256 del contenuto
+    size BIGINT NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,  -- Numero di file che puntano al blob
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Indice delle cartelle virtuali con dimensioni aggregate (aggiornato dall'API)
+CREATE TABLE IF NOT EXISTS folders (
+    user_id VARCHAR(64) NOT NULL,
+    path TEXT NOT NULL,  -- Path virtuale della cartella (es: /Documents)
+    parent_path TEXT,  -- NULL per la root
+    total_size BIGINT NOT NULL DEFAULT 0,  -- Byte totali, sottocartelle incluse
+    file_count BIGINT NOT NULL DEFAULT 0,  -- File totali, sottocartelle incluse
+    PRIMARY KEY (user_id, path)
+);
+CREATE INDEX IF NOT EXISTS idx_folders_parent ON folders (user_id, parent_path);
+
+-- Chunk content-defined per versioni e upload delta (refcount 0 = caricato ma non ancora usato)
+CREATE TABLE IF NOT EXISTS chunks (
+    checksum VARCHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    blob_checksum VARCHAR(64),  -- Chunk dell'ultima versione: si legge da questo blob, senza file proprio
+    blob_offset BIGINT
+);
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS blob_checksum VARCHAR(64);
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS blob_offset BIGINT;
+CREATE INDEX IF NOT EXISTS idx_chunks_blob ON chunks (blob_checksum);
+
+-- Utenti che hanno caricato o possiedono un chunk
+CREATE TABLE IF NOT EXISTS chunk_owners (
+    user_id VARCHAR(64) NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    PRIMARY KEY (user_id, checksum)
+);
+
+-- Versioni dei file come manifest ordinati di chunk
+CREATE TABLE IF NOT EXISTS file_versions (
+    id SERIAL PRIMARY KEY,
+    file_id VARCHAR(64) NOT NULL,
+    user_id VARCHAR(64) NOT NULL,
+    version INTEGER NOT NULL,
+    size BIGINT NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    manifest TEXT NOT NULL,  -- JSON: [[sha256, size], ...]
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_file_versions_file ON file_versions (file_id, version);
+
+-- Journal delle modifiche ai file (delta sync dei client)
+CREATE TABLE IF NOT EXISTS file_changes (
+    user_id VARCHAR(64) NOT NULL,
+    seq BIGINT NOT NULL,
+    op VARCHAR(16) NOT NULL,  -- created | updated | moved | deleted
+    file_id VARCHAR(64) NOT NULL,
+    path TEXT NOT NULL,
+    old_path TEXT,
+    size BIGINT,
+    checksum VARCHAR(64),
+    mime_type VARCHAR(255),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, seq)
+);
+
+-- Sequenza corrente del journal per utente
+CREATE TABLE IF NOT EXISTS file_change_heads (
+    user_id VARCHAR(64) PRIMARY KEY,
+    seq BIGINT NOT NULL DEFAULT 0,
+    pruned_seq BIGINT NOT NULL DEFAULT 0
+);
+
+-- Indice di ricerca: campi restituiti dalla ricerca, per file
+CREATE TABLE IF NOT EXISTS search_documents (
+    user_id VARCHAR(64) NOT NULL,
+    file_id VARCHAR(64) NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size BIGINT NOT NULL DEFAULT 0,
+    mime_type VARCHAR(255),
+    tags TEXT,  -- JSON: lista dei tag
+    metadata_text TEXT,  -- Parole estratte dai metadata
+    modified_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (user_id, file_id)
+);
+
+-- Indice invertito: trigrammi del nome ('t:abc') e parole intere ('w:parola')
+CREATE TABLE IF NOT EXISTS search_terms (
+    user_id VARCHAR(64) NOT NULL,
+    term VARCHAR(72) NOT NULL,
+    file_id VARCHAR(64) NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, file_id)
+);
+CREATE INDEX IF NOT EXISTS idx_search_terms_file ON search_terms (user_id, file_id);
+
+-- Sequenza del journal già applicata all'indice di ricerca
+CREATE TABLE IF NOT EXISTS search_index_state (
+    user_id VARCHAR(64) PRIMARY KEY,
+    seq BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Spazio occupato per utente (contatori incrementali, riallineati periodicamente al catalogo)
+CREATE TABLE IF NOT EXISTS storage_usage (
+    user_id VARCHAR(64) PRIMARY KEY,
+    used_bytes BIGINT NOT NULL DEFAULT 0,
+    file_count BIGINT NOT NULL DEFAULT 0,
+    quota_bytes BIGINT,  -- NULL = quota di default (STORAGE_QUOTA_DEFAULT_MB)
+    generation BIGINT NOT NULL DEFAULT 0,
+    reconciled_at TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Avanzamento dello scrubber dello storage
+CREATE TABLE IF NOT EXISTS storage_scrub_state (
+    name VARCHAR(32) PRIMARY KEY,
+    phase VARCHAR(16),  -- blobs | chunks | sweep
+    cursor TEXT,
+    pass_started_at TIMESTAMP WITH TIME ZONE,
+    last_pass_finished_at TIMESTAMP WITH TIME ZONE,
+    stats TEXT,
+    last_pass_stats TEXT
+);
+
+-- Avanzamento del ribilanciamento dei blob tra i volumi
+CREATE TABLE IF NOT EXISTS storage_rebalance_state (
+    name VARCHAR(32) PRIMARY KEY,
+    signature TEXT,
+    pending_signature TEXT,
+    cursor VARCHAR(64),
+    stats TEXT,
+    updated_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Problemi di integrità trovati dallo scrubber
+CREATE TABLE IF NOT EXISTS storage_scrub_issues (
+    object_key TEXT NOT NULL,
+    kind VARCHAR(16) NOT NULL,  -- corrupt | missing | refcount
+    detail TEXT,
+    detected_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (object_key, kind)
+);
+
 -- Funzione per pulizia automatica dei log vecchi (retention policy)
 CREATE OR REPLACE FUNCTION cleanup_old_logs(retention_days INTEGER DEFAULT 30)
 RETURNS void AS $$
@@ -67,3 +213,11 @@ VALUES ('database_initialized', 'info', 'Local PostgreSQL database initialized s
 COMMENT ON TABLE device_logs IS 'Log ad alta frequenza per eventi dei dispositivi';
 COMMENT ON TABLE api_logs IS 'Log delle chiamate API per monitoring e debugging';
 COMMENT ON TABLE system_events IS 'Eventi di sistema e notifiche';
+COMMENT ON TABLE folders IS 'Albero delle cartelle virtuali con byte e file aggregati';
+COMMENT ON TABLE chunks IS 'Chunk content-defined condivisi tra le versioni dei file';
+COMMENT ON TABLE file_versions IS 'Storico delle versioni dei file come manifest di chunk';
+COMMENT ON TABLE blobs IS 'Contenuti fisici deduplicati per checksum con reference counting';
+COMMENT ON TABLE file_changes IS 'Journal delle modifiche ai file per la sincronizzazione incrementale';
+COMMENT ON TABLE storage_usage IS 'Byte e file per utente per le quote di storage, senza SUM sul catalogo';
+COMMENT ON TABLE search_terms IS 'Indice invertito per la ricerca fuzzy e full-text sui file';
+COMMENT ON TABLE storage_scrub_issues IS 'Contenuti corrotti, mancanti o con refcount non allineato al catalogo';
@@ -244,6 +244,8 @@ CREATE TRIGGER set_files_updated_at
 -- ========================================
 
 -- Funzione per ottenere lo spazio totale usato da un utente
+-- Scorre tutti i file (O(file)): per le quote l'API usa i contatori di storage_usage
+-- sul DB locale; questa resta per verifiche manuali e per la riconciliazione
 CREATE OR REPLACE FUNCTION public.get_user_storage_usage(user_uuid UUID)
 RETURNS BIGINT AS $$
 BEGIN